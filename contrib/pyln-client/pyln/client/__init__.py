@@ -1,13 +1,56 @@
 from .lightning import LightningRpc, RpcError, Millisatoshi
+from .metrics import HandlerMetrics, RpcMetrics
 from .plugin import Plugin, monkey_patch, RpcException
-from .gossmap import Gossmap, GossmapNode, GossmapChannel, GossmapHalfchannel, GossmapNodeId, LnFeatureBits
-from .gossmapstats import GossmapStats
+from typing import TYPE_CHECKING
+
+import importlib
+
+if TYPE_CHECKING:
+    from .async_lightning import AsyncLightningRpc
+    from .async_plugin import AsyncPlugin
+    from .gossmap import Gossmap, GossmapNode, GossmapChannel, GossmapHalfchannel, GossmapNodeId, LnFeatureBits
+    from .gossmapcolumns import GossmapColumns
+    from .gossmapstats import GossmapStats
 
 __version__ = "23.11"
 
+# Imported on first use: most plugins need none of these, and they pull
+# in asyncio, or pyln.proto and the parsed BOLT7 spec, which would slow
+# down every plugin's startup.
+_lazy = {
+    "AsyncLightningRpc": ".async_lightning",
+    "AsyncPlugin": ".async_plugin",
+    "Gossmap": ".gossmap",
+    "GossmapNode": ".gossmap",
+    "GossmapChannel": ".gossmap",
+    "GossmapHalfchannel": ".gossmap",
+    "GossmapNodeId": ".gossmap",
+    "LnFeatureBits": ".gossmap",
+    "GossmapColumns": ".gossmapcolumns",
+    "GossmapStats": ".gossmapstats",
+}
+
+
+def __getattr__(name):
+    module = _lazy.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
+
+
 __all__ = [
     "LightningRpc",
+    "AsyncLightningRpc",
+    "RpcMetrics",
+    "HandlerMetrics",
     "Plugin",
+    "AsyncPlugin",
     "RpcError",
     "RpcException",
     "Millisatoshi",
@@ -19,5 +62,6 @@ __all__ = [
     "GossmapHalfchannel",
     "GossmapNodeId",
     "LnFeatureBits",
+    "GossmapColumns",
     "GossmapStats",
 ]
@@ -0,0 +1,399 @@
+from .jsoncodec import get_codec
+from .lightning import (RPC_READ_SIZE, LightningRpc, RpcError,
+                        UnixDomainSocketRpc, UnixSocket, _pop_json,
+                        monkey_patch_json)
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+
+
+class AsyncRpcConnection(object):
+    """A connection to the RPC socket shared by many in-flight requests.
+
+    Responses are matched to their requests by JSON id, so any number
+    of coroutines can have calls outstanding on the same connection.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter,
+                 sock: Optional[socket.socket] = None):
+        self.reader = reader
+        self.writer = writer
+        self.sock = sock
+        self.notifications_enabled = False
+        self.closed = False
+        # Map of JSON id to (future, request, notify callback)
+        self.pending: Dict[str, Tuple[asyncio.Future, dict, Any]] = {}
+        self.read_task: Optional[asyncio.Task] = None
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        lost = {'error': 'Connection to RPC server lost.'}
+        for fut, _, _ in self.pending.values():
+            if not fut.done():
+                fut.set_result(lost)
+        self.pending = {}
+
+    def abandon(self) -> None:
+        """Close the socket from outside of the connection's event loop.
+
+        That loop may be closed already, so we can't go through the
+        transport, nor complete the pending futures.
+        """
+        self.closed = True
+        self.pending = {}
+        if self.sock is not None:
+            self.sock.close()
+
+
+class AsyncUnixDomainSocketRpc(object):
+    """asyncio counterpart of `UnixDomainSocketRpc`.
+
+    All calls share a single connection, which is opened on first use
+    and reopened if the server closes it, or if the client is then used
+    from another event loop (e.g. successive `asyncio.run`). `notify`, `reply_filter` and
+    `cmdprefix` are tracked per task (using `contextvars`), so that
+    concurrent coroutines don't interfere with each other.
+    """
+
+    def __init__(self, socket_path, logger=logging,
+                 encoder_cls=json.JSONEncoder, decoder=json.JSONDecoder(),
+                 caller_name=None, json_backend=None):
+        self.socket_path = socket_path
+        self.encoder_cls = encoder_cls
+        self.decoder = decoder
+        self.codec = get_codec(json_backend, encoder_cls, decoder)
+        self.logger = logger
+        if caller_name is None:
+            self.caller_name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        else:
+            self.caller_name = caller_name
+
+        self.next_id = 1
+
+        self._notify_var: ContextVar = ContextVar('notify', default=None)
+        self._filter_var: ContextVar = ContextVar('filter', default=None)
+        self._cmdprefix_var: ContextVar = ContextVar('cmdprefix', default=None)
+
+        # The event loop the connection and its lock belong to.
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._conn: Optional[AsyncRpcConnection] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+
+    # Same id format and method-by-attribute magic as the blocking client.
+    get_json_id = UnixDomainSocketRpc.get_json_id
+    __getattr__ = UnixDomainSocketRpc.__getattr__
+
+    @property
+    def cmdprefix(self) -> Optional[str]:
+        """Prefix for the JSON ids of calls made from the current task."""
+        return self._cmdprefix_var.get()
+
+    @cmdprefix.setter
+    def cmdprefix(self, cmdprefix: Optional[str]) -> None:
+        self._cmdprefix_var.set(cmdprefix)
+
+    async def _get_connection(self) -> AsyncRpcConnection:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Neither can be used from another loop; the old one is
+            # gone or busy elsewhere, so just close its connection.
+            if self._conn is not None:
+                self._conn.abandon()
+            self._loop = loop
+            self._connect_lock = asyncio.Lock()
+            self._conn = None
+        assert self._connect_lock is not None
+        async with self._connect_lock:
+            if self._conn is None or self._conn.closed:
+                # Connect synchronously, so we get UnixSocket's workaround
+                # for long paths; that never blocks for a unix socket.
+                s = UnixSocket(self.socket_path)
+                sock, s.sock = s.sock, None
+                reader, writer = await asyncio.open_unix_connection(sock=sock)
+                conn = AsyncRpcConnection(reader, writer, sock)
+                conn.read_task = asyncio.ensure_future(self._read_loop(conn))
+                self._conn = conn
+            return self._conn
+
+    async def _read_loop(self, conn: AsyncRpcConnection) -> None:
+        """Read responses and notifications, and hand them to their requests"""
+        buff = bytearray()
+        # Where to resume looking for the terminator, so we only ever
+        # scan newly received data.
+        scanned = 0
+        try:
+            while True:
+                end = buff.find(b'\n\n', scanned)
+                if end < 0:
+                    scanned = max(0, len(buff) - 1)
+                    b = await conn.reader.read(RPC_READ_SIZE)
+                    if len(b) == 0:
+                        break
+                    buff += b
+                    continue
+
+                obj = _pop_json(self.codec, buff, end)
+                scanned = 0
+                self._dispatch(conn, obj)
+        except (OSError, ValueError) as e:
+            self.logger.debug("Error reading from RPC connection: %r", e)
+        finally:
+            conn.close()
+
+    def _dispatch(self, conn: AsyncRpcConnection, resp: Any) -> None:
+        if not isinstance(resp, dict):
+            self.logger.debug("Ignoring malformed response %r", resp)
+            return
+        id = resp.get("id", None)
+        meth = resp.get("method", None)
+
+        if meth is not None and id is None:
+            # A notification: those we care about carry the id of the
+            # request they belong to.
+            params = resp.get('params', {})
+            pending = conn.pending.get(params.get('id', None))
+            if meth == 'message' and pending is not None and pending[2] is not None:
+                _, request, notify = pending
+                # The read loop serves every caller: one caller's
+                # callback failing must not fail the others' calls.
+                try:
+                    notify(
+                        message=params.get('message', None),
+                        progress=params.get('progress', None),
+                        request=request
+                    )
+                except Exception:
+                    self.logger.exception("Notification callback for %s failed",
+                                          request['id'])
+            return
+
+        pending = conn.pending.pop(id, None)
+        if pending is None:
+            self.logger.debug("Response for unknown request: %r", resp)
+            return
+        fut = pending[0]
+        if not fut.done():
+            fut.set_result(resp)
+
+    async def _request(self, conn: AsyncRpcConnection, request: dict,
+                       notify=None) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        conn.pending[request['id']] = (fut, request, notify)
+        try:
+            conn.writer.write(self.codec.dumps(request))
+            await conn.writer.drain()
+        except OSError:
+            conn.close()
+        return await fut
+
+    async def call(self, method, payload=None, cmdprefix=None, filter=None):
+        """Generic call API: you can set cmdprefix here, or set self.cmdprefix
+        before the call is made.
+
+        """
+        self.logger.debug("Calling %s with payload %r", method, payload)
+
+        if payload is None:
+            payload = {}
+        # Filter out arguments that are None
+        if isinstance(payload, dict):
+            payload = {k: v for k, v in payload.items() if v is not None}
+
+        this_id = self.get_json_id(method, cmdprefix)
+        self.next_id += 1
+
+        request = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": payload,
+            "id": this_id,
+        }
+
+        if filter is None:
+            filter = self._filter_var.get()
+        if filter is not None:
+            request["filter"] = filter
+
+        conn = await self._get_connection()
+        notify = self._notify_var.get()
+        if notify is not None and not conn.notifications_enabled:
+            # Opt into the notifications support
+            # FIXME: Notification schema support?
+            await self._request(conn, {
+                "jsonrpc": "2.0",
+                "method": "notifications",
+                "id": this_id + "+notify-enable",
+                "params": {
+                    "enable": True
+                },
+            })
+            conn.notifications_enabled = True
+
+        resp = await self._request(conn, request, notify)
+
+        self.logger.debug("Received response for %s call: %r", method, resp)
+        if not isinstance(resp, dict):
+            raise ValueError("Malformed response, response is not a dictionary %s." % resp)
+        elif "error" in resp:
+            raise RpcError(method, payload, resp['error'])
+        elif "result" not in resp:
+            raise ValueError("Malformed response, \"result\" missing.")
+        return resp["result"]
+
+    async def call_many(self, calls, cmdprefix=None, filter=None):
+        """Issue a batch of calls at once, see `UnixDomainSocketRpc.call_many`.
+
+        All requests are in flight at the same time on the shared
+        connection. Failed calls get their `RpcError` as result entry.
+        """
+        results = await asyncio.gather(*[
+            self.call(method, payload, cmdprefix=cmdprefix, filter=filter)
+            for method, payload in calls
+        ], return_exceptions=True)
+        for r in results:
+            if isinstance(r, BaseException) and not isinstance(r, RpcError):
+                raise r
+        return results
+
+    async def close_connections(self) -> None:
+        """Close the connection to the RPC socket, failing any pending call.
+
+        It gets reopened by the next call.
+        """
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        conn.close()
+        if conn.read_task is not None:
+            await asyncio.gather(conn.read_task, return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close_connections()
+
+    @contextmanager
+    def notify(self, fn):
+        """Register a notification callback to use for a set of RPC calls.
+
+        Works just like `UnixDomainSocketRpc.notify`, but only applies
+        to the calls made from the current task:
+
+        ```python
+        with rpc.notify(fn):
+            await rpc.somemethod()
+        ```
+        """
+        token = self._notify_var.set(fn)
+        try:
+            yield
+        finally:
+            self._notify_var.reset(token)
+
+    @contextmanager
+    def reply_filter(self, filter):
+        """Filter the fields returned from RPC calls made from the current task.
+
+        ```python
+        with rpc.reply_filter({"transactions": [{"outputs": [{"amount_msat": true, "type": true}]}]}):
+            await rpc.listtransactions()
+        ```
+        """
+        token = self._filter_var.set(filter)
+        try:
+            yield
+        finally:
+            self._filter_var.reset(token)
+
+
+class AsyncLightningRpc(AsyncUnixDomainSocketRpc, LightningRpc):
+    """
+    asyncio RPC client for the `lightningd` daemon.
+
+    This offers the same methods as `LightningRpc`, except that they
+    return awaitables: all the `LightningRpc` helpers simply return
+    the result of `self.call`, which here is a coroutine. Many calls
+    can be in flight at the same time over a single connection.
+
+    ```python
+    async with AsyncLightningRpc("/path/to/lightning-rpc") as rpc:
+        info, funds = await asyncio.gather(rpc.getinfo(), rpc.listfunds())
+    ```
+    """
+
+    def __init__(self, socket_path, logger=logging, patch_json=False,
+                 msat_mode='object', json_backend=None):
+        AsyncUnixDomainSocketRpc.__init__(
+            self,
+            socket_path,
+            logger,
+            LightningRpc.LightningJSONEncoder,
+            LightningRpc.LightningJSONDecoder(msat_mode=msat_mode),
+            json_backend=json_backend,
+        )
+
+        if patch_json:
+            monkey_patch_json(patch=True)
+
+    async def _paginate(self, method, key, index, start, page_size,
+                        prefetch, payload):
+        """Async generator counterpart of `LightningRpc._paginate`.
+
+        With `prefetch` the call for the next page runs concurrently
+        while the current one is being consumed.
+        """
+        if index not in ('created', 'updated'):
+            raise ValueError("index must be 'created' or 'updated'")
+        if page_size < 1:
+            raise ValueError("page_size must be at least 1")
+        index_key = index + '_index'
+        cmdprefix = self.cmdprefix
+        filter = self._filter_var.get()
+
+        async def fetch(start):
+            page = dict(payload, index=index, start=start, limit=page_size)
+            return (await self.call(method, page, cmdprefix=cmdprefix, filter=filter))[key]
+
+        nextpage = None
+        try:
+            entries = await fetch(start)
+            while entries:
+                if len(entries) == page_size:
+                    nextstart = entries[-1][index_key] + 1
+                    if prefetch:
+                        nextpage = asyncio.ensure_future(fetch(nextstart))
+                for entry in entries:
+                    yield entry
+
+                if len(entries) < page_size:
+                    break
+                if nextpage is not None:
+                    entries, nextpage = await nextpage, None
+                else:
+                    entries = await fetch(nextstart)
+        finally:
+            if nextpage is not None:
+                nextpage.cancel()
+
+    async def getpeer(self, peer_id, level=None):
+        """
+        Show peer with {peer_id}, if {level} is set, include {log}s.
+        """
+        payload = {
+            "id": peer_id,
+            "level": level
+        }
+        res = await self.call("listpeers", payload)
+        return res.get("peers") and res["peers"][0] or None
@@ -0,0 +1,161 @@
+from .async_lightning import AsyncLightningRpc
+from .lightning import RPC_READ_SIZE
+from .plugin import Plugin, Request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Set
+
+import asyncio
+import inspect
+import os
+import traceback
+
+
+class AsyncPlugin(Plugin):
+    """A `Plugin` running on an asyncio event loop.
+
+    Methods, hooks, subscriptions and the init handler can be `async def`
+    functions: each request is handled in its own task, so any number
+    of them can be pending (e.g. hold invoices, or HTLCs waiting for an
+    external decision) without blocking the others. Their result is
+    returned to lightningd when they complete, no need to use
+    `async_method` and `request.set_result`.
+
+    `plugin.rpc` is an `AsyncLightningRpc`, whose methods return
+    awaitables:
+
+    ```python
+    plugin = AsyncPlugin()
+
+    @plugin.method("hello")
+    async def hello(name, plugin):
+        info = await plugin.rpc.getinfo()
+        return "Hello {}, I am {}".format(name, info['id'])
+
+    plugin.run()
+    ```
+
+    Plain `def` handlers are still supported, and run on the event
+    loop's thread: they must not block. CPU bound ones can be added
+    with `process=True`, the child process then has a synchronous
+    `LightningRpc` as `plugin.rpc`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('max_workers') is not None:
+            raise ValueError("AsyncPlugin does not support max_workers")
+        super().__init__(*args, **kwargs)
+        # Tasks handling requests, so they are not garbage collected
+        # while pending, and we can wait for them on exit.
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _connect_rpc(self, path: str) -> AsyncLightningRpc:  # type: ignore[override]
+        return AsyncLightningRpc(path, json_backend=self.json_backend)
+
+    def run(self) -> None:
+        # If we are not running inside lightningd we'll print usage
+        # and some information about the plugin.
+        if os.environ.get('LIGHTNINGD_PLUGIN', None) != '1':
+            return self.print_usage()
+        asyncio.run(self.run_async())
+
+    async def run_async(self) -> None:
+        """Read and handle requests from lightningd until stdin is closed.
+
+        This is what `run` does, for use from an already running event
+        loop.
+        """
+        loop = asyncio.get_running_loop()
+        # Reading stdin blocks, do it in a thread of its own.
+        reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='plugin-stdin')
+        read = self.stdin.buffer.read1
+        buff = bytearray()
+        scanned = 0
+        self._start_writer()
+        try:
+            while True:
+                b = await loop.run_in_executor(reader, read, RPC_READ_SIZE)
+                if len(b) == 0:
+                    break
+                buff += b
+                requests: List[Request] = []
+                scanned = self._consume(buff, scanned, lambda payload: requests.append(
+                    self._parse_request(self.codec.loads(payload))
+                ))
+                for request in requests:
+                    if request.method in ('getmanifest', 'init'):
+                        # Nothing else may run before we're initialized.
+                        await self._dispatch_async(request)
+                    else:
+                        self._start(self._dispatch_async(request))
+                self.flush_logs()
+
+            # Let pending requests finish.
+            while self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=True)
+        finally:
+            self._stop_writer()
+            reader.shutdown(wait=False)
+            if isinstance(self.rpc, AsyncLightningRpc):
+                await self.rpc.close_connections()
+
+    def _start(self, coro) -> None:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch_async(self, request: Request) -> None:
+        # There is no one to raise to in a task.
+        if self.handler_metrics is not None:
+            self.handler_metrics.request_started()
+        try:
+            if request.id is not None:
+                await self._dispatch_request_async(request)
+            else:
+                await self._dispatch_notification_async(request)
+        except Exception:
+            self.log(traceback.format_exc(), level='error')
+
+    async def _exec_func_async(self, func: Callable[..., Any],
+                               request: Request) -> Any:
+        ret = self._exec_func(func, request)
+        if inspect.isawaitable(ret):
+            # _exec_func only sets the JSON id prefix while calling the
+            # function, which for a coroutine function returns before
+            # it ran. The prefix is per task, so we can leave it set.
+            if self.rpc:
+                self.rpc.cmdprefix = request.id
+            ret = await ret
+        return ret
+
+    async def _dispatch_request_async(self, request: Request) -> None:
+        method = self._request_method(request)
+
+        if method.process:
+            fut = self._process_submit(request)
+            try:
+                await asyncio.wrap_future(fut)
+            except Exception:
+                # _process_done reports it.
+                pass
+            self._process_done(request, fut)
+            return
+
+        try:
+            result = await self._exec_func_async(method.func, request)
+            if not method.background:
+                request.set_result(result)
+        except Exception as e:
+            self._request_failed(request, e)
+
+    async def _dispatch_notification_async(self, request: Request) -> None:
+        func = self._subscription_func(request)
+
+        try:
+            await self._exec_func_async(func, request)
+        except Exception:
+            self._record_notification(request, True)
+            self.log(traceback.format_exc())
+        else:
+            self._record_notification(request, False)
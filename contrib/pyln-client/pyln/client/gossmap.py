@@ -3,14 +3,19 @@
 from pyln.spec.bolt7 import (channel_announcement, channel_update,
                              node_announcement)
 from pyln.proto import ShortChannelId, PublicKey
-from typing import Any, Dict, List, Set, Optional, Union
+from typing import Any, Dict, List, Set, Optional, Tuple, Union, TYPE_CHECKING
 
 import io
 import base64
+import mmap
+import os
 import socket
 import struct
 import time
 
+if TYPE_CHECKING:
+    from .gossmapcolumns import GossmapColumns
+
 # These duplicate constants in lightning/common/gossip_store.h
 GOSSIP_STORE_MAJOR_VERSION = (0 << 5)
 GOSSIP_STORE_MAJOR_VERSION_MASK = 0xE0
@@ -26,6 +31,33 @@ WIRE_GOSSIP_STORE_DELETE_CHAN = 4103
 WIRE_GOSSIP_STORE_ENDED = 4105
 WIRE_GOSSIP_STORE_CHANNEL_AMOUNT = 4101
 
+# flags, length, crc, timestamp, followed by the record, starting with its type
+GOSSIP_STORE_HDR = struct.Struct('>HHII')
+GOSSIP_STORE_HDR_LEN = GOSSIP_STORE_HDR.size
+_RECTYPE = struct.Struct('>H')
+_U16 = struct.Struct('>H')
+_U64 = struct.Struct('>Q')
+
+# Offsets in a channel_announcement (after its type): four signatures,
+# then the features' length and the features. The short_channel_id
+# and node ids follow the (variable length) features and chain_hash.
+_CA_FLEN = 4 * 64
+_CA_FEATURES = _CA_FLEN + 2
+
+# A channel_update (after its type) is a signature and chain_hash
+# followed by fixed size fields, htlc_maximum_msat being optional in
+# older stores.
+_CU_SCID = 64 + 32
+_CU_CHANNEL_FLAGS = _CU_SCID + 8 + 4 + 1
+_CU_FIELDS = struct.Struct('>QIBBHQIIQ')
+_CU_FIELDS_NO_MAX = struct.Struct('>QIBBHQII')
+
+# A node_announcement (after its type): signature, features' length and
+# features, then timestamp, node_id, rgb_color, alias, addresses.
+_NA_FLEN = 64
+_NA_FEATURES = _NA_FLEN + 2
+_NA_META = struct.Struct('>I33s3s32sH')
+
 
 class LnFeatureBits(object):
     """ feature flags taken from bolts.git/09-features.md
@@ -87,41 +119,101 @@ def _parse_features(featurebytes):
 
 
 class GossipStoreMsgHeader(object):
-    def __init__(self, buf: bytes, off: int):
-        self.flags, self.length, self.crc, self.timestamp = struct.unpack('>HHII', buf)
+    """The header of a gossip_store record, found at `pos` in `buf`.
+
+    `off` and `length` locate the record's message in the store (for
+    private channels and updates, the message they wrap).
+    """
+    __slots__ = ('flags', 'length', 'crc', 'timestamp', 'off', 'pos')
+
+    def __init__(self, buf: bytes, off: int, pos: int = 0):
+        self.flags, self.length, self.crc, self.timestamp = GOSSIP_STORE_HDR.unpack_from(buf, pos)
         self.off = off
-        self.deleted = (self.flags & GOSSIP_STORE_LEN_DELETED_BIT) != 0
-        self.ratelimit = (self.flags & GOSSIP_STORE_LEN_RATELIMIT_BIT) != 0
-        self.zombie = (self.flags & GOSSIP_STORE_ZOMBIE_BIT) != 0
+        self.pos = pos
+
+    @property
+    def deleted(self) -> bool:
+        return (self.flags & GOSSIP_STORE_LEN_DELETED_BIT) != 0
+
+    @property
+    def ratelimit(self) -> bool:
+        return (self.flags & GOSSIP_STORE_LEN_RATELIMIT_BIT) != 0
+
+    @property
+    def zombie(self) -> bool:
+        return (self.flags & GOSSIP_STORE_ZOMBIE_BIT) != 0
+
+
+def _message(store: '_StoreMap', hdr: GossipStoreMsgHeader) -> bytes:
+    """The message `hdr` is the header of, without its type"""
+    return store.buf[hdr.off + 2:hdr.off + hdr.length]
 
 
 class GossmapHalfchannel(object):
-    """One direction of a GossmapChannel."""
+    """One direction of a GossmapChannel.
+
+    When loaded from a store, the routing attributes are read straight
+    from the channel_update in the `store`, and `fields` is only decoded
+    on first access."""
+    __slots__ = ('channel', 'direction', 'hdr', '_fields', '_store',
+                 'timestamp', 'cltv_expiry_delta', 'htlc_minimum_msat',
+                 'htlc_maximum_msat', 'fee_base_msat',
+                 'fee_proportional_millionths', 'disabled', '_numscidd')
+
     def __init__(self, channel: 'GossmapChannel', direction: int,
-                 fields: Dict[str, Any], hdr: GossipStoreMsgHeader):
+                 fields: Optional[Dict[str, Any]], hdr: GossipStoreMsgHeader,
+                 store: Optional['_StoreMap'] = None):
         assert direction in [0, 1], "direction can only be 0 or 1"
         self.channel = channel
         self.direction = direction
-        self.source = channel.node1 if direction == 0 else channel.node2
-        self.destination = channel.node2 if direction == 0 else channel.node1
-        self.fields: Dict[str, Any] = fields
+        self._fields = fields
+        self._store = store
         self.hdr: GossipStoreMsgHeader = hdr
 
-        self.timestamp: int = fields['timestamp']
-        self.cltv_expiry_delta: int = fields['cltv_expiry_delta']
-        self.htlc_minimum_msat: int = fields['htlc_minimum_msat']
-        self.htlc_maximum_msat: Optional[int] = fields.get('htlc_maximum_msat', None)
-        self.fee_base_msat: int = fields['fee_base_msat']
-        self.fee_proportional_millionths: int = fields['fee_proportional_millionths']
-        self.disabled = fields['channel_flags'] & 2 > 0
-
-        # Cache the _scidd and hash to have faster operation later
-        # Unfortunately the @final decorator only comes for python3.8
-        self._scidd = f"{self.channel.scid}/{self.direction}"
+        self.htlc_maximum_msat: Optional[int]
+        if fields is not None:
+            self.timestamp: int = fields['timestamp']
+            self.cltv_expiry_delta: int = fields['cltv_expiry_delta']
+            self.htlc_minimum_msat: int = fields['htlc_minimum_msat']
+            self.htlc_maximum_msat = fields.get('htlc_maximum_msat', None)
+            self.fee_base_msat: int = fields['fee_base_msat']
+            self.fee_proportional_millionths: int = fields['fee_proportional_millionths']
+            self.disabled = fields['channel_flags'] & 2 > 0
+        else:
+            assert store is not None
+            start = hdr.off + 2 + _CU_SCID
+            if hdr.length >= 2 + _CU_SCID + _CU_FIELDS.size:
+                (_, self.timestamp, _, channel_flags, self.cltv_expiry_delta,
+                 self.htlc_minimum_msat, self.fee_base_msat,
+                 self.fee_proportional_millionths,
+                 self.htlc_maximum_msat) = _CU_FIELDS.unpack_from(store.buf, start)
+            else:
+                (_, self.timestamp, _, channel_flags, self.cltv_expiry_delta,
+                 self.htlc_minimum_msat, self.fee_base_msat,
+                 self.fee_proportional_millionths) = _CU_FIELDS_NO_MAX.unpack_from(store.buf, start)
+                self.htlc_maximum_msat = None
+            self.disabled = channel_flags & 2 > 0
+
+        # Cache the hash to have faster operation later
         self._numscidd = direction << 63 | self.channel.scid.to_int()
 
+    @property
+    def source(self) -> 'GossmapNode':
+        return self.channel.node1 if self.direction == 0 else self.channel.node2
+
+    @property
+    def destination(self) -> 'GossmapNode':
+        return self.channel.node2 if self.direction == 0 else self.channel.node1
+
+    @property
+    def fields(self) -> Dict[str, Any]:
+        if self._fields is None:
+            assert self._store is not None
+            self._fields = channel_update.read(io.BytesIO(_message(self._store, self.hdr)), {})
+        return self._fields
+
     def __repr__(self):
-        return f"GossmapHalfchannel[{self._scidd}]"
+        return f"GossmapHalfchannel[{self}]"
 
     def __eq__(self, other):
         if not isinstance(other, GossmapHalfchannel):
@@ -129,13 +221,15 @@ class GossmapHalfchannel(object):
         return self._numscidd == other._numscidd
 
     def __str__(self):
-        return self._scidd
+        return f"{self.channel.scid}/{self.direction}"
 
     def __hash__(self):
         return self._numscidd
 
 
 class GossmapNodeId(object):
+    __slots__ = ('nodeid',)
+
     def __init__(self, buf: Union[bytes, str]):
         if isinstance(buf, str):
             buf = bytes.fromhex(buf)
@@ -143,9 +237,6 @@ class GossmapNodeId(object):
             raise ValueError("{} is not a valid node_id".format(buf.hex()))
         self.nodeid = buf
 
-        self._hash = self.nodeid.__hash__()
-        self._str = self.nodeid.hex()
-
     def to_pubkey(self) -> PublicKey:
         return PublicKey(self.nodeid)
 
@@ -160,13 +251,14 @@ class GossmapNodeId(object):
         return self.nodeid.__lt__(other.nodeid)  # yes, that works
 
     def __hash__(self):
-        return self._hash
+        # bytes cache their hash
+        return self.nodeid.__hash__()
 
     def __repr__(self):
         return "GossmapNodeId[{}]".format(self.nodeid.hex())
 
     def __str__(self):
-        return self._str
+        return self.nodeid.hex()
 
     @classmethod
     def from_str(cls, s: str):
@@ -179,15 +271,23 @@ class GossmapNodeId(object):
 
 class GossmapChannel(object):
     """A channel: fields of channel_announcement are in .fields,
-       optional updates are in .half_channels[0/1].fields """
+       optional updates are in .half_channels[0/1].fields
+
+       When loaded from a store, `fields` is only decoded on first
+       access, from the message in the `store`."""
+    __slots__ = ('_fields', '_store', 'hdr', 'is_private', 'scid', 'node1',
+                 'node2', 'satoshis', 'half_channels', 'features')
+
     def __init__(self,
-                 fields: Dict[str, Any],
+                 fields: Optional[Dict[str, Any]],
                  scid: Union[ShortChannelId, str],
                  node1: 'GossmapNode',
                  node2: 'GossmapNode',
                  is_private: bool,
-                 hdr: GossipStoreMsgHeader):
-        self.fields: Dict[str, Any] = fields
+                 hdr: GossipStoreMsgHeader,
+                 store: Optional['_StoreMap'] = None):
+        self._fields = fields
+        self._store = store
         self.hdr: GossipStoreMsgHeader = hdr
 
         self.is_private = is_private
@@ -196,14 +296,28 @@ class GossmapChannel(object):
         self.node2 = node2
         self.satoshis = None
         self.half_channels: List[Optional[GossmapHalfchannel]] = [None, None]
-        self.features = _parse_features(fields['features'])
+        if fields is not None:
+            self.features = _parse_features(fields['features'])
+        else:
+            assert store is not None
+            start = hdr.off + 2 + _CA_FEATURES
+            flen, = _U16.unpack_from(store.buf, hdr.off + 2 + _CA_FLEN)
+            self.features = int.from_bytes(store.buf[start:start + flen], 'big')
+
+    @property
+    def fields(self) -> Dict[str, Any]:
+        if self._fields is None:
+            assert self._store is not None
+            self._fields = channel_announcement.read(io.BytesIO(_message(self._store, self.hdr)), {})
+        return self._fields
 
     def _update_channel(self,
                         direction: int,
-                        fields: Dict[str, Any],
-                        hdr: GossipStoreMsgHeader):
+                        fields: Optional[Dict[str, Any]],
+                        hdr: GossipStoreMsgHeader,
+                        store: Optional['_StoreMap'] = None):
 
-        half = GossmapHalfchannel(self, direction, fields, hdr)
+        half = GossmapHalfchannel(self, direction, fields, hdr, store)
         self.half_channels[direction] = half
 
     def get_direction(self, direction: int):
@@ -248,20 +362,101 @@ class GossmapChannel(object):
 class GossmapNode(object):
     """A node: fields of node_announcement are in .fields,
        which can be None if there has been no node announcement.
-       .channels is a list of the GossmapChannels attached to this node."""
+       .channels is a list of the GossmapChannels attached to this node.
+
+       When loaded from a store, the announcement's fields and metadata
+       (features, timestamp, alias, rgb, addresses) are decoded on first
+       access, from the message in the `store`."""
+    __slots__ = ('_fields', '_store', '_meta', 'hdr', 'channels', 'node_id',
+                 'announced')
+
     def __init__(self, node_id: Union[GossmapNodeId, bytes, str]):
         if isinstance(node_id, bytes) or isinstance(node_id, str):
             node_id = GossmapNodeId(node_id)
-        self.fields: Optional[Dict[str, Any]] = None
+        self._fields: Optional[Dict[str, Any]] = None
+        self._store: Optional[_StoreMap] = None
+        self._meta: Optional[Tuple[int, int, str, List[int], List[str]]] = None
         self.hdr: GossipStoreMsgHeader = None
         self.channels: List[GossmapChannel] = []
         self.node_id = node_id
         self.announced = False
 
-        self._hash = self.node_id.__hash__()
+    def _announce(self, hdr: GossipStoreMsgHeader, store: '_StoreMap') -> None:
+        """Use the node_announcement `hdr` is the header of in `store`"""
+        self.hdr = hdr
+        self._store = store
+        self._fields = None
+        self._meta = None
+        self.announced = True
+
+    def _unannounce(self) -> None:
+        """Forget the node_announcement, which was deleted"""
+        self.hdr = None
+        self._store = None
+        self._fields = None
+        self._meta = None
+        self.announced = False
+
+    @property
+    def fields(self) -> Optional[Dict[str, Any]]:
+        if self._fields is None and self._store is not None:
+            self._fields = node_announcement.read(io.BytesIO(_message(self._store, self.hdr)), {})
+        return self._fields
+
+    @fields.setter
+    def fields(self, fields: Optional[Dict[str, Any]]) -> None:
+        self._fields = fields
+        self._store = None
+        # Decoded again from the new fields.
+        self._meta = None
+
+    def _get_meta(self, name: str) -> Tuple[int, int, str, List[int], List[str]]:
+        if self._meta is None:
+            if not self.announced:
+                raise AttributeError(name)
+            if self._store is None:
+                fields = self.fields
+                assert fields is not None
+                self._meta = (_parse_features(fields['features']),
+                              fields['timestamp'],
+                              bytes(fields['alias']).decode('utf-8'),
+                              fields['rgb_color'],
+                              self._parse_addresses(bytes(fields['addresses'])))
+            else:
+                raw = _message(self._store, self.hdr)
+                flen, = _U16.unpack_from(raw, _NA_FLEN)
+                pos = _NA_FEATURES + flen
+                timestamp, _, rgb, alias, addrlen = _NA_META.unpack_from(raw, pos)
+                pos += _NA_META.size
+                self._meta = (int.from_bytes(raw[_NA_FEATURES:_NA_FEATURES + flen], 'big'),
+                              timestamp,
+                              alias.decode('utf-8'),
+                              list(rgb),
+                              self._parse_addresses(raw[pos:pos + addrlen]))
+        return self._meta
+
+    @property
+    def features(self) -> int:
+        return self._get_meta('features')[0]
+
+    @property
+    def timestamp(self) -> int:
+        return self._get_meta('timestamp')[1]
+
+    @property
+    def alias(self) -> str:
+        return self._get_meta('alias')[2]
+
+    @property
+    def rgb(self) -> List[int]:
+        return self._get_meta('rgb')[3]
+
+    @property
+    def addresses(self) -> List[str]:
+        return self._get_meta('addresses')[4]
 
     def __repr__(self):
-        if hasattr(self, 'alias'):
+        if self.announced:
             return f"GossmapNode[{self.node_id.nodeid.hex()}, \"{self.alias}\"]"
         return f"GossmapNode[{self.node_id.nodeid.hex()}]"
 
@@ -276,7 +471,7 @@ class GossmapNode(object):
         return self.node_id.__lt__(other.node_id)
 
     def __hash__(self):
-        return self._hash
+        return self.node_id.__hash__()
 
     def __str__(self):
         return str(self.node_id)
@@ -304,7 +499,7 @@ class GossmapNode(object):
                 return False
         return True
 
-    def _parse_addresses(self, data: bytes):
+    def _parse_addresses(self, data: bytes) -> List[str]:
         """ parse address descriptors defined in bolts 07-routing-gossip.md """
         result = []
         try:
@@ -335,7 +530,7 @@ class GossmapNode(object):
         # we simply pass exceptions and return what we were able to read so far
         except Exception:
             pass
-        self.addresses = result
+        return result
 
     def get_address_type(self, idx: int):
         """ I know this can be more sophisticated, but works """
@@ -390,65 +585,200 @@ class GossmapNode(object):
         return True
 
 
+class _StoreMap(object):
+    """A read-only memory map of a gossip_store file, growing with it.
+
+    Mapping the file, rather than reading it, lets us walk the records
+    in place, without copying them around.
+    """
+    def __init__(self, f: io.BufferedReader):
+        self.file = f
+        self.buf: Union[mmap.mmap, bytes] = b''
+        self.remap()
+
+    def remap(self) -> int:
+        """Map whatever was appended since, returns the mapped size."""
+        size = os.fstat(self.file.fileno()).st_size
+        if size > len(self.buf):
+            # The previous map gets unmapped once nothing uses it.
+            self.buf = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        return len(self.buf)
+
+
+class GossmapChanges(object):
+    """What a `Gossmap.refresh` changed.
+
+    The short channel ids of the channels, and node ids of the nodes,
+    that were added, removed or updated: for channels a new or deleted
+    channel_update, for nodes a new or deleted node_announcement. A
+    channel or node that was removed then added back is updated.
+    `reopened` tells whether the store was rewritten, e.g. compacted.
+    """
+    __slots__ = ('added_channels', 'removed_channels', 'updated_channels',
+                 'added_nodes', 'removed_nodes', 'updated_nodes', 'reopened')
+
+    def __init__(self):
+        self.added_channels: Set[ShortChannelId] = set()
+        self.removed_channels: Set[ShortChannelId] = set()
+        self.updated_channels: Set[ShortChannelId] = set()
+        self.added_nodes: Set[GossmapNodeId] = set()
+        self.removed_nodes: Set[GossmapNodeId] = set()
+        self.updated_nodes: Set[GossmapNodeId] = set()
+        self.reopened = False
+
+    @staticmethod
+    def _added(added: Set[Any], removed: Set[Any], updated: Set[Any], key: Any) -> None:
+        if key in removed:
+            removed.discard(key)
+            updated.add(key)
+        else:
+            added.add(key)
+
+    @staticmethod
+    def _removed(added: Set[Any], removed: Set[Any], updated: Set[Any], key: Any) -> None:
+        if key in added:
+            # Never seen by the caller.
+            added.discard(key)
+        else:
+            updated.discard(key)
+            removed.add(key)
+
+    def _add_channel(self, scid: ShortChannelId) -> None:
+        self._added(self.added_channels, self.removed_channels, self.updated_channels, scid)
+
+    def _remove_channel(self, scid: ShortChannelId) -> None:
+        self._removed(self.added_channels, self.removed_channels, self.updated_channels, scid)
+
+    def _update_channel(self, scid: ShortChannelId) -> None:
+        if scid not in self.added_channels:
+            self.updated_channels.add(scid)
+
+    def _add_node(self, node_id: GossmapNodeId) -> None:
+        self._added(self.added_nodes, self.removed_nodes, self.updated_nodes, node_id)
+
+    def _remove_node(self, node_id: GossmapNodeId) -> None:
+        self._removed(self.added_nodes, self.removed_nodes, self.updated_nodes, node_id)
+
+    def _update_node(self, node_id: GossmapNodeId) -> None:
+        if node_id not in self.added_nodes:
+            self.updated_nodes.add(node_id)
+
+    def __bool__(self):
+        return bool(self.added_channels or self.removed_channels or self.updated_channels
+                    or self.added_nodes or self.removed_nodes or self.updated_nodes
+                    or self.reopened)
+
+    def __repr__(self):
+        return ("GossmapChanges[channels +{} -{} ~{}, nodes +{} -{} ~{}{}]"
+                .format(len(self.added_channels), len(self.removed_channels),
+                        len(self.updated_channels), len(self.added_nodes),
+                        len(self.removed_nodes), len(self.updated_nodes),
+                        ", reopened" if self.reopened else ""))
+
+
 class Gossmap(object):
-    """Class to represent the gossip map of the network"""
+    """Class to represent the gossip map of the network
+
+    The store is memory mapped, and `refresh` processes the records
+    appended to it since the last one. `bytes_read` is the offset in
+    the store up to which it was processed.
+
+    A long running process can keep it up to date by calling `refresh`
+    from time to time, which returns a `GossmapChanges`.
+    """
     def __init__(self, store_filename: str = "gossip_store"):
         self.store_filename = store_filename
         self.store_file = open(store_filename, "rb")
-        self.store_buf = bytes()
-        self.bytes_read = 0
+        self._store = _StoreMap(self.store_file)
+        if len(self._store.buf) == 0:
+            raise ValueError("Empty gossip store {}".format(store_filename))
+        self.bytes_read = 1
         self.nodes: Dict[GossmapNodeId, GossmapNode] = {}
         self.channels: Dict[ShortChannelId, GossmapChannel] = {}
         self._last_scid: Optional[str] = None
-        version = self.store_file.read(1)[0]
+        version = self._store.buf[0]
         if (version & GOSSIP_STORE_MAJOR_VERSION_MASK) != GOSSIP_STORE_MAJOR_VERSION:
             raise ValueError("Invalid gossip store version {}".format(version))
         self.processing_time = 0
         self.orphan_channel_updates = set()
-        self.refresh()
+        self._columns: Optional['GossmapColumns'] = None
+        # What the current refresh changed, None while loading.
+        self._changes: Optional[GossmapChanges] = None
+        self._catchup()
 
     def _new_channel(self,
-                     fields: Dict[str, Any],
+                     fields: Optional[Dict[str, Any]],
                      scid: ShortChannelId,
                      node1: GossmapNode,
                      node2: GossmapNode,
                      is_private: bool,
                      hdr: GossipStoreMsgHeader):
-        c = GossmapChannel(fields, scid, node1, node2, is_private, hdr)
+        c = GossmapChannel(fields, scid, node1, node2, is_private, hdr,
+                           self._store)
         self._last_scid = scid
+        old = self.channels.get(scid)
+        if old is not None:
+            # e.g. a private channel that got announced.
+            node1.channels.remove(old)
+            node2.channels.remove(old)
         self.channels[scid] = c
         node1.channels.append(c)
         node2.channels.append(c)
+        if self._changes is not None:
+            if old is None:
+                self._changes._add_channel(scid)
+            else:
+                self._changes._update_channel(scid)
 
     def _del_channel(self, scid: ShortChannelId):
         c = self.channels[scid]
         del self.channels[scid]
         c.node1.channels.remove(c)
         c.node2.channels.remove(c)
+        changes = self._changes
+        if changes is not None:
+            changes._remove_channel(scid)
         # Beware self-channels n1-n1!
         if len(c.node1.channels) == 0 and c.node1 != c.node2:
             del self.nodes[c.node1.node_id]
+            if changes is not None:
+                changes._remove_node(c.node1.node_id)
         if len(c.node2.channels) == 0:
             del self.nodes[c.node2.node_id]
-
-    def _add_channel(self, rec: bytes, is_private: bool, hdr: GossipStoreMsgHeader):
-        fields = channel_announcement.read(io.BytesIO(rec[2:]), {})
+            if changes is not None:
+                changes._remove_node(c.node2.node_id)
+
+    def _add_channel(self, rec: memoryview, is_private: bool, hdr: GossipStoreMsgHeader):
+        # We only pick what we need to place the channel in the graph,
+        # its fields get decoded if and when they are used.
+        msg = rec[2:]
+        flen, = _U16.unpack_from(msg, _CA_FLEN)
+        pos = _CA_FEATURES + flen + 32  # skip the chain_hash
+        scid, = _U64.unpack_from(msg, pos)
         # Add nodes one the fly
-        node1_id = GossmapNodeId(fields['node_id_1'])
-        node2_id = GossmapNodeId(fields['node_id_2'])
+        node1_id = GossmapNodeId(bytes(msg[pos + 8:pos + 8 + 33]))
+        node2_id = GossmapNodeId(bytes(msg[pos + 8 + 33:pos + 8 + 66]))
         if node1_id not in self.nodes:
-            self.nodes[node1_id] = GossmapNode(node1_id)
+            self._new_node(node1_id)
         if node2_id not in self.nodes:
-            self.nodes[node2_id] = GossmapNode(node2_id)
-        self._new_channel(fields,
-                          ShortChannelId.from_int(fields['short_channel_id']),
+            self._new_node(node2_id)
+        self._new_channel(None,
+                          ShortChannelId.from_int(scid),
                           self.get_node(node1_id), self.get_node(node2_id),
                           is_private, hdr)
 
-    def _set_channel_amount(self, rec: bytes):
+    def _new_node(self, node_id: GossmapNodeId) -> GossmapNode:
+        node = GossmapNode(node_id)
+        self.nodes[node_id] = node
+        if self._changes is not None:
+            self._changes._add_node(node_id)
+        return node
+
+    def _set_channel_amount(self, rec: memoryview):
         """ Sets channel capacity of last added channel """
         sats, = struct.unpack(">Q", rec[2:])
-        self.channels[self._last_scid].satoshis = sats
+        if self._last_scid is not None:
+            self.channels[self._last_scid].satoshis = sats
 
     def get_channel(self, short_channel_id: Union[ShortChannelId, str]):
         """ Resolves a channel by its short channel id """
@@ -558,80 +888,236 @@ class Gossmap(object):
             inner = shell
         return result
 
-    def _update_channel(self, rec: bytes, hdr: GossipStoreMsgHeader):
-        fields = channel_update.read(io.BytesIO(rec[2:]), {})
-        direction = fields['channel_flags'] & 1
-        scid = ShortChannelId.from_int(fields['short_channel_id'])
+    def _update_channel(self, rec: memoryview, hdr: GossipStoreMsgHeader):
+        scidint, = _U64.unpack_from(rec, 2 + _CU_SCID)
+        direction = rec[2 + _CU_CHANNEL_FLAGS] & 1
+        scid = ShortChannelId.from_int(scidint)
         if scid in self.channels:
             c = self.channels[scid]
-            c._update_channel(direction, fields, hdr)
+            c._update_channel(direction, None, hdr, self._store)
+            if self._changes is not None:
+                self._changes._update_channel(scid)
         else:
             self.orphan_channel_updates.add(scid)
 
-    def _add_node_announcement(self, rec: bytes, hdr: GossipStoreMsgHeader):
-        fields = node_announcement.read(io.BytesIO(rec[2:]), {})
-        node_id = GossmapNodeId(fields['node_id'])
-        if node_id not in self.nodes:
-            self.nodes[node_id] = GossmapNode(node_id)
-        node = self.nodes[node_id]
-        node.fields = fields
-        node.hdr = hdr
-
-        # read metadata
-        node.features = _parse_features(fields['features'])
-        node.timestamp = fields['timestamp']
-        node.alias = bytes(fields['alias']).decode('utf-8')
-        node.rgb = fields['rgb_color']
-        node._parse_addresses(bytes(fields['addresses']))
-        node.announced = True
-
-    def reopen_store(self):
-        assert False, "FIXME: Implement!"
-
-    def _remove_channel_by_deletemsg(self, rec: bytes):
+    def _add_node_announcement(self, rec: memoryview, hdr: GossipStoreMsgHeader):
+        flen, = _U16.unpack_from(rec, 2 + _NA_FLEN)
+        pos = 2 + _NA_FEATURES + flen + 4  # skip the timestamp
+        node_id = GossmapNodeId(bytes(rec[pos:pos + 33]))
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = self._new_node(node_id)
+        elif self._changes is not None:
+            self._changes._update_node(node_id)
+        node._announce(hdr, self._store)
+
+    def reopen_store(self, equivalent_offset: int) -> None:
+        """Switch to the new gossip_store, after the old one ended.
+
+        The store was rewritten (e.g. compacted) into a new file, whose
+        first `equivalent_offset` bytes hold the records of the old one
+        which were not deleted. We rebind our objects to those, drop
+        the ones that are no longer there, and resume reading from
+        `equivalent_offset` on.
+        """
+        store_file = open(self.store_filename, "rb")
+        store = _StoreMap(store_file)
+        if len(store.buf) < equivalent_offset:
+            store_file.close()
+            raise ValueError("New gossip store {} is shorter than its equivalent offset {}"
+                             .format(self.store_filename, equivalent_offset))
+        version = store.buf[0]
+        if (version & GOSSIP_STORE_MAJOR_VERSION_MASK) != GOSSIP_STORE_MAJOR_VERSION:
+            store_file.close()
+            raise ValueError("Invalid gossip store version {}".format(version))
+        old_file = self.store_file
+        self.store_file = store_file
+        self._store = store
+        view = memoryview(store.buf)
+        try:
+            self._rebind_records(store.buf, view, equivalent_offset)
+        finally:
+            view.release()
+        self.bytes_read = equivalent_offset
+        if self._changes is not None:
+            self._changes.reopened = True
+        # Objects still using the old map keep it alive.
+        old_file.close()
+
+    def _rebind_records(self, buf: Union[mmap.mmap, bytes], view: memoryview,
+                        end: int) -> None:
+        unpack_hdr = GOSSIP_STORE_HDR.unpack_from
+        unpack_type = _RECTYPE.unpack_from
+        skip = GOSSIP_STORE_LEN_DELETED_BIT | GOSSIP_STORE_ZOMBIE_BIT
+        store = self._store
+        channels: Set[ShortChannelId] = set()
+        halfchannels: Set[GossmapHalfchannel] = set()
+        nodes: Set[GossmapNodeId] = set()
+        pos = 1
+        while pos + GOSSIP_STORE_HDR_LEN <= end:
+            flags, length, _, _ = unpack_hdr(buf, pos)
+            off = pos + GOSSIP_STORE_HDR_LEN
+            hdr = GossipStoreMsgHeader(buf, off, pos)
+            pos = off + length
+            if flags & skip:
+                continue
+
+            rectype, = unpack_type(buf, off)
+            rec = view[off:pos]
+            if rectype == WIRE_GOSSIP_STORE_PRIVATE_CHANNEL:
+                hdr.off += 2 + 8 + 2
+                hdr.length -= 2 + 8 + 2
+                rec = rec[2 + 8 + 2:]
+                rectype = channel_announcement.number
+            elif rectype == WIRE_GOSSIP_STORE_PRIVATE_UPDATE:
+                hdr.off += 2 + 2
+                hdr.length -= 2 + 2
+                rec = rec[2 + 2:]
+                rectype = channel_update.number
+
+            if rectype == channel_announcement.number:
+                flen, = _U16.unpack_from(rec, 2 + _CA_FLEN)
+                scidint, = _U64.unpack_from(rec, 2 + _CA_FEATURES + flen + 32)
+                scid = ShortChannelId.from_int(scidint)
+                c = self.channels.get(scid)
+                if c is not None:
+                    c.hdr = hdr
+                    c._store = store
+                    channels.add(scid)
+            elif rectype == channel_update.number:
+                scidint, timestamp = struct.unpack_from('>QI', rec, 2 + _CU_SCID)
+                scid = ShortChannelId.from_int(scidint)
+                c = self.channels.get(scid)
+                if c is None:
+                    continue
+                direction = rec[2 + _CU_CHANNEL_FLAGS] & 1
+                hc = c.half_channels[direction]
+                if hc is not None and hc.timestamp == timestamp:
+                    hc.hdr = hdr
+                    hc._store = store
+                else:
+                    self._update_channel(rec, hdr)
+                    hc = c.half_channels[direction]
+                halfchannels.add(hc)
+            elif rectype == node_announcement.number:
+                flen, = _U16.unpack_from(rec, 2 + _NA_FLEN)
+                npos = 2 + _NA_FEATURES + flen
+                timestamp, = struct.unpack_from('>I', rec, npos)
+                node_id = GossmapNodeId(bytes(rec[npos + 4:npos + 4 + 33]))
+                node = self.nodes.get(node_id)
+                if node is None:
+                    continue
+                if node.announced and node.timestamp == timestamp:
+                    node.hdr = hdr
+                    node._store = store
+                else:
+                    self._add_node_announcement(rec, hdr)
+                nodes.add(node_id)
+
+        # Whatever is not in the new store was deleted meanwhile.
+        changes = self._changes
+        for c in list(self.channels.values()):
+            if c.scid not in channels:
+                self._del_channel(c.scid)
+                continue
+            for hc in c.half_channels:
+                if hc is not None and hc not in halfchannels:
+                    c.half_channels[hc.direction] = None
+                    if changes is not None:
+                        changes._update_channel(c.scid)
+        for n in self.nodes.values():
+            if n.announced and n.node_id not in nodes:
+                n._unannounce()
+                if changes is not None:
+                    changes._update_node(n.node_id)
+
+    def _remove_channel_by_deletemsg(self, rec: memoryview):
         scidint, = struct.unpack(">Q", rec[2:])
         scid = ShortChannelId.from_int(scidint)
         # It might have already been deleted when we skipped it.
         if scid in self.channels:
             self._del_channel(scid)
 
-    def _pull_bytes(self, length: int) -> bool:
-        """Pull bytes from file into our internal buffer"""
-        if len(self.store_buf) < length:
-            self.store_buf += self.store_file.read(length - len(self.store_buf))
-        self.bytes_read += len(self.store_buf)
-        return len(self.store_buf) >= length
-
-    def _read_record(self) -> Optional[bytes]:
-        """If a whole record is not in the file, returns None.
-        If deleted, returns empty."""
-        off = self.bytes_read + 1
-        if not self._pull_bytes(12):
-            return None, None
-        hdr = GossipStoreMsgHeader(self.store_buf[:12], off)
-        if not self._pull_bytes(12 + hdr.length):
-            return None, hdr
-        rec = self.store_buf[12:]
-        self.store_buf = bytes()
-        return rec, hdr
-
-    def refresh(self):
-        """Catch up with any changes to the gossip store"""
+    def refresh(self) -> GossmapChanges:
+        """Catch up with any changes to the gossip store.
+
+        This reads the records appended since the last refresh, and
+        follows the store if it was rewritten. Like common/gossmap.c we
+        only look at what was appended: gossipd appends a replacement
+        or a delete record for whatever it marks deleted. Records only
+        marked in place (zombies) are dropped on the next rewrite, when
+        `reopen_store` walks the whole new store. Returns what changed.
+        """
+        changes = GossmapChanges()
+        self._changes = changes
+        try:
+            self._catchup()
+        finally:
+            self._changes = None
+        if changes:
+            self._columns = None
+        return changes
+
+    def _catchup(self) -> None:
         start_time = time.time()
         while True:
-            rec, hdr = self._read_record()
-            if rec is None:  # EOF
+            size = self._store.remap()
+            buf = self._store.buf
+            view = memoryview(buf)
+            try:
+                ended = self._process_records(buf, view, size)
+            finally:
+                # Don't keep the map from being replaced by the next one.
+                view.release()
+            if ended is None:
                 break
-            if hdr.deleted:  # Skip deleted records
-                continue
-            if hdr.zombie:
+            self.reopen_store(ended)
+        self.processing_time += time.time() - start_time
+
+    def columns(self, use_numpy: Optional[bool] = None) -> 'GossmapColumns':
+        """A `GossmapColumns` view of the current map.
+
+        It is built on first use and kept until `refresh` finds new
+        records. `use_numpy` defaults to whether NumPy is installed.
+        """
+        from .gossmapcolumns import GossmapColumns
+        cols = self._columns
+        if cols is None or (use_numpy is not None and cols.use_numpy != use_numpy):
+            cols = GossmapColumns(self, use_numpy)
+            self._columns = cols
+        return cols
+
+    def _process_records(self, buf: Union[mmap.mmap, bytes], view: memoryview,
+                         size: int) -> Optional[int]:
+        """Process the records up to `size`.
+
+        Returns the equivalent offset in the new store if this one ended.
+        """
+        unpack_hdr = GOSSIP_STORE_HDR.unpack_from
+        unpack_type = _RECTYPE.unpack_from
+        skip = GOSSIP_STORE_LEN_DELETED_BIT | GOSSIP_STORE_ZOMBIE_BIT
+        while self.bytes_read + GOSSIP_STORE_HDR_LEN <= size:
+            pos = self.bytes_read
+            flags, length, _, _ = unpack_hdr(buf, pos)
+            off = pos + GOSSIP_STORE_HDR_LEN
+            end = off + length
+            if end > size:
+                # Not completely written yet.
+                break
+            self.bytes_read = end
+            if flags & skip:  # Skip deleted and zombie records
+                # Including the amount of a skipped channel_announcement.
+                self._last_scid = None
                 continue
 
-            rectype, = struct.unpack(">H", rec[:2])
+            rectype, = unpack_type(buf, off)
+            hdr = GossipStoreMsgHeader(buf, off, pos)
+            rec = view[off:end]
             if rectype == channel_announcement.number:
                 self._add_channel(rec, False, hdr)
             elif rectype == WIRE_GOSSIP_STORE_PRIVATE_CHANNEL:
                 hdr.off += 2 + 8 + 2
+                hdr.length -= 2 + 8 + 2
                 self._add_channel(rec[2 + 8 + 2:], True, hdr)
             elif rectype == WIRE_GOSSIP_STORE_CHANNEL_AMOUNT:
                 self._set_channel_amount(rec)
@@ -639,13 +1125,15 @@ class Gossmap(object):
                 self._update_channel(rec, hdr)
             elif rectype == WIRE_GOSSIP_STORE_PRIVATE_UPDATE:
                 hdr.off += 2 + 2
+                hdr.length -= 2 + 2
                 self._update_channel(rec[2 + 2:], hdr)
             elif rectype == WIRE_GOSSIP_STORE_DELETE_CHAN:
                 self._remove_channel_by_deletemsg(rec)
             elif rectype == node_announcement.number:
                 self._add_node_announcement(rec, hdr)
             elif rectype == WIRE_GOSSIP_STORE_ENDED:
-                self.reopen_store()
+                equivalent_offset, = _U64.unpack_from(rec, 2)
+                return equivalent_offset
             else:
                 continue
-        self.processing_time += time.time() - start_time
+        return None
@@ -0,0 +1,234 @@
+"""Columnar view of a `Gossmap`, for analytics and pathfinding.
+
+Nodes, channels and half channels get dense integer indices, and their
+attributes are laid out as one array per attribute. If NumPy is
+installed these are NumPy arrays (without copying), which allows
+vectorized operations over the whole graph. Otherwise they are stdlib
+`array.array`s, which are still much more compact than the objects.
+
+```python
+cols = gossmap.columns()
+cheap = cols.select(cols.halfchannels,
+                    cols.compare(cols.fee_proportional_millionths, operator.le, 10))
+```
+"""
+from .gossmap import Gossmap, GossmapChannel, GossmapHalfchannel, GossmapNode, GossmapNodeId
+from array import array
+from pyln.proto import ShortChannelId
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Feature bits beyond these are not in the `*_features` columns.
+FEATURE_BITS = 64
+_FEATURE_MASK = (1 << FEATURE_BITS) - 1
+
+# The comparisons NumPy applies elementwise to a whole column.
+_VECTOR_OPS = (operator.lt, operator.le, operator.eq,
+               operator.ne, operator.ge, operator.gt)
+
+
+class GossmapColumns(object):
+    """A snapshot of a `Gossmap` as arrays.
+
+    Nodes are indexed in `nodes` order, channels in `channels` order.
+    Half channels are indexed by `direction * len(channels) + channel`,
+    so all direction 0 half channels come first; `halfchannels` has
+    None for those we have no channel_update for.
+
+    Per node: `node_announced`, `node_features`, `node_channel_count`,
+    `node_ratelimit`.
+
+    Per channel: `node1`, `node2` (node indices), `capacity_sat` and
+    `has_capacity`, `channel_features`.
+
+    Per half channel: `present`, `channel` (channel index, so its
+    capacity is `capacity_sat[channel]`), `source`, `destination`,
+    `fee_base_msat`, `fee_proportional_millionths`,
+    `cltv_expiry_delta`, `htlc_minimum_msat`, `htlc_maximum_msat` (0
+    if unknown), `disabled`, `ratelimit`.
+
+    The outgoing half channels of node `n` are
+    `indices[indptr[n]:indptr[n + 1]]` (a CSR adjacency).
+
+    Feature columns only hold the first `FEATURE_BITS` bits.
+    """
+
+    def __init__(self, g: Gossmap, use_numpy: Optional[bool] = None):
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ImportError("numpy is not installed")
+        self.use_numpy = use_numpy
+
+        self.nodes: List[GossmapNode] = list(g.nodes.values())
+        self.node_ids: List[GossmapNodeId] = [n.node_id for n in self.nodes]
+        self.node_index: Dict[GossmapNodeId, int] = {
+            nid: i for i, nid in enumerate(self.node_ids)
+        }
+        self.channels: List[GossmapChannel] = list(g.channels.values())
+        self.scids: List[ShortChannelId] = [c.scid for c in self.channels]
+        self.channel_index: Dict[ShortChannelId, int] = {
+            scid: i for i, scid in enumerate(self.scids)
+        }
+
+        node_announced = array('B')
+        node_features = array('Q')
+        node_channel_count = array('I')
+        node_ratelimit = array('B')
+        for n in self.nodes:
+            node_announced.append(n.announced)
+            node_features.append(n.features & _FEATURE_MASK if n.announced else 0)
+            node_channel_count.append(len(n.channels))
+            node_ratelimit.append(n.hdr is not None and n.hdr.ratelimit)
+
+        index = self.node_index
+        node1 = array('i')
+        node2 = array('i')
+        capacity_sat = array('Q')
+        has_capacity = array('B')
+        channel_features = array('Q')
+        for c in self.channels:
+            node1.append(index[c.node1.node_id])
+            node2.append(index[c.node2.node_id])
+            capacity_sat.append(c.satoshis or 0)
+            has_capacity.append(c.satoshis is not None)
+            channel_features.append(c.features & _FEATURE_MASK)
+
+        self.halfchannels: List[Optional[GossmapHalfchannel]] = (
+            [c.half_channels[0] for c in self.channels]
+            + [c.half_channels[1] for c in self.channels]
+        )
+        num_channels = len(self.channels)
+        present = array('B')
+        channel = array('i', list(range(num_channels)) * 2)
+        source = array('i')
+        destination = array('i')
+        fee_base_msat = array('I')
+        fee_proportional_millionths = array('I')
+        cltv_expiry_delta = array('H')
+        htlc_minimum_msat = array('Q')
+        htlc_maximum_msat = array('Q')
+        disabled = array('B')
+        ratelimit = array('B')
+        for i, hc in enumerate(self.halfchannels):
+            c = i % num_channels
+            if i < num_channels:
+                source.append(node1[c])
+                destination.append(node2[c])
+            else:
+                source.append(node2[c])
+                destination.append(node1[c])
+            if hc is None:
+                present.append(0)
+                fee_base_msat.append(0)
+                fee_proportional_millionths.append(0)
+                cltv_expiry_delta.append(0)
+                htlc_minimum_msat.append(0)
+                htlc_maximum_msat.append(0)
+                disabled.append(0)
+                ratelimit.append(0)
+                continue
+            present.append(1)
+            fee_base_msat.append(hc.fee_base_msat)
+            fee_proportional_millionths.append(hc.fee_proportional_millionths)
+            cltv_expiry_delta.append(hc.cltv_expiry_delta)
+            htlc_minimum_msat.append(hc.htlc_minimum_msat)
+            htlc_maximum_msat.append(hc.htlc_maximum_msat or 0)
+            disabled.append(hc.disabled)
+            ratelimit.append(hc.hdr.ratelimit)
+
+        # Outgoing half channels by source node, a counting sort.
+        indptr = array('q', bytes(8 * (len(self.nodes) + 1)))
+        for i, p in enumerate(present):
+            if p:
+                indptr[source[i] + 1] += 1
+        for n in range(len(self.nodes)):
+            indptr[n + 1] += indptr[n]
+        indices = array('q', bytes(8 * indptr[-1]))
+        fill = indptr[:-1]
+        for i, p in enumerate(present):
+            if p:
+                indices[fill[source[i]]] = i
+                fill[source[i]] += 1
+
+        self.node_announced = self._column(node_announced, bool)
+        self.node_features = self._column(node_features)
+        self.node_channel_count = self._column(node_channel_count)
+        self.node_ratelimit = self._column(node_ratelimit, bool)
+        self.node1 = self._column(node1)
+        self.node2 = self._column(node2)
+        self.capacity_sat = self._column(capacity_sat)
+        self.has_capacity = self._column(has_capacity, bool)
+        self.channel_features = self._column(channel_features)
+        self.present = self._column(present, bool)
+        self.channel = self._column(channel)
+        self.source = self._column(source)
+        self.destination = self._column(destination)
+        self.fee_base_msat = self._column(fee_base_msat)
+        self.fee_proportional_millionths = self._column(fee_proportional_millionths)
+        self.cltv_expiry_delta = self._column(cltv_expiry_delta)
+        self.htlc_minimum_msat = self._column(htlc_minimum_msat)
+        self.htlc_maximum_msat = self._column(htlc_maximum_msat)
+        self.disabled = self._column(disabled, bool)
+        self.ratelimit = self._column(ratelimit, bool)
+        self.indptr = self._column(indptr)
+        self.indices = self._column(indices)
+
+    def _column(self, a: array, dtype: Any = None) -> Any:
+        if not self.use_numpy:
+            return a
+        col = numpy.frombuffer(a, dtype=a.typecode)
+        return col.view(bool) if dtype is bool else col
+
+    # Helpers working on either kind of column. Masks are boolean
+    # arrays with NumPy, lists of bools otherwise.
+    def compare(self, col: Sequence[int], op: Callable[[Any, Any], Any], value: Any) -> Any:
+        """Mask of `op(x, value)` for each `x` of `col`
+
+        Only the `operator` comparisons are applied to the whole column
+        at once, any other `op` is called for each element.
+        """
+        if self.use_numpy and op in _VECTOR_OPS:
+            return numpy.asarray(op(col, value), dtype=bool)
+        # As plain ints, the way `op` would see them on the objects.
+        return [bool(op(x, value)) for x in self.values(col)]
+
+    def any_bits(self, col: Sequence[int], bits: int) -> Any:
+        """Mask of the elements of `col` with any of `bits` set"""
+        if self.use_numpy:
+            return (col & numpy.uint64(bits)) != 0
+        return [x & bits != 0 for x in col]
+
+    def all_of(self, *masks: Any) -> Any:
+        if self.use_numpy:
+            return numpy.logical_and.reduce(masks)
+        return [all(ms) for ms in zip(*masks)]
+
+    def negate(self, mask: Any) -> Any:
+        if self.use_numpy:
+            return ~numpy.asarray(mask, dtype=bool)
+        return [not m for m in mask]
+
+    def select(self, objs: Sequence[Any], mask: Any) -> List[Any]:
+        """The elements of `objs` for which `mask` is set, in order"""
+        if self.use_numpy:
+            return [objs[i] for i in numpy.flatnonzero(mask)]
+        return [o for o, m in zip(objs, mask) if m]
+
+    def values(self, col: Sequence[int], mask: Any = None) -> List[int]:
+        """The elements of `col` (for which `mask` is set) as a list"""
+        if self.use_numpy:
+            return (col if mask is None else col[mask]).tolist()
+        if mask is None:
+            return col.tolist()  # type: ignore[attr-defined]
+        return [x for x, m in zip(col, mask) if m]
+
+    def outgoing(self, node: int) -> Sequence[int]:
+        """Indices of the half channels going out of node index `node`"""
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
@@ -1,14 +1,35 @@
 from pyln.client import Gossmap, GossmapChannel, GossmapNode, GossmapHalfchannel, LnFeatureBits
-from typing import Iterable, List, Optional, Callable
+from .gossmapcolumns import FEATURE_BITS, GossmapColumns, numpy
+from typing import Any, Iterable, List, Optional, Callable
 
 import operator
 import statistics
 
 
 class GossmapStats(object):
+    """Filters and statistics over a `Gossmap`.
+
+    When called without an explicit `nodes` or `channels` argument, the
+    predefined filters and quantiles work on the `Gossmap.columns()`
+    view of the whole map if NumPy is installed, or if that view was
+    already built.
+    """
     def __init__(self, g: Gossmap):
         self.g = g
 
+    def _columns(self, objs: Optional[Iterable[Any]]) -> Optional[GossmapColumns]:
+        if objs is not None:
+            return None
+        # Without NumPy, building the columns costs more than looping
+        # over the objects once: only use them if they are already there.
+        if numpy is None:
+            return self.g._columns
+        return self.g.columns()
+
+    def _features(self, bit: int, objs: Optional[Iterable[Any]]) -> Optional[GossmapColumns]:
+        # Only the low bits are in the columns.
+        return self._columns(objs) if bit + 1 < FEATURE_BITS else None
+
     # First the generic filter functions
     def filter_nodes(self, predicate: Callable[[GossmapNode], bool], nodes: Optional[Iterable[GossmapNode]] = None) -> List[GossmapNode]:
         """ Filter nodes using an arbitrary function or lamda predicate. """
@@ -33,23 +54,38 @@ class GossmapStats(object):
     # Now a bunch of predefined specific filter methods
     def filter_nodes_ratelimited(self, nodes: Optional[Iterable[GossmapNode]] = None) -> List[GossmapNode]:
         """ Filters nodes being marked by cln as ratelimited, when they send out too many updates. """
+        cols = self._columns(nodes)
+        if cols is not None:
+            return cols.select(cols.nodes, cols.node_ratelimit)
         return self.filter_nodes(lambda n: n.hdr is not None and n.hdr.ratelimit, nodes)
 
     def filter_nodes_unannounced(self, nodes: Optional[Iterable[GossmapNode]] = None) -> List[GossmapNode]:
         """ Filters nodes that are only known by a channel, i.e. missing a node_announcement.
             Usually happens when a peer has been offline for a while. """
+        cols = self._columns(nodes)
+        if cols is not None:
+            return cols.select(cols.nodes, cols.negate(cols.node_announced))
         return self.filter_nodes(lambda n: not n.announced, nodes)
 
     def filter_nodes_feature(self, bit, nodes: Optional[Iterable[GossmapNode]] = None) -> List[GossmapNode]:
         """Filters nodes based on node_announcement feature bits. """
+        cols = self._features(bit, nodes)
+        if cols is not None:
+            return cols.select(cols.nodes, cols.any_bits(cols.node_features, 3 << bit))
         return self.filter_nodes(lambda n: n.announced and 3 << bit & n.features != 0, nodes)
 
     def filter_nodes_feature_compulsory(self, bit, nodes: Optional[Iterable[GossmapNode]] = None) -> List[GossmapNode]:
         """Filters nodes based on node_announcement feature bits. """
+        cols = self._features(bit, nodes)
+        if cols is not None:
+            return cols.select(cols.nodes, cols.any_bits(cols.node_features, 1 << bit))
         return self.filter_nodes(lambda n: n.announced and 1 << bit & n.features != 0, nodes)
 
     def filter_nodes_feature_optional(self, bit, nodes: Optional[Iterable[GossmapNode]] = None) -> List[GossmapNode]:
         """Filters nodes based on node_announcement feature bits. """
+        cols = self._features(bit, nodes)
+        if cols is not None:
+            return cols.select(cols.nodes, cols.any_bits(cols.node_features, 2 << bit))
         return self.filter_nodes(lambda n: n.announced and 2 << bit & n.features != 0, nodes)
 
     def filter_nodes_address_type(self, typestr, nodes: Optional[Iterable[GossmapNode]] = None) -> List[GossmapNode]:
@@ -70,26 +106,46 @@ class GossmapStats(object):
 
     def filter_nodes_channel_count(self, count, op=operator.ge, nodes: Optional[Iterable[GossmapNode]] = None) -> List[GossmapNode]:
         """ Filters nodes by its channel count (default op: being greater or eaqual). """
+        cols = self._columns(nodes)
+        if cols is not None:
+            return cols.select(cols.nodes, cols.compare(cols.node_channel_count, op, count))
         return self.filter_nodes(lambda n: op(len(n.channels), count), nodes)
 
     def filter_channels_feature(self, bit, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
         """ Filters channels based on channel_announcement feature bits. """
+        cols = self._features(bit, channels)
+        if cols is not None:
+            return cols.select(cols.channels, cols.any_bits(cols.channel_features, 3 << bit))
         return self.filter_channels(lambda c: 3 << bit & c.features != 0, channels)
 
     def filter_channels_feature_compulsory(self, bit, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
         """ Filters channels based on channel_announcement feature bits. """
+        cols = self._features(bit, channels)
+        if cols is not None:
+            return cols.select(cols.channels, cols.any_bits(cols.channel_features, 1 << bit))
         return self.filter_channels(lambda c: 1 << bit & c.features != 0, channels)
 
     def filter_channels_feature_optional(self, bit, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
         """ Filters channels based on channel_announcement feature bits. """
+        cols = self._features(bit, channels)
+        if cols is not None:
+            return cols.select(cols.channels, cols.any_bits(cols.channel_features, 2 << bit))
         return self.filter_channels(lambda c: 2 << bit & c.features != 0, channels)
 
     def filter_channels_unidirectional(self, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
         """ Filters channels that are known only in one direction, i.e. other peer seems offline for a long time. """
+        cols = self._columns(channels)
+        if cols is not None:
+            n = len(cols.channels)
+            both = cols.all_of(cols.present[:n], cols.present[n:])
+            return cols.select(cols.channels, cols.negate(both))
         return self.filter_channels(lambda c: c.half_channels[0] is None or c.half_channels[1] is None, channels)
 
     def filter_channels_nosatoshis(self, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
         """ Filters channels with missing WIRE_GOSSIP_STORE_CHANNEL_AMOUNT. This should not happen. """
+        cols = self._columns(channels)
+        if cols is not None:
+            return cols.select(cols.channels, cols.negate(cols.has_capacity))
         return self.filter_channels(lambda c: c.satoshis is None, channels)
 
     def filter_channels_tor_only(self, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
@@ -98,14 +154,28 @@ class GossmapStats(object):
 
     def filter_channels_capacity(self, satoshis, op=operator.ge, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
         """ Filter channels by its capacity (default op: being greater or equal). """
+        cols = self._columns(channels)
+        if cols is not None:
+            return cols.select(cols.channels, cols.all_of(cols.has_capacity, cols.compare(cols.capacity_sat, op, satoshis)))
         return self.filter_channels(lambda c: c.satoshis is not None and op(c.satoshis, satoshis), channels)
 
     def filter_channels_disabled_bidirectional(self, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
         """ Filters channels that are disabled in both directions. """
+        cols = self._columns(channels)
+        if cols is not None:
+            # disabled is never set for missing half-channels.
+            n = len(cols.channels)
+            return cols.select(cols.channels, cols.all_of(cols.disabled[:n], cols.disabled[n:]))
         return self.filter_channels(lambda c: c.half_channels[0] is not None and c.half_channels[0].disabled and c.half_channels[1] is not None and c.half_channels[1].disabled, channels)
 
     def filter_channels_disabled_unidirectional(self, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapChannel]:
         """ Filters channels that are disabled only in one direction. """
+        cols = self._columns(channels)
+        if cols is not None:
+            n = len(cols.channels)
+            d0, d1 = cols.disabled[:n], cols.disabled[n:]
+            return (cols.select(cols.channels, cols.all_of(d0, cols.negate(d1)))
+                    + cols.select(cols.channels, cols.all_of(d1, cols.negate(d0))))
         if channels is None:
             channels = self.g.channels.values()
         hc0 = [c for c in channels if c.half_channels[0] is not None and c.half_channels[0].disabled and (c.half_channels[1] is None or not c.half_channels[1].disabled)]
@@ -114,31 +184,52 @@ class GossmapStats(object):
 
     def filter_halfchannels_fee_base(self, msat, op=operator.le, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapHalfchannel]:
         """ Filters half-channels by its base fee (default op: being lower or equal). """
+        cols = self._columns(channels)
+        if cols is not None:
+            return cols.select(cols.halfchannels, cols.all_of(cols.present, cols.compare(cols.fee_base_msat, op, msat)))
         return self.filter_halfchannels(lambda hc: op(hc.fee_base_msat, msat), channels)
 
     def filter_halfchannels_fee_ppm(self, msat, op=operator.le, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapHalfchannel]:
         """ Filters half-channels by its ppm fee (default op: being lower or equal). """
+        cols = self._columns(channels)
+        if cols is not None:
+            return cols.select(cols.halfchannels, cols.all_of(cols.present, cols.compare(cols.fee_proportional_millionths, op, msat)))
         return self.filter_halfchannels(lambda hc: op(hc.fee_proportional_millionths, msat), channels)
 
     def filter_halfchannels_disabled(self, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapHalfchannel]:
         """ Filters half-channels that are disabled. """
+        cols = self._columns(channels)
+        if cols is not None:
+            return cols.select(cols.halfchannels, cols.disabled)
         return self.filter_halfchannels(lambda hc: hc.disabled, channels)
 
     def filter_halfchannels_ratelimited(self, channels: Optional[Iterable[GossmapChannel]] = None) -> List[GossmapHalfchannel]:
         """ Filters half-channels that are being marked as ratelimited for sending out too many updates. """
+        cols = self._columns(channels)
+        if cols is not None:
+            return cols.select(cols.halfchannels, cols.ratelimit)
         return self.filter_halfchannels(lambda hc: hc.hdr.ratelimit, channels)
 
     def quantiles_nodes_channel_count(self, tiles=100, nodes: Optional[Iterable[GossmapNode]] = None) -> List[float]:
+        cols = self._columns(nodes)
+        if cols is not None:
+            return statistics.quantiles(cols.values(cols.node_channel_count), n=tiles)
         if nodes is None:
             nodes = self.g.nodes.values()
         return statistics.quantiles([len(n.channels) for n in nodes], n=tiles)
 
     def quantiles_channels_capacity(self, tiles=100, channels: Optional[Iterable[GossmapChannel]] = None) -> List[float]:
+        cols = self._columns(channels)
+        if cols is not None:
+            return statistics.quantiles(cols.values(cols.capacity_sat, cols.has_capacity), n=tiles)
         if channels is None:
             channels = self.g.channels.values()
         return statistics.quantiles([c.satoshis for c in channels if c.satoshis is not None], n=tiles)
 
     def quantiles_halfchannels_fee_base(self, tiles=100, channels: Optional[Iterable[GossmapChannel]] = None) -> List[float]:
+        cols = self._columns(channels)
+        if cols is not None:
+            return statistics.quantiles(cols.values(cols.fee_base_msat, cols.present), n=tiles)
         if channels is None:
             channels = self.g.channels.values()
         hc0 = [c.half_channels[0].fee_base_msat for c in channels if c.half_channels[0] is not None]
@@ -146,6 +237,9 @@ class GossmapStats(object):
         return statistics.quantiles(hc0 + hc1, n=tiles)
 
     def quantiles_halfchannels_fee_ppm(self, tiles=100, channels: Optional[Iterable[GossmapChannel]] = None) -> List[float]:
+        cols = self._columns(channels)
+        if cols is not None:
+            return statistics.quantiles(cols.values(cols.fee_proportional_millionths, cols.present), n=tiles)
         if channels is None:
             channels = self.g.channels.values()
         hc0 = [c.half_channels[0].fee_proportional_millionths for c in channels if c.half_channels[0] is not None]
@@ -0,0 +1,183 @@
+"""JSON encoding and decoding for the RPC clients and plugins.
+
+The stdlib `json` module is always available, and is the reference
+behaviour. If `orjson` is installed it is used instead whenever it can
+produce the same results, which makes (de)serializing large payloads
+several times cheaper.
+"""
+from typing import Any, Optional
+
+import json
+import math
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class LightningJSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        try:
+            return o.to_json()
+        except AttributeError:
+            pass
+        return json.JSONEncoder.default(self, o)
+
+
+class JsonCodec(object):
+    """Stdlib based codec.
+
+    `dumps` returns UTF-8 encoded bytes (we never escape non-ASCII
+    characters), `loads` accepts any bytes-like object.
+    """
+    name = 'json'
+
+    def __init__(self, encoder_cls=LightningJSONEncoder,
+                 decoder: Optional[json.JSONDecoder] = None):
+        self.encoder_cls = encoder_cls
+        self.decoder = decoder if decoder is not None else json.JSONDecoder()
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False,
+                          cls=self.encoder_cls).encode('UTF-8')
+
+    def loads(self, data) -> Any:
+        if not isinstance(data, str):
+            data = str(data, 'UTF-8')
+        obj, _ = self.decoder.raw_decode(data.lstrip())
+        return obj
+
+
+def _to_json(o):
+    to_json = getattr(o, 'to_json', None)
+    if to_json is None:
+        raise TypeError("Object of type {} is not JSON serializable".format(
+            type(o).__name__))
+    return to_json()
+
+
+# orjson turns integers outside the [-2^63, 2^64) range into floats,
+# losing precision: leave anything containing one to the stdlib.
+# Scanning for those with a regex costs more than orjson saves, so we
+# first map number characters to '0' and separators to 's' (a fast
+# bytes.translate), and only look closer at long digit runs following
+# a separator, i.e. at numbers rather than at digits in strings.
+_NUMBER_CHARS = bytes(
+    ord('0') if chr(c) in '-0123456789'
+    else ord('s') if chr(c) in ':,[ \t\r\n'
+    else ord('x')
+    for c in range(256)
+)
+_LONG_NUMBER = b's' + b'0' * 19
+_NUMBER_RUN = re.compile(b'0+')
+
+
+def _has_bigint(data) -> bool:
+    marked = bytes(data).translate(_NUMBER_CHARS)
+    pos = marked.find(_LONG_NUMBER)
+    while pos >= 0:
+        start = pos + 1
+        end = _NUMBER_RUN.match(marked, start).end()
+        try:
+            if not -2**63 <= int(bytes(data[start:end])) < 2**64:
+                return True
+        except ValueError:
+            # Not a number after all: the stdlib will tell.
+            return True
+        pos = marked.find(_LONG_NUMBER, end)
+    return False
+
+
+def _has_nonfinite(obj) -> bool:
+    """Does `obj` contain a NaN or infinite float?"""
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_nonfinite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_nonfinite(v) for v in obj)
+    return False
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson based codec, producing the same results as `JsonCodec`.
+
+    Whatever orjson cannot handle identically (decoders with hooks,
+    integers beyond 64 bits, NaN, objects without `to_json`, ...) is
+    passed on to the stdlib.
+    """
+    name = 'orjson'
+
+    def __init__(self, encoder_cls=LightningJSONEncoder,
+                 decoder: Optional[json.JSONDecoder] = None):
+        super().__init__(encoder_cls, decoder)
+        if self.encoder_cls is LightningJSONEncoder:
+            self.default = _to_json
+        else:
+            self.default = None
+        self.hooked = (self.decoder.object_hook is not None
+                       or self.decoder.object_pairs_hook is not None)
+
+    def dumps(self, obj: Any) -> bytes:
+        try:
+            s = orjson.dumps(obj, default=self.default,
+                             option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return super().dumps(obj)
+        # orjson writes NaN and infinities as null, the stdlib as NaN
+        # and Infinity: only look for them if there is a null.
+        if b'null' in s and _has_nonfinite(obj):
+            return super().dumps(obj)
+        return s
+
+    def loads(self, data) -> Any:
+        # The stdlib calls the decoder's hooks while parsing, which is
+        # cheaper than walking orjson's result to apply them.
+        if self.hooked or isinstance(data, str) or _has_bigint(data):
+            return super().loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Let the stdlib either accept it or raise its own error.
+            return super().loads(data)
+
+
+def _orjson_compatible(encoder_cls, decoder: Optional[json.JSONDecoder]) -> bool:
+    """Can `OrjsonCodec` behave exactly like `JsonCodec` would?"""
+    if encoder_cls not in (json.JSONEncoder, LightningJSONEncoder):
+        return False
+    if decoder is None:
+        return True
+    # Hooks are fine (we let the stdlib handle those), anything else
+    # changing how values are parsed isn't.
+    return (type(decoder).raw_decode is json.JSONDecoder.raw_decode
+            and decoder.parse_float is float
+            and decoder.parse_int is int
+            and decoder.strict)
+
+
+def get_codec(backend: Optional[str] = None,
+              encoder_cls=LightningJSONEncoder,
+              decoder: Optional[json.JSONDecoder] = None) -> JsonCodec:
+    """Return the codec for `backend` ('json' or 'orjson').
+
+    By default (`backend=None`) this is orjson if it is installed and
+    can handle `encoder_cls` and `decoder`, and the stdlib otherwise.
+    """
+    if backend is None:
+        if orjson is not None and _orjson_compatible(encoder_cls, decoder):
+            backend = 'orjson'
+        else:
+            backend = 'json'
+
+    if backend == 'json':
+        return JsonCodec(encoder_cls, decoder)
+    elif backend == 'orjson':
+        if orjson is None:
+            raise ImportError("JSON backend 'orjson' is not installed")
+        if not _orjson_compatible(encoder_cls, decoder):
+            raise ValueError("JSON backend 'orjson' does not support this encoder or decoder")
+        return OrjsonCodec(encoder_cls, decoder)
+    raise ValueError("Unknown JSON backend {}".format(backend))
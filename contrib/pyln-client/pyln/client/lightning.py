@@ -1,13 +1,19 @@
 import json
 import logging
 import os
+import select
 import socket
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from decimal import Decimal
 from json import JSONEncoder
+from .jsoncodec import JsonCodec, LightningJSONEncoder, get_codec
 from math import floor, log10
-from typing import Optional, Union
+from .metrics import RpcCallStats
+from typing import Any, List, Optional, Union
 
 
 def _patched_default(self, obj):
@@ -44,10 +50,22 @@ class Millisatoshi:
     Many JSON API fields are expressed in millisatoshis: these automatically
     get turned into Millisatoshi types. Converts to and from int.
     """
+    __slots__ = ('millisatoshis',)
+
     def __init__(self, v: Union[int, str, Decimal]):
         """
         Takes either a string ending in 'msat', 'sat', 'btc' or an integer.
         """
+        # Fast paths for what we get from JSON: ints and "<n>msat".
+        if type(v) is int:
+            if v < 0:
+                raise ValueError("Millisatoshi must be >= 0")
+            self.millisatoshis = v
+            return
+        if type(v) is str and v.endswith("msat") and v[:-4].isascii() and v[:-4].isdigit():
+            self.millisatoshis = int(v[:-4])
+            return
+
         if isinstance(v, str):
             if v.endswith("msat"):
                 parsed = Decimal(v[0:-4])
@@ -191,10 +209,10 @@ class Millisatoshi:
         return self.millisatoshis >= other.millisatoshis
 
     def __add__(self, other: 'Millisatoshi') -> 'Millisatoshi':
-        return Millisatoshi(int(self) + int(other))
+        return Millisatoshi(self.millisatoshis + int(other))
 
     def __sub__(self, other: 'Millisatoshi') -> 'Millisatoshi':
-        return Millisatoshi(int(self) - int(other))
+        return Millisatoshi(self.millisatoshis - int(other))
 
     def __mul__(self, other: Union[int, float]) -> 'Millisatoshi':
         if isinstance(other, Millisatoshi):
@@ -215,7 +233,105 @@ class Millisatoshi:
         return Millisatoshi(int(self.millisatoshis % other))
 
     def __radd__(self, other: 'Millisatoshi') -> 'Millisatoshi':
-        return Millisatoshi(int(self) + int(other))
+        return Millisatoshi(self.millisatoshis + int(other))
+
+
+# How much we read from the RPC socket at once: large enough to make
+# huge responses cheap, small enough not to waste memory on small ones.
+RPC_READ_SIZE = 65536
+
+
+def _pop_json(codec: JsonCodec, buff: bytearray, end: int):
+    """Decode the JSON object in `buff[:end]`, and remove it and the
+    empty line terminating it from `buff`.
+
+    We decode straight from a view, to avoid copying (possibly
+    hundreds of MB of) response bytes before decoding them.
+    """
+    with memoryview(buff)[:end] as view:
+        obj = codec.loads(view)
+    del buff[:end + 2]
+    return obj
+
+
+def _msat_value(v):
+    """Convert the value of an *msat field to Millisatoshi, unless it is
+    an object (or already converted)."""
+    if isinstance(v, list):
+        return [e if isinstance(e, Millisatoshi) else Millisatoshi(e) for e in v]
+    # FIXME: Deprecated "listconfigs" gives two 'null' fields:
+    #            "lease-fee-base-msat": null,
+    #            "channel-fee-max-base-msat": null,
+    # FIXME: Removed for v23.08, delete this code in 24.08?
+    if v is None or isinstance(v, (dict, Millisatoshi)):
+        return v
+    return Millisatoshi(v)
+
+
+class LazyMsatDict(dict):
+    """A JSON object whose *msat fields turn into Millisatoshi only once
+    they are accessed.
+
+    Used by the 'lazy' `msat_mode`: bulk consumers only pay for the
+    amounts they actually look at. Whichever way the fields are read
+    (including `items()`, `values()`, `copy()`, `dict(d)` or `{**d}`),
+    they are converted first.
+    """
+    __slots__ = ()
+
+    # dict's C code (dict(d), {**d}, update) reads subclasses' values
+    # directly, unless they override __iter__: then it goes through
+    # keys() and __getitem__.
+    def __iter__(self):
+        return dict.__iter__(self)
+
+    def __getitem__(self, k):
+        v = dict.__getitem__(self, k)
+        if type(k) is str and k.endswith('msat'):
+            c = _msat_value(v)
+            if c is not v:
+                dict.__setitem__(self, k, c)
+            return c
+        return v
+
+    def get(self, k, default=None):
+        if k in self:
+            return self[k]
+        return default
+
+    def _convert_all(self):
+        for k in dict.keys(self):
+            self[k]
+
+    def items(self):
+        self._convert_all()
+        return dict.items(self)
+
+    def values(self):
+        self._convert_all()
+        return dict.values(self)
+
+    def copy(self):
+        return LazyMsatDict(self)
+
+    def pop(self, k, *default):
+        if k in self:
+            v = self[k]
+            dict.__delitem__(self, k)
+            return v
+        return dict.pop(self, k, *default)
+
+    def setdefault(self, k, default=None):
+        if k in self:
+            return self[k]
+        dict.__setitem__(self, k, default)
+        return default
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        if type(k) is str and k.endswith('msat'):
+            v = _msat_value(v)
+        return k, v
 
 
 class UnixSocket(object):
@@ -285,11 +401,63 @@ class UnixSocket(object):
         self.close()
 
 
+class RpcConnection(object):
+    """A single connection to the RPC socket.
+
+    Besides the socket itself this tracks the bytes read past the end
+    of the last response, and whether `lightningd` was already asked to
+    send notifications on this connection, since both are
+    per-connection state.
+    """
+
+    def __init__(self, path: str):
+        self.sock = UnixSocket(path)
+        self.buff = bytearray()
+        self.notifications_enabled = False
+
+    def is_stale(self) -> bool:
+        """Check whether the server hung up while we were idle.
+
+        An idle connection should never be readable, unless the other
+        end closed it, in which case a peek returns EOF.
+        """
+        if self.sock.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([self.sock.sock], [], [], 0)
+            if not readable:
+                return False
+            return self.sock.sock.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def close(self) -> None:
+        self.sock.close()
+
+
 class UnixDomainSocketRpc(object):
-    def __init__(self, socket_path, executor=None, logger=logging, encoder_cls=json.JSONEncoder, decoder=json.JSONDecoder(), caller_name=None):
+    def __init__(self, socket_path, executor=None, logger=logging, encoder_cls=json.JSONEncoder, decoder=json.JSONDecoder(), caller_name=None, persistent=False, pool_size=1, json_backend=None, metrics=None):
+        """If `persistent` is set the connection to `socket_path` is kept
+        open and reused across calls, rather than connecting anew for
+        every call. A connection that was closed by the server is
+        replaced transparently.
+
+        Calls made concurrently from multiple threads each use their
+        own connection. In `persistent` mode up to `pool_size` of them
+        are kept open for reuse.
+
+        `json_backend` selects the JSON library, see `get_codec`.
+
+        `metrics` is a sink (such as `RpcMetrics`) whose `record_call`
+        gets an `RpcCallStats` for each call.
+        """
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
         self.socket_path = socket_path
         self.encoder_cls = encoder_cls
         self.decoder = decoder
+        self.codec = get_codec(json_backend, encoder_cls, decoder)
+        self.metrics = metrics
         self.executor = executor
         self.logger = logger
         self._notify = None
@@ -298,28 +466,74 @@ class UnixDomainSocketRpc(object):
             self.caller_name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
         else:
             self.caller_name = caller_name
-        self.cmdprefix = None
+        # cmdprefix is per-thread, see the property below.
+        self._local = threading.local()
 
         self.next_id = 1
-
-    def _writeobj(self, sock, obj):
-        s = json.dumps(obj, ensure_ascii=False, cls=self.encoder_cls)
-        sock.sendall(bytearray(s, 'UTF-8'))
-
-    def _readobj(self, sock, buff=b''):
-        """Read a JSON object, starting with buff; returns object and any buffer left over."""
+        self._id_lock = threading.Lock()
+
+        self.persistent = persistent
+        self.pool_size = pool_size
+        self._idle_conns: List[RpcConnection] = []
+        self._conn_lock = threading.Lock()
+
+    @property
+    def cmdprefix(self) -> Optional[str]:
+        """Prefix for the JSON ids of calls made from the current thread.
+
+        This is thread-local, so that concurrent callers (such as
+        plugin handlers running in different threads) don't clobber
+        each other's prefix.
+        """
+        return getattr(self._local, 'cmdprefix', None)
+
+    @cmdprefix.setter
+    def cmdprefix(self, cmdprefix: Optional[str]) -> None:
+        self._local.cmdprefix = cmdprefix
+
+    def _writeobj(self, sock, obj, stats=None):
+        if stats is None:
+            sock.sendall(self.codec.dumps(obj))
+            return
+        start = time.perf_counter()
+        s = self.codec.dumps(obj)
+        encoded = time.perf_counter()
+        sock.sendall(s)
+        stats.encode_time += encoded - start
+        stats.wait_time += time.perf_counter() - encoded
+        stats.bytes_sent += len(s)
+
+    def _readobj(self, sock, buff=b'', stats=None):
+        """Read a JSON object, starting with buff; returns object and any buffer left over.
+
+        If `stats` is given, the time spent and bytes read are added to it.
+        """
+        if not isinstance(buff, bytearray):
+            buff = bytearray(buff)
+        scanned = 0
         while True:
-            parts = buff.split(b'\n\n', 1)
-            if len(parts) == 1:
-                # Didn't read enough.
-                b = sock.recv(max(1024, len(buff)))
+            end = buff.find(b'\n\n', scanned)
+            if end < 0:
+                # Didn't read enough. Only the new bytes need scanning
+                # next time (but the terminator may straddle reads).
+                scanned = max(0, len(buff) - 1)
+                if stats is not None:
+                    start = time.perf_counter()
+                    b = sock.recv(RPC_READ_SIZE)
+                    stats.wait_time += time.perf_counter() - start
+                else:
+                    b = sock.recv(RPC_READ_SIZE)
                 buff += b
                 if len(b) == 0:
                     return {'error': 'Connection to RPC server lost.'}, buff
-            else:
-                buff = parts[1]
-                obj, _ = self.decoder.raw_decode(parts[0].decode("UTF-8"))
+            elif stats is not None:
+                start = time.perf_counter()
+                obj = _pop_json(self.codec, buff, end)
+                stats.decode_time += time.perf_counter() - start
+                stats.bytes_received += end + 2
                 return obj, buff
+            else:
+                return _pop_json(self.codec, buff, end), buff
 
     def __getattr__(self, name):
         """Intercept any call that is not explicitly defined and call @call.
@@ -352,6 +566,22 @@ class UnixDomainSocketRpc(object):
         before the call is made.
 
         """
+        metrics = self.metrics
+        if metrics is None:
+            return self._call(method, payload, cmdprefix, filter)
+
+        stats = RpcCallStats(method)
+        start = time.perf_counter()
+        try:
+            return self._call(method, payload, cmdprefix, filter, stats)
+        except Exception as e:
+            stats.error = type(e).__name__
+            raise
+        finally:
+            stats.latency = time.perf_counter() - start
+            metrics.record_call(stats)
+
+    def _call(self, method, payload, cmdprefix, filter, stats=None):
         self.logger.debug("Calling %s with payload %r", method, payload)
 
         if payload is None:
@@ -360,26 +590,9 @@ class UnixDomainSocketRpc(object):
         if isinstance(payload, dict):
             payload = {k: v for k, v in payload.items() if v is not None}
 
-        this_id = self.get_json_id(method, cmdprefix)
-        self.next_id += 1
-
-        # FIXME: we open a new socket for every readobj call...
-        sock = UnixSocket(self.socket_path)
-
-        buf = b''
-
-        if self._notify is not None:
-            # Opt into the notifications support
-            self._writeobj(sock, {
-                "jsonrpc": "2.0",
-                "method": "notifications",
-                "id": this_id + "+notify-enable",
-                "params": {
-                    "enable": True
-                },
-            })
-            # FIXME: Notification schema support?
-            _, buf = self._readobj(sock, buf)
+        with self._id_lock:
+            this_id = self.get_json_id(method, cmdprefix)
+            self.next_id += 1
 
         request = {
             "jsonrpc": "2.0",
@@ -393,28 +606,38 @@ class UnixDomainSocketRpc(object):
         if filter is not None:
             request["filter"] = filter
 
-        self._writeobj(sock, request)
-        while True:
-            resp, buf = self._readobj(sock, buf)
-            id = resp.get("id", None)
-            meth = resp.get("method", None)
-
-            if meth == 'message' and self._notify is not None:
-                n = resp['params']
-                self._notify(
-                    message=n.get('message', None),
-                    progress=n.get('progress', None),
-                    request=request
-                )
-                continue
-
-            if meth is None or id is None:
+        with self._connection() as conn:
+            if self._notify is not None and not conn.notifications_enabled:
+                self._enable_notifications(conn, this_id)
+
+            self._writeobj(conn.sock, request, stats)
+            while True:
+                resp, conn.buff = self._readobj(conn.sock, conn.buff, stats)
+                id = resp.get("id", None)
+                meth = resp.get("method", None)
+
+                if meth == 'message' and self._notify is not None:
+                    n = resp['params']
+                    self._notify(
+                        message=n.get('message', None),
+                        progress=n.get('progress', None),
+                        request=request
+                    )
+                    continue
+
+                if meth is not None and id is None:
+                    # A notification we are not interested in: these keep
+                    # coming once they are enabled on a connection.
+                    continue
                 break
 
-        self.logger.debug("Received response for %s call: %r", method, resp)
-        if 'id' in resp and resp['id'] != this_id:
-            raise ValueError("Malformed response, id is not {}: {}.".format(this_id, resp))
-        sock.close()
+            if 'id' not in resp:
+                # We lost the connection, don't try to reuse it.
+                conn.close()
+
+            self.logger.debug("Received response for %s call: %r", method, resp)
+            if 'id' in resp and resp['id'] != this_id:
+                raise ValueError("Malformed response, id is not {}: {}.".format(this_id, resp))
 
         if not isinstance(resp, dict):
             raise ValueError("Malformed response, response is not a dictionary %s." % resp)
@@ -424,6 +647,184 @@ class UnixDomainSocketRpc(object):
             raise ValueError("Malformed response, \"result\" missing.")
         return resp["result"]
 
+    def call_many(self, calls, cmdprefix=None, filter=None):
+        """Issue a batch of calls, pipelined over a single connection.
+
+        `calls` is a sequence of `(method, payload)` tuples. All requests
+        are written back to back, and the responses collected as they
+        come in, so the whole batch costs about one round-trip rather
+        than one per call.
+
+        Returns a list with the result of each call, in the order of
+        `calls`. A call that failed does not abort the batch: its entry
+        is the `RpcError` that `call` would have raised instead.
+        """
+        if filter is None:
+            filter = self._filter
+
+        requests = []
+        payloads = []
+        with self._id_lock:
+            for method, payload in calls:
+                if payload is None:
+                    payload = {}
+                if isinstance(payload, dict):
+                    payload = {k: v for k, v in payload.items() if v is not None}
+                request = {
+                    "jsonrpc": "2.0",
+                    "method": method,
+                    "params": payload,
+                    "id": self.get_json_id(method, cmdprefix),
+                }
+                self.next_id += 1
+                if filter is not None:
+                    request["filter"] = filter
+                requests.append(request)
+                payloads.append(payload)
+
+        self.logger.debug("Calling batch of %d requests", len(requests))
+        if not requests:
+            return []
+
+        index = {r['id']: i for i, r in enumerate(requests)}
+        results: List[Any] = [None] * len(requests)
+        with self._connection() as conn:
+            if self._notify is not None and not conn.notifications_enabled:
+                self._enable_notifications(conn, requests[0]['id'])
+
+            out = bytearray()
+            for request in requests:
+                out += self.codec.dumps(request)
+
+            # lightningd stops reading from a connection until we have
+            # consumed its pending output, so we must keep reading while
+            # we write or we could deadlock on large batches. Writable
+            # only means there is some room in the socket buffer: a
+            # blocking send could still wait for more, so don't block.
+            sock = conn.sock.sock
+            sock.setblocking(False)
+            try:
+                while out:
+                    readable, writable, _ = select.select([sock], [sock], [])
+                    if readable:
+                        try:
+                            b = sock.recv(RPC_READ_SIZE)
+                        except BlockingIOError:
+                            b = None
+                        if b is not None:
+                            if len(b) == 0:
+                                break
+                            conn.buff += b
+                    if writable:
+                        try:
+                            sent = sock.send(out[:65536])
+                        except BlockingIOError:
+                            sent = 0
+                        del out[:sent]
+            finally:
+                sock.setblocking(True)
+
+            remaining = len(requests)
+            while remaining:
+                resp, conn.buff = self._readobj(conn.sock, conn.buff)
+                id = resp.get("id", None)
+                meth = resp.get("method", None)
+
+                if meth is not None and id is None:
+                    n = resp.get('params', {})
+                    if meth == 'message' and self._notify is not None and n.get('id') in index:
+                        self._notify(
+                            message=n.get('message', None),
+                            progress=n.get('progress', None),
+                            request=requests[index[n['id']]]
+                        )
+                    continue
+
+                if id is None:
+                    # We lost the connection: fail whatever is left.
+                    conn.close()
+                    for i, request in enumerate(requests):
+                        if results[i] is None:
+                            results[i] = RpcError(request['method'], payloads[i], resp['error'])
+                    break
+
+                if id not in index:
+                    raise ValueError("Malformed response, unexpected id {}: {}.".format(id, resp))
+                i = index[id]
+                if "error" in resp:
+                    results[i] = RpcError(requests[i]['method'], payloads[i], resp['error'])
+                elif "result" not in resp:
+                    raise ValueError("Malformed response, \"result\" missing.")
+                else:
+                    results[i] = resp["result"]
+                remaining -= 1
+
+        self.logger.debug("Received responses for batch of %d requests", len(requests))
+        return results
+
+    def _enable_notifications(self, conn, this_id):
+        """Opt into the notifications support for this connection"""
+        self._writeobj(conn.sock, {
+            "jsonrpc": "2.0",
+            "method": "notifications",
+            "id": this_id + "+notify-enable",
+            "params": {
+                "enable": True
+            },
+        })
+        # FIXME: Notification schema support?
+        _, conn.buff = self._readobj(conn.sock, conn.buff)
+        conn.notifications_enabled = True
+
+    def _get_connection(self) -> RpcConnection:
+        """Take an idle connection if we have a usable one, or open a new one"""
+        while self.persistent:
+            with self._conn_lock:
+                if not self._idle_conns:
+                    break
+                conn = self._idle_conns.pop()
+            if not conn.is_stale():
+                return conn
+            self.logger.debug("RPC connection closed by server, reconnecting")
+            conn.close()
+        return RpcConnection(self.socket_path)
+
+    def _put_connection(self, conn: RpcConnection) -> None:
+        """Keep the connection around for the next call, if we can"""
+        if self.persistent and conn.sock.sock is not None:
+            with self._conn_lock:
+                if len(self._idle_conns) < self.pool_size:
+                    self._idle_conns.append(conn)
+                    return
+        conn.close()
+
+    @contextmanager
+    def _connection(self):
+        """A connection that is ours for the duration of the context.
+
+        Concurrent (or reentrant) calls each get their own connection,
+        at most `pool_size` of them are kept for reuse. If anything goes
+        wrong we can no longer tell where the next response starts, so
+        the connection is discarded rather than put back.
+        """
+        conn = self._get_connection()
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        self._put_connection(conn)
+
+    def close_connections(self) -> None:
+        """Close the connections kept open by `persistent` mode, if any.
+
+        They get reopened as needed by the next calls.
+        """
+        with self._conn_lock:
+            conns, self._idle_conns = self._idle_conns, []
+        for conn in conns:
+            conn.close()
+
     @contextmanager
     def notify(self, fn):
         """Register a notification callback to use for a set of RPC calls.
@@ -476,25 +877,41 @@ class LightningRpc(UnixDomainSocketRpc):
     keyword argument. If `async` is set to true then the method
     returns a future immediately, instead of blocking indefinitely.
 
-    This implementation is thread safe in that it locks the socket
-    between calls, but it does not (yet) support concurrent calls.
+    This implementation is thread safe, and supports concurrent calls
+    from multiple threads: each in-flight call uses its own connection
+    to `lightningd`. With `persistent=True` connections are kept open
+    and reused, up to `pool_size` of them, and the JSON id prefix
+    (`cmdprefix`) is tracked per thread.
     """
 
-    class LightningJSONEncoder(json.JSONEncoder):
-        def default(self, o):
-            try:
-                return o.to_json()
-            except NameError:
-                pass
-            return json.JSONEncoder.default(self, o)
+    LightningJSONEncoder = LightningJSONEncoder
 
     class LightningJSONDecoder(json.JSONDecoder):
+        """Decoder turning *msat fields into amounts, according to `msat_mode`:
+
+         - 'object' (the default): Millisatoshi instances.
+         - 'int': plain ints, the cheapest for bulk processing.
+         - 'lazy': Millisatoshi instances, but only created when the
+           field is accessed (objects are `LazyMsatDict`).
+        """
         def __init__(self, *, object_hook=None, parse_float=None,
                      parse_int=None, parse_constant=None,
                      strict=True, object_pairs_hook=None,
-                     patch_json=True):
+                     patch_json=True, msat_mode='object'):
             self.object_hook_next = object_hook
-            super().__init__(object_hook=self.millisatoshi_hook, parse_float=parse_float, parse_int=parse_int, parse_constant=parse_constant, strict=strict, object_pairs_hook=object_pairs_hook)
+            self.msat_mode = msat_mode
+            if msat_mode == 'object':
+                hook = self.millisatoshi_hook
+            elif msat_mode == 'int':
+                hook = self.int_hook
+            elif msat_mode == 'lazy':
+                if object_pairs_hook is not None:
+                    raise ValueError("msat_mode 'lazy' cannot be combined with object_pairs_hook")
+                hook = None
+                object_pairs_hook = self.lazy_hook
+            else:
+                raise ValueError("msat_mode must be one of 'object', 'int' or 'lazy'")
+            super().__init__(object_hook=hook, parse_float=parse_float, parse_int=parse_int, parse_constant=parse_constant, strict=strict, object_pairs_hook=object_pairs_hook)
 
         @staticmethod
         def replace_amounts(obj):
@@ -523,24 +940,105 @@ class LightningRpc(UnixDomainSocketRpc):
             return obj
 
         def millisatoshi_hook(self, obj):
-            obj = LightningRpc.LightningJSONDecoder.replace_amounts(obj)
+            # The decoder calls us on every object as soon as it is
+            # decoded, innermost first: nested objects have been taken
+            # care of already, so we only need to look at this one's own
+            # fields, rather than walk all of them again with
+            # replace_amounts.
+            for k, v in obj.items():
+                # Objects ending in msat are not treated specially!
+                if v is not None and k.endswith('msat'):
+                    obj[k] = _msat_value(v)
+            if self.object_hook_next:
+                obj = self.object_hook_next(obj)
+            return obj
+
+        def int_hook(self, obj):
+            # Amounts are ints on the wire already, except for a few
+            # legacy "<n>msat" strings.
+            for k, v in obj.items():
+                if type(v) is str and k.endswith('msat'):
+                    obj[k] = Millisatoshi(v).millisatoshis
+            if self.object_hook_next:
+                obj = self.object_hook_next(obj)
+            return obj
+
+        def lazy_hook(self, pairs):
+            obj = LazyMsatDict(pairs)
             if self.object_hook_next:
                 obj = self.object_hook_next(obj)
             return obj
 
     def __init__(self, socket_path, executor=None, logger=logging,
-                 patch_json=True):
+                 patch_json=False, persistent=False, pool_size=1,
+                 msat_mode='object', json_backend=None, metrics=None):
+        """`msat_mode` selects how amounts in responses are represented,
+        see `LightningJSONDecoder`.
+
+        `patch_json` makes the global `json` module encode objects with
+        a `to_json` method (such as `Millisatoshi`); this client does
+        not need it.
+        """
         super().__init__(
             socket_path,
             executor,
             logger,
             self.LightningJSONEncoder,
-            self.LightningJSONDecoder()
+            self.LightningJSONDecoder(msat_mode=msat_mode),
+            persistent=persistent,
+            pool_size=pool_size,
+            json_backend=json_backend,
+            metrics=metrics,
         )
 
         if patch_json:
             monkey_patch_json(patch=True)
 
+    def _paginate(self, method, key, index, start, page_size, prefetch,
+                  payload):
+        """Generator walking through `method`'s results a page at a time.
+
+        Pages are requested with `index`/`start`/`limit`, the next one
+        starting right after the last entry of the previous one. With
+        `prefetch` the next page is requested in a background thread
+        while the current one is being consumed.
+        """
+        if index not in ('created', 'updated'):
+            raise ValueError("index must be 'created' or 'updated'")
+        if page_size < 1:
+            raise ValueError("page_size must be at least 1")
+        index_key = index + '_index'
+        # cmdprefix is per-thread, so make sure prefetches use ours.
+        cmdprefix = self.cmdprefix
+        filter = self._filter
+
+        def fetch(start):
+            page = dict(payload, index=index, start=start, limit=page_size)
+            return self.call(method, page, cmdprefix=cmdprefix, filter=filter)[key]
+
+        executor = None
+        if prefetch:
+            executor = self.executor or ThreadPoolExecutor(max_workers=1)
+        try:
+            entries = fetch(start)
+            while entries:
+                nextpage = None
+                if len(entries) == page_size:
+                    nextstart = entries[-1][index_key] + 1
+                    if executor is not None:
+                        nextpage = executor.submit(fetch, nextstart)
+                yield from entries
+
+                if len(entries) < page_size:
+                    break
+                if nextpage is not None:
+                    entries = nextpage.result()
+                else:
+                    entries = fetch(nextstart)
+        finally:
+            if executor is not None and executor is not self.executor:
+                executor.shutdown(wait=False)
+
     def addgossip(self, message):
         """
         Inject this (hex-encoded) gossip message.
@@ -1021,6 +1519,25 @@ class LightningRpc(UnixDomainSocketRpc):
         }
         return self.call("listforwards", payload)
 
+    def iter_forwards(self, status=None, in_channel=None, out_channel=None,
+                      index='created', start=None, page_size=1000,
+                      prefetch=False):
+        """Iterate over forwards matching {status}, {in_channel} and
+        {out_channel}, fetching {page_size} of them at a time, in
+        {index} order ('created' or 'updated') from {start}.
+
+        Unlike `listforwards` this runs in constant memory. With
+        {prefetch} the next page is fetched while the current one is
+        being consumed.
+        """
+        payload = {
+            "status": status,
+            "in_channel": in_channel,
+            "out_channel": out_channel,
+        }
+        return self._paginate("listforwards", "forwards", index, start,
+                              page_size, prefetch, payload)
+
     def listfunds(self, spent=None):
         """
         Show funds available for opening channels
@@ -1056,6 +1573,25 @@ class LightningRpc(UnixDomainSocketRpc):
         }
         return self.call("listinvoices", payload)
 
+    def iter_invoices(self, label=None, payment_hash=None, invstring=None,
+                      offer_id=None, index='created', start=None,
+                      page_size=1000, prefetch=False):
+        """Iterate over invoices (see `listinvoices`), fetching
+        {page_size} of them at a time, in {index} order ('created' or
+        'updated') from {start}.
+
+        With {prefetch} the next page is fetched while the current one
+        is being consumed.
+        """
+        payload = {
+            "label": label,
+            "payment_hash": payment_hash,
+            "invstring": invstring,
+            "offer_id": offer_id,
+        }
+        return self._paginate("listinvoices", "invoices", index, start,
+                              page_size, prefetch, payload)
+
     def listnodes(self, node_id=None):
         """
         Show all nodes in our local network view, filter on node {id}
@@ -1112,6 +1648,24 @@ class LightningRpc(UnixDomainSocketRpc):
         }
         return self.call("listsendpays", payload)
 
+    def iter_sendpays(self, bolt11=None, payment_hash=None, status=None,
+                      index='created', start=None, page_size=1000,
+                      prefetch=False):
+        """Iterate over sendpays (see `listsendpays`), fetching
+        {page_size} of them at a time, in {index} order ('created' or
+        'updated') from {start}.
+
+        With {prefetch} the next page is fetched while the current one
+        is being consumed.
+        """
+        payload = {
+            "bolt11": bolt11,
+            "payment_hash": payment_hash,
+            "status": status,
+        }
+        return self._paginate("listsendpays", "payments", index, start,
+                              page_size, prefetch, payload)
+
     def multifundchannel(self, destinations, feerate=None, minconf=None, utxos=None, minchannels=None, **kwargs):
         """
         Fund channels to an array of {destinations},
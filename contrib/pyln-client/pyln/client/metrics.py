@@ -0,0 +1,291 @@
+"""Instrumentation for the RPC client.
+
+Give `LightningRpc` a `metrics` sink, and it reports an `RpcCallStats`
+for every call it makes. `RpcMetrics` is a sink aggregating them per
+method, and exporting the result as a dict or in the Prometheus text
+exposition format:
+
+```python
+metrics = RpcMetrics()
+rpc = LightningRpc("/path/to/lightning-rpc", metrics=metrics)
+rpc.getinfo()
+print(metrics.to_prometheus())
+```
+
+Any object with a `record_call(stats)` method can be used as a sink.
+
+`HandlerMetrics` is the plugin side counterpart: it tracks how a
+`Plugin`'s methods, hooks and subscriptions perform.
+"""
+from bisect import bisect_left
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+import threading
+
+
+class RpcCallStats(object):
+    """Measurements of a single RPC call.
+
+    `latency` is the total time spent in the call, of which `wait_time`
+    was spent waiting for `lightningd` (sending the request and waiting
+    for its response), `encode_time` serializing the request and
+    `decode_time` parsing the response. All times are in seconds.
+
+    `error` is None for a successful call, or the name of the exception
+    it raised (e.g. 'RpcError').
+    """
+    __slots__ = ('method', 'latency', 'wait_time', 'encode_time',
+                 'decode_time', 'bytes_sent', 'bytes_received', 'error')
+
+    def __init__(self, method: str):
+        self.method = method
+        self.latency = 0.0
+        self.wait_time = 0.0
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return "RpcCallStats({})".format(", ".join(
+            "{}={!r}".format(k, getattr(self, k)) for k in self.__slots__))
+
+
+class _MethodMetrics(object):
+    __slots__ = ('calls', 'errors', 'buckets', 'latency', 'wait_time',
+                 'encode_time', 'decode_time', 'bytes_sent',
+                 'bytes_received')
+
+    def __init__(self, num_buckets: int):
+        self.calls = 0
+        self.errors: Dict[str, int] = {}
+        # Non-cumulative counts, the last one is for +Inf.
+        self.buckets = [0] * (num_buckets + 1)
+        self.latency = 0.0
+        self.wait_time = 0.0
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_float(value: float) -> str:
+    return repr(float(value))
+
+
+class RpcMetrics(object):
+    """Thread safe per-method aggregation of `RpcCallStats`.
+
+    Latencies go into a histogram with the given bucket upper bounds
+    (in seconds), everything else is summed up.
+    """
+    DEFAULT_BUCKETS: Tuple[float, ...] = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+    )
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        if list(buckets) != sorted(buckets):
+            raise ValueError("buckets must be sorted")
+        self.bucket_bounds = tuple(float(b) for b in buckets)
+        self._methods: Dict[str, _MethodMetrics] = {}
+        self._lock = threading.Lock()
+
+    def record_call(self, stats: RpcCallStats) -> None:
+        with self._lock:
+            m = self._methods.get(stats.method)
+            if m is None:
+                m = self._methods[stats.method] = _MethodMetrics(len(self.bucket_bounds))
+            m.calls += 1
+            if stats.error is not None:
+                m.errors[stats.error] = m.errors.get(stats.error, 0) + 1
+            m.buckets[bisect_left(self.bucket_bounds, stats.latency)] += 1
+            m.latency += stats.latency
+            m.wait_time += stats.wait_time
+            m.encode_time += stats.encode_time
+            m.decode_time += stats.decode_time
+            m.bytes_sent += stats.bytes_sent
+            m.bytes_received += stats.bytes_received
+
+    def reset(self) -> None:
+        with self._lock:
+            self._methods = {}
+
+    def to_dict(self) -> Dict[str, dict]:
+        """Snapshot of the metrics, keyed by method name.
+
+        The histogram is given as a list of cumulative
+        `(upper bound, count)` pairs, the last bound being infinity.
+        """
+        bounds = self.bucket_bounds + (float('inf'),)
+        res = {}
+        with self._lock:
+            for method, m in self._methods.items():
+                cumulative = 0
+                histogram = []
+                for bound, count in zip(bounds, m.buckets):
+                    cumulative += count
+                    histogram.append((bound, cumulative))
+                res[method] = {
+                    'calls': m.calls,
+                    'errors': dict(m.errors),
+                    'latency_seconds': m.latency,
+                    'latency_histogram': histogram,
+                    'wait_seconds': m.wait_time,
+                    'encode_seconds': m.encode_time,
+                    'decode_seconds': m.decode_time,
+                    'bytes_sent': m.bytes_sent,
+                    'bytes_received': m.bytes_received,
+                }
+        return res
+
+    def to_prometheus(self, prefix: str = 'pyln_rpc') -> str:
+        """The metrics in the Prometheus text exposition format"""
+        snapshot = self.to_dict()
+        methods = sorted(snapshot.items())
+        lines = []
+
+        def family(name, kind, help):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+
+        family('call_duration_seconds', 'histogram',
+               'Time spent in RPC calls.')
+        for method, m in methods:
+            label = 'method="{}"'.format(_escape_label(method))
+            for bound, count in m['latency_histogram']:
+                le = '+Inf' if bound == float('inf') else _format_float(bound)
+                lines.append('{}_call_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                    prefix, label, le, count))
+            lines.append('{}_call_duration_seconds_sum{{{}}} {}'.format(
+                prefix, label, _format_float(m['latency_seconds'])))
+            lines.append('{}_call_duration_seconds_count{{{}}} {}'.format(
+                prefix, label, m['calls']))
+
+        counters = [
+            ('wait_seconds_total', 'wait_seconds',
+             'Time spent waiting for lightningd.'),
+            ('encode_seconds_total', 'encode_seconds',
+             'Time spent serializing requests.'),
+            ('decode_seconds_total', 'decode_seconds',
+             'Time spent parsing responses.'),
+            ('sent_bytes_total', 'bytes_sent',
+             'Bytes sent to lightningd.'),
+            ('received_bytes_total', 'bytes_received',
+             'Bytes received from lightningd.'),
+        ]
+        for name, key, help in counters:
+            family(name, 'counter', help)
+            for method, m in methods:
+                value = m[key]
+                lines.append('{}_{}{{method="{}"}} {}'.format(
+                    prefix, name, _escape_label(method),
+                    _format_float(value) if isinstance(value, float) else value))
+
+        family('errors_total', 'counter', 'RPC calls that failed, by exception.')
+        for method, m in methods:
+            for error, count in sorted(m['errors'].items()):
+                lines.append('{}_errors_total{{method="{}",error="{}"}} {}'.format(
+                    prefix, _escape_label(method), _escape_label(error), count))
+
+        return "\n".join(lines) + "\n"
+
+
+class _HandlerMetrics(object):
+    __slots__ = ('calls', 'errors', 'fallbacks', 'latency', 'max_latency',
+                 'recent')
+
+    def __init__(self, window: int):
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.recent: deque = deque(maxlen=window)
+
+
+def _percentile(ordered, p: int) -> float:
+    # Nearest-rank
+    if not ordered:
+        return 0.0
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+
+class HandlerMetrics(object):
+    """Thread safe per-handler metrics of a `Plugin`.
+
+    Handlers are grouped by kind ('methods', 'hooks' or
+    'subscriptions'). Latencies are measured from when the request was
+    read until its response was queued (or, for subscriptions, the
+    handler returned), so they include time spent waiting for a worker.
+    Percentiles are over the last `window` invocations.
+    """
+    KINDS = ('methods', 'hooks', 'subscriptions')
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._handlers: Dict[str, Dict[str, _HandlerMetrics]] = {
+            kind: {} for kind in self.KINDS
+        }
+        self.received = 0
+        self.started = 0
+        self._lock = threading.Lock()
+
+    def request_received(self) -> None:
+        with self._lock:
+            self.received += 1
+
+    def request_started(self) -> None:
+        with self._lock:
+            self.started += 1
+
+    def record(self, kind: str, name: str, latency: float,
+               error: bool = False, fallback: bool = False) -> None:
+        with self._lock:
+            handlers = self._handlers[kind]
+            m = handlers.get(name)
+            if m is None:
+                m = handlers[name] = _HandlerMetrics(self.window)
+            m.calls += 1
+            if error:
+                m.errors += 1
+            if fallback:
+                m.fallbacks += 1
+            m.latency += latency
+            if latency > m.max_latency:
+                m.max_latency = latency
+            m.recent.append(latency)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._handlers = {kind: {} for kind in self.KINDS}
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Snapshot of the metrics, by kind and handler name.
+
+        Also gives the number of requests read but not handled yet
+        (`queued_requests`).
+        """
+        res: Dict[str, Any] = {}
+        with self._lock:
+            for kind, handlers in self._handlers.items():
+                res[kind] = {}
+                for name, m in handlers.items():
+                    ordered = sorted(m.recent)
+                    res[kind][name] = {
+                        'calls': m.calls,
+                        'errors': m.errors,
+                        'fallbacks': m.fallbacks,
+                        'latency_seconds': m.latency,
+                        'latency_p50_seconds': _percentile(ordered, 50),
+                        'latency_p99_seconds': _percentile(ordered, 99),
+                        'latency_max_seconds': m.max_latency,
+                    }
+            res['queued_requests'] = self.received - self.started
+        return res
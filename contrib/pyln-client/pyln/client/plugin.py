@@ -1,18 +1,24 @@
-from .lightning import LightningRpc, Millisatoshi
+from .jsoncodec import get_codec
+from .lightning import RPC_READ_SIZE, LightningRpc, Millisatoshi
+from .metrics import HandlerMetrics
 from binascii import hexlify
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
-from threading import RLock
+from threading import Condition, Lock, RLock, Thread, Timer
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import inspect
 import io
-import json
 import logging
+import fcntl
 import math
+import multiprocessing
 import os
 import re
 import sys
+import termios
+import time
 import traceback
 
 # Notice that this definition is incomplete as it only checks the
@@ -54,6 +60,7 @@ class Method(object):
         self.mtype = mtype
         self.category = category
         self.background = False
+        self.process = False
         self.desc = desc
         self.long_desc = long_desc
         self.deprecated = deprecated
@@ -68,6 +75,10 @@ class RpcException(Exception):
         self.message = message
         super().__init__("RpcException: {}".format(message))
 
+    def __reduce__(self):
+        # So it survives being passed back from a `process` method.
+        return (RpcException, (self.message, self.code))
+
 
 class Request(dict):
     """A request object that wraps params and allows async return
@@ -81,6 +92,10 @@ class Request(dict):
         self.state = RequestState.PENDING
         self.id = req_id
         self.termination_tb: Optional[str] = None
+        # When it was read, if the plugin keeps `handler_metrics`.
+        self.received: Optional[float] = None
+        # Whether it was answered with a `hook_fallbacks` response.
+        self.fallback = False
 
     def getattr(self, key: str) -> Union[Method, Any, int]:
         if key == "params":
@@ -94,29 +109,39 @@ class Request(dict):
                 'Cannot get attribute "{key}" on Request'.format(key=key)
             )
 
+    def _check_pending(self, what: str) -> None:
+        if self.state == RequestState.PENDING:
+            return
+        if self.termination_tb is not None:
+            where = "Request previously terminated at\n{}".format(self.termination_tb)
+        else:
+            where = "Set plugin.debug_requests to see where it terminated."
+        raise ValueError(
+            "Cannot set the {what} of a request that is not pending, "
+            "current state is {state}. {where}".format(
+                what=what, state=self.state, where=where))
+
+    def _terminate(self, state: RequestState) -> None:
+        self.state = state
+        # Formatting the stack is way more expensive than handling most
+        # requests, so only do it when asked to.
+        if self.plugin.debug_requests:
+            self.termination_tb = "".join(traceback.extract_stack().format()[:-2])
+        if self.received is not None:
+            self.plugin._record_request(self, state == RequestState.FAILED)
+
     def set_result(self, result: Any) -> None:
-        if self.state != RequestState.PENDING:
-            assert(self.termination_tb is not None)
-            raise ValueError(
-                "Cannot set the result of a request that is not pending, "
-                "current state is {state}. Request previously terminated at\n"
-                "{tb}".format(state=self.state, tb=self.termination_tb))
+        self._check_pending("result")
         self.result = result
         self._write_result({
             'jsonrpc': '2.0',
             'id': self.id,
             'result': self.result
         })
-        self.state = RequestState.FINISHED
-        self.termination_tb = "".join(traceback.extract_stack().format()[:-1])
+        self._terminate(RequestState.FINISHED)
 
     def set_exception(self, exc: Union[Exception, RpcException]) -> None:
-        if self.state != RequestState.PENDING:
-            assert(self.termination_tb is not None)
-            raise ValueError(
-                "Cannot set the exception of a request that is not pending, "
-                "current state is {state}. Request previously terminated at\n"
-                "{tb}".format(state=self.state, tb=self.termination_tb))
+        self._check_pending("exception")
         self.exc = exc
         if isinstance(exc, RpcException):
             code = exc.code
@@ -135,11 +160,10 @@ class Request(dict):
                 "traceback": traceback.format_exc(),
             },
         })
-        self.state = RequestState.FAILED
-        self.termination_tb = "".join(traceback.extract_stack().format()[:-1])
+        self._terminate(RequestState.FAILED)
 
     def _write_result(self, result: dict) -> None:
-        self.plugin._write_locked(result)
+        self.plugin._write_locked(result, self.method in priority_hooks)
 
     def _notify(self, method: str, params: JSONType) -> None:
         """Send a notification to the caller.
@@ -183,6 +207,39 @@ class Request(dict):
         self._notify("progress", d)
 
 
+class BindPlan(object):
+    """How to call a handler with a request's params, worked out once.
+
+    Inspecting the handler's signature is costly compared to calling
+    it, so we do it when the handler is registered rather than for
+    every request.
+    """
+    __slots__ = ('sig', 'injections', 'takes_plugin', 'takes_request',
+                 'msat_names', 'msat_positions')
+
+    def __init__(self, func: Callable[..., Any]):
+        self.sig = inspect.signature(func)
+        names = list(self.sig.parameters.keys())
+        self.takes_plugin = 'plugin' in self.sig.parameters
+        self.takes_request = 'request' in self.sig.parameters
+
+        # Where to insert `plugin` and `request` into positional params.
+        # They are sorted so that inserting them in order does not shift
+        # an earlier injection.
+        self.injections: List[Tuple[int, str]] = sorted(
+            (names.index(n), n) for n in ('plugin', 'request')
+            if n in self.sig.parameters
+        )
+
+        # Parameters annotated as Millisatoshi get their value converted.
+        annotations = getattr(func, '__annotations__', {})
+        self.msat_names = [
+            n for n in names
+            if annotations.get(n, None) is not None and annotations[n] == Millisatoshi
+        ]
+        self.msat_positions = [names.index(n) for n in self.msat_names]
+
+
 # If a hook call fails we need to coerce it into something the main daemon can
 # handle. Returning an error is not an option since we explicitly do not allow
 # those as a response to the calls, otherwise the only option we have is to
@@ -202,6 +259,157 @@ hook_fallbacks = {
     'custommsg': {'result': 'continue'},
 }
 
+# Hooks holding up payments: their replies are written out ahead of
+# other pending output, see `PluginWriter`.
+priority_hooks = {'htlc_accepted'}
+
+
+class PluginWriter(object):
+    """Writes a plugin's output to lightningd from a thread of its own.
+
+    Responses and notifications are queued in order, up to `max_queue`
+    of them: beyond that callers block until lightningd catches up.
+    Each message is queued along with the logs pending before it, so
+    they keep their order. Whatever is queued by the time the writer
+    gets to it is written out in a single write, without holding the
+    plugin's `write_lock`. Once the writer is closed, messages are
+    written out directly.
+
+    Replies to `priority_hooks` skip the line: they go out first in
+    the next write, ahead of the messages and logs queued before them.
+    """
+
+    def __init__(self, plugin: 'Plugin', max_queue: int = 1000):
+        if max_queue < 1:
+            raise ValueError("max_queue must be at least 1")
+        self.plugin = plugin
+        self.max_queue = max_queue
+        self._queue: deque = deque()
+        self._priority: deque = deque()
+        self._cond = Condition()
+        self._logs_pending = False
+        self._busy = False
+        self._closed = False
+
+        # Metrics, see `stats`
+        self.writes = 0
+        self.messages = 0
+        self.bytes_written = 0
+        self.max_queue_depth = 0
+        self.blocked = 0
+        self.blocked_time = 0.0
+
+        self._thread = Thread(target=self._run, name='plugin-writer',
+                              daemon=True)
+        self._thread.start()
+
+    def put(self, s: bytes, priority: bool = False) -> None:
+        """Queue an encoded message, waiting for room if need be.
+
+        A `priority` message neither waits for room nor for the logs.
+        """
+        with self._cond:
+            if priority and not self._closed:
+                self._priority.append(s)
+                self._cond.notify_all()
+                return
+            if len(self._queue) >= self.max_queue:
+                start = time.monotonic()
+                while len(self._queue) >= self.max_queue and not self._closed:
+                    self._cond.wait()
+                self.blocked += 1
+                self.blocked_time += time.monotonic() - start
+            closed = self._closed
+        if closed:
+            # Nothing would write it out: do it ourselves, after
+            # whatever was queued before.
+            self._thread.join()
+            with self.plugin.write_lock:
+                self.plugin._write_out(s)
+            return
+
+        # Not waiting for room while holding the write_lock (the writer
+        # needs it), so concurrent callers may overshoot max_queue a bit.
+        # The writer also takes the logs and the queue together under
+        # the write_lock, so no log is written after a later message.
+        with self.plugin.write_lock:
+            s = self.plugin._take_logs() + s
+            with self._cond:
+                self._queue.append(s)
+                if len(self._queue) > self.max_queue_depth:
+                    self.max_queue_depth = len(self._queue)
+                self._cond.notify_all()
+
+    def logs_pending(self) -> None:
+        """Tell the writer the plugin has logs to write out."""
+        with self._cond:
+            self._logs_pending = True
+            self._cond.notify_all()
+
+    def flush(self) -> None:
+        """Wait until everything queued so far has been written."""
+        with self._cond:
+            while self._queue or self._priority or self._logs_pending or self._busy:
+                self._cond.wait()
+
+    def close(self) -> None:
+        """Write out what is queued, and stop the writer thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'queue_depth': len(self._queue) + len(self._priority),
+                'max_queue_depth': self.max_queue_depth,
+                'blocked': self.blocked,
+                'blocked_seconds': self.blocked_time,
+                'writes': self.writes,
+                'messages': self.messages,
+                'bytes': self.bytes_written,
+                'logs_dropped': self.plugin.logs_dropped,
+            }
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not (self._queue or self._priority or self._logs_pending
+                           or self._closed):
+                    self._cond.wait()
+                if not (self._queue or self._priority or self._logs_pending):
+                    return
+                self._busy = True
+
+            # Logs still pending were logged after the queued messages.
+            # We only hold the write_lock to take both, not to write.
+            with self.plugin.write_lock:
+                logs = self.plugin._take_logs()
+                with self._cond:
+                    msgs = list(self._priority) + list(self._queue)
+                    self._priority.clear()
+                    self._queue.clear()
+                    self._logs_pending = False
+                    # There's room in the queue again.
+                    self._cond.notify_all()
+
+            data = b"".join(msgs) + logs
+            try:
+                if data:
+                    self.plugin.stdout.buffer.write(data)
+                    self.plugin.stdout.flush()
+            except (OSError, ValueError):
+                # lightningd went away, there's nothing we can do.
+                pass
+
+            with self._cond:
+                self.writes += 1
+                self.messages += len(msgs)
+                self.bytes_written += len(data)
+                self._busy = False
+                self._cond.notify_all()
+
 
 class Plugin(object):
     """Controls interactions with lightningd, and bundles functionality.
@@ -210,6 +418,48 @@ class Plugin(object):
     options, and offers a control loop that dispatches incoming RPC
     calls and hooks.
 
+    By default each request is handled to completion before the next
+    one is read. With `max_workers` they are dispatched to a pool of
+    that many threads instead, so that a slow handler doesn't hold up
+    the others. `ordering` then tells which requests must still be
+    handled one at a time, in the order they arrived:
+
+     - 'none': no ordering, any requests can run concurrently.
+     - 'method': requests for the same method, hook or notification
+       topic are handled in order.
+     - 'all': every request is handled in order (but off the thread
+       reading from lightningd).
+
+    `getmanifest` and `init` are always handled before anything else.
+
+    Log notifications are buffered, and written out together with the
+    next response, after each batch of requests read from lightningd,
+    or `log_flush_interval` seconds after they were logged, whichever
+    comes first. At most `log_buffer_size` lines are buffered, any
+    more are dropped (and counted in `logs_dropped`) until the next
+    write. A `log_flush_interval` of 0 writes each log message out
+    immediately.
+
+    While `run` is running, output is written by a `PluginWriter`
+    thread, so that handlers don't block on lightningd reading it
+    unless more than `write_queue_size` messages are pending. Its
+    metrics are available through `plugin.writer.stats()`.
+
+    Methods added with `process=True` are run in a pool of up to
+    `max_processes` processes (by default, one per CPU), for CPU bound
+    handlers the GIL would otherwise serialize. Their params and
+    results must be picklable. The processes are forked from the
+    running plugin, threads and all: see `add_method` for what that
+    means for the handlers.
+
+    With `stats_method` set, the plugin keeps `handler_metrics` (see
+    `HandlerMetrics`), and registers an RPC method of that name
+    returning them, along with the stdin backlog and the writer's
+    stats. Use a name unique to the plugin, e.g. `myplugin-stats`.
+
+    With `debug_requests` set, requests remember the stack they were
+    completed from, so that completing them twice reports where the
+    first completion happened. This is costly, so it's off by default.
     """
 
     def __init__(self, stdout: Optional[io.TextIOBase] = None,
@@ -218,7 +468,21 @@ class Plugin(object):
                  init_features: Optional[Union[int, str, bytes]] = None,
                  node_features: Optional[Union[int, str, bytes]] = None,
                  invoice_features: Optional[Union[int, str, bytes]] = None,
-                 custom_msgs: Optional[List[int]] = None):
+                 custom_msgs: Optional[List[int]] = None,
+                 json_backend: Optional[str] = None,
+                 max_workers: Optional[int] = None,
+                 ordering: str = 'none',
+                 debug_requests: bool = False,
+                 log_buffer_size: int = 1000,
+                 log_flush_interval: float = 0.05,
+                 write_queue_size: int = 1000,
+                 stats_method: Optional[str] = None,
+                 max_processes: Optional[int] = None):
+        if ordering not in ('none', 'method', 'all'):
+            raise ValueError("ordering must be one of 'none', 'method' or 'all'")
+        if max_workers is not None and max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+
         self.methods = {
             'init': Method('init', self._init, MethodType.RPCMETHOD)
         }
@@ -259,10 +523,11 @@ class Plugin(object):
         # A dict from topics to handler functions
         self.subscriptions: Dict[str, Callable[..., None]] = {}
 
-        if not stdout:
-            self.stdout = sys.stdout
-        if not stdin:
-            self.stdin = sys.stdin
+        # How to call each handler, see `BindPlan`.
+        self._bind_plans: Dict[Callable[..., Any], BindPlan] = {}
+
+        self.stdout = stdout if stdout else sys.stdout
+        self.stdin = stdin if stdin else sys.stdin
 
         self.lightning_version = None
         if os.getenv('LIGHTNINGD_VERSION'):
@@ -284,6 +549,47 @@ class Plugin(object):
 
         self.write_lock = RLock()
 
+        # Log notifications waiting to be written, see `log`. These are
+        # protected by the write_lock.
+        self.log_buffer_size = log_buffer_size
+        self.log_flush_interval = log_flush_interval
+        self.logs_dropped = 0
+        self._logs_dropped_unreported = 0
+        self._log_buffer: List[bytes] = []
+        self._log_timer: Optional[Timer] = None
+
+        # Started by `run`, until then we write synchronously.
+        self.write_queue_size = write_queue_size
+        self.writer: Optional[PluginWriter] = None
+
+        # How we (de)serialize messages to and from lightningd, see
+        # `get_codec`.
+        self.json_backend = json_backend
+        self.codec = get_codec(json_backend)
+
+        self.debug_requests = debug_requests
+        self.max_workers = max_workers
+        self.ordering = ordering
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if max_workers is not None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix='plugin'
+            )
+        # Requests waiting for their predecessors to be handled, by
+        # ordering key. A key is present while a worker handles them.
+        self._ordered_queues: Dict[Optional[str], deque] = {}
+        self._ordered_lock = Lock()
+
+        # Created when a `process` method is first called.
+        self.max_processes = max_processes
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._process_pool_lock = Lock()
+
+        self.handler_metrics: Optional[HandlerMetrics] = None
+        if stats_method is not None:
+            self.handler_metrics = HandlerMetrics()
+            self.add_method(stats_method, self._stats)
+
         # Initialize the logging system with a handler that passes the logs to
         # lightning for display.
         log_handler = PluginLogHandler(self)
@@ -296,7 +602,8 @@ class Plugin(object):
                    category: Optional[str] = None,
                    desc: Optional[str] = None,
                    long_desc: Optional[str] = None,
-                   deprecated: bool = False) -> None:
+                   deprecated: bool = False,
+                   process: bool = False) -> None:
         """Add a plugin method to the dispatch table.
 
         The function will be expected at call time (see `_dispatch`)
@@ -328,11 +635,33 @@ class Plugin(object):
 
         `deprecated` means that it won't appear unless `allow-deprecated-apis`
         is true (the default).
+
+        With `process=True` the method is called in a separate process
+        (forked from this one, see `max_processes`), with a copy of the
+        plugin whose `rpc` is a new `LightningRpc` connection. Whatever
+        it logs or notifies is passed on when it returns. It can't be
+        `background` or a coroutine function.
+
+        The fork happens while the plugin's reader, writer and worker
+        threads are running, and only the forking thread survives it.
+        The plugin's own locks are recreated in the child, and the
+        stdlib's `logging` handles itself, but a lock held by any other
+        thread at the time (in the handler's own code, or in a C
+        extension running a thread pool) stays held forever in the
+        child. Such a handler deadlocks: keep `process` methods to pure
+        computation on their params. We can't use the `spawn` or
+        `forkserver` start methods instead, as those run the plugin
+        script again in the child, and need handlers that can be
+        pickled.
         """
         if name in self.methods:
             raise ValueError(
                 "Name {} is already bound to a method.".format(name)
             )
+        if process and (background or inspect.iscoroutinefunction(func)):
+            raise ValueError(
+                "Method {} cannot be run in a process.".format(name)
+            )
 
         # Register the function with the name
         method = Method(
@@ -341,7 +670,9 @@ class Plugin(object):
         )
 
         method.background = background
+        method.process = process
         self.methods[name] = method
+        self._bind_plan(func)
 
     def add_subscription(self, topic: str, func: Callable[..., None]) -> None:
         """Add a subscription to our list of subscriptions.
@@ -374,6 +705,7 @@ class Plugin(object):
                 "handlers.".format(func.__name__, topic), level="warn")
 
         self.subscriptions[topic] = func
+        self._bind_plan(func)
 
     def subscribe(self, topic: str) -> NoneDecoratorType:
         """Function decorator to register a notification handler.
@@ -459,7 +791,8 @@ class Plugin(object):
     def method(self, method_name: str, category: Optional[str] = None,
                desc: Optional[str] = None,
                long_desc: Optional[str] = None,
-               deprecated: bool = False) -> JsonDecoratorType:
+               deprecated: bool = False,
+               process: bool = False) -> JsonDecoratorType:
         """Decorator to add a plugin method to the dispatch table.
 
         Internally uses add_method.
@@ -471,7 +804,8 @@ class Plugin(object):
                             category=category,
                             desc=desc,
                             long_desc=long_desc,
-                            deprecated=deprecated)
+                            deprecated=deprecated,
+                            process=process)
             return f
         return decorator
 
@@ -507,6 +841,7 @@ class Plugin(object):
         if after:
             method.after = after
         self.methods[name] = method
+        self._bind_plan(func)
 
     def hook(self, method_name: str,
              before: List[str] = None,
@@ -560,28 +895,24 @@ class Plugin(object):
         ba.arguments = args
         return ba
 
+    def _bind_plan(self, func: Callable[..., Any]) -> BindPlan:
+        plan = self._bind_plans.get(func)
+        if plan is None:
+            plan = self._bind_plans[func] = BindPlan(func)
+        return plan
+
     def _bind_pos(self, func: Callable[..., Any], params: List[str],
                   request: Request) -> inspect.BoundArguments:
         """Positional binding of parameters
         """
         assert(isinstance(params, list))
-        sig = inspect.signature(func)
-
-        # Collect injections so we can sort them and insert them in the right
-        # order later. If we don't apply inject them in increasing order we
-        # might shift away an earlier injection.
-        injections: List[Tuple[int, Any]] = []
-        if 'plugin' in sig.parameters:
-            pos = list(sig.parameters.keys()).index('plugin')
-            injections.append((pos, self))
-        if 'request' in sig.parameters:
-            pos = list(sig.parameters.keys()).index('request')
-            injections.append((pos, request))
-        injections = sorted(injections)
-        for pos, val in injections:
+        plan = self._bind_plan(func)
+
+        for pos, name in plan.injections:
+            val = self if name == 'plugin' else request
             params = params[:pos] + [val] + params[pos:]
 
-        ba = sig.bind(*params)
+        ba = plan.sig.bind(*params)
         self._coerce_arguments(func, ba)
         ba.apply_defaults()
         return ba
@@ -591,19 +922,19 @@ class Plugin(object):
         """Keyword based binding of parameters
         """
         assert(isinstance(params, dict))
-        sig = inspect.signature(func)
+        plan = self._bind_plan(func)
 
         # Inject additional parameters if they are in the signature.
-        if 'plugin' in sig.parameters:
+        if plan.takes_plugin:
             params['plugin'] = self
         elif 'plugin' in params:
             del params['plugin']
-        if 'request' in sig.parameters:
+        if plan.takes_request:
             params['request'] = request
         elif 'request' in params:
             del params['request']
 
-        ba = sig.bind(**params)
+        ba = plan.sig.bind(**params)
         self._coerce_arguments(func, ba)
         return ba
 
@@ -613,12 +944,38 @@ class Plugin(object):
         if self.rpc:
             self.rpc.cmdprefix = request.id
         params = request.params
+        plan = self._bind_plan(func)
+
+        # This does what _bind_pos and _bind_kwargs do, but leaves it to
+        # the call itself to match arguments to parameters (raising a
+        # TypeError if they don't), which is much cheaper than binding
+        # them with the signature first.
         if isinstance(params, list):
-            ba = self._bind_pos(func, params, request)
-            ret = func(*ba.args, **ba.kwargs)
+            args = params
+            if plan.injections or plan.msat_positions:
+                args = list(params)
+                for pos, name in plan.injections:
+                    args.insert(pos, self if name == 'plugin' else request)
+                for pos in plan.msat_positions:
+                    if pos < len(args):
+                        args[pos] = Millisatoshi(args[pos])
+            ret = func(*args)
         elif isinstance(params, dict):
-            ba = self._bind_kwargs(func, params, request)
-            ret = func(*ba.args, **ba.kwargs)
+            if plan.takes_plugin:
+                params['plugin'] = self
+            elif 'plugin' in params:
+                del params['plugin']
+            if plan.takes_request:
+                params['request'] = request
+            elif 'request' in params:
+                del params['request']
+            kwargs = params
+            if plan.msat_names:
+                kwargs = dict(params)
+                for name in plan.msat_names:
+                    if name in kwargs:
+                        kwargs[name] = Millisatoshi(kwargs[name])
+            ret = func(**kwargs)
         else:
             if self.rpc:
                 self.rpc.cmdprefix = None
@@ -629,13 +986,68 @@ class Plugin(object):
             self.rpc.cmdprefix = None
         return ret
 
-    def _dispatch_request(self, request: Request) -> None:
+    def _request_method(self, request: Request) -> Method:
         name = request.method
 
         if name not in self.methods:
             raise ValueError("No method {} found.".format(name))
         method = self.methods[name]
         request.background = method.background
+        return method
+
+    def _request_failed(self, request: Request, e: Exception) -> None:
+        name = request.method
+        if name in hook_fallbacks:
+            response = hook_fallbacks[name]
+            request.fallback = True
+            self.log((
+                "Hook handler for {name} failed with an exception. "
+                "Returning safe fallback response {response} to avoid "
+                "crashing the main daemon. Please contact the plugin "
+                "author!"
+            ).format(name=name, response=response), level="error")
+
+            request.set_result(response)
+        else:
+            request.set_exception(e)
+        self.log(traceback.format_exc())
+
+    def _record_request(self, request: Request, failed: bool) -> None:
+        assert self.handler_metrics is not None and request.received is not None
+        method = self.methods.get(request.method)
+        kind = 'hooks' if method and method.mtype == MethodType.HOOK else 'methods'
+        self.handler_metrics.record(kind, request.method,
+                                    time.monotonic() - request.received,
+                                    error=failed or request.fallback,
+                                    fallback=request.fallback)
+
+    def _record_notification(self, request: Request, failed: bool) -> None:
+        if request.received is not None and self.handler_metrics is not None:
+            self.handler_metrics.record('subscriptions', request.method,
+                                        time.monotonic() - request.received,
+                                        error=failed)
+
+    def _stats(self) -> Dict[str, Any]:
+        """Returns this plugin's handler metrics and output queue stats."""
+        assert self.handler_metrics is not None
+        stats = self.handler_metrics.to_dict()
+        try:
+            # Bytes lightningd sent that we haven't read yet.
+            buf = fcntl.ioctl(self.stdin.fileno(), termios.FIONREAD, b"\0\0\0\0")
+            stats['stdin_pending_bytes'] = int.from_bytes(buf, sys.byteorder)
+        except (OSError, ValueError, io.UnsupportedOperation):
+            stats['stdin_pending_bytes'] = None
+        writer = self.writer
+        stats['writer'] = writer.stats() if writer is not None else None
+        return stats
+
+    def _dispatch_request(self, request: Request) -> None:
+        method = self._request_method(request)
+
+        if method.process:
+            self._process_submit(request).add_done_callback(
+                lambda fut: self._process_done(request, fut))
+            return
 
         try:
             result = self._exec_func(method.func, request)
@@ -646,46 +1058,149 @@ class Plugin(object):
                 # return a result or raise an exception.
                 request.set_result(result)
         except Exception as e:
-            if name in hook_fallbacks:
-                response = hook_fallbacks[name]
-                self.log((
-                    "Hook handler for {name} failed with an exception. "
-                    "Returning safe fallback response {response} to avoid "
-                    "crashing the main daemon. Please contact the plugin "
-                    "author!"
-                ).format(name=name, response=response), level="error")
-
-                request.set_result(response)
-            else:
-                request.set_exception(e)
-            self.log(traceback.format_exc())
+            self._request_failed(request, e)
+
+    def _process_submit(self, request: Request) -> 'Future[Tuple[Any, Optional[Exception], bytes]]':
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                # Forking lets the children inherit the handlers, which
+                # can then be anything, e.g. closures. Only the request
+                # and its outcome need to be pickled. See `add_method`
+                # for the restrictions that come with it.
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.max_processes,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_process_init,
+                    initargs=(self,),
+                )
+        return self._process_pool.submit(
+            _process_call, request.id, request.method, request.params)
 
-    def _dispatch_notification(self, request: Request) -> None:
+    def _process_done(self, request: Request, fut: Future) -> None:
+        try:
+            result, error, output = fut.result()
+            self._write_raw(output)
+            if error is not None:
+                raise error
+            request.set_result(result)
+        except Exception as e:
+            self._request_failed(request, e)
+
+    def _init_process(self) -> None:
+        """Turn this copy of the plugin into a `process` method runner."""
+        # Other threads didn't make it across the fork, and may have
+        # been holding these.
+        self.write_lock = RLock()
+        self._ordered_lock = Lock()
+        self._process_pool_lock = Lock()
+        self._log_buffer = []
+        self._log_timer = None
+        self._logs_dropped_unreported = 0
+        self.writer = None
+        self.executor = None
+        self._process_pool = None
+        self.handler_metrics = None
+        # Output is collected, for the parent to write.
+        self.stdout = io.TextIOWrapper(io.BytesIO())
+        self.log_flush_interval = 0
+        if self.rpc_filename is not None and self.lightning_dir is not None:
+            self.rpc = Plugin._connect_rpc(
+                self, os.path.join(self.lightning_dir, self.rpc_filename))
+
+    def _take_output(self) -> bytes:
+        self.stdout.flush()
+        out = self.stdout.buffer
+        data = out.getvalue()  # type: ignore[attr-defined]
+        out.seek(0)
+        out.truncate()
+        return data
+
+    def _write_raw(self, s: bytes) -> None:
+        """Write already encoded messages"""
+        if not s:
+            return
+        writer = self.writer
+        if writer is not None:
+            writer.put(s)
+            return
+        with self.write_lock:
+            self._write_out(s)
+
+    def _subscription_func(self, request: Request) -> Callable[..., None]:
         if request.method in self.subscriptions:
-            func = self.subscriptions[request.method]
+            return self.subscriptions[request.method]
         # Wildcard 'all' subscriptions using asterisk
         elif '*' in self.subscriptions:
-            func = self.subscriptions['*']
+            return self.subscriptions['*']
         else:
             raise ValueError(f"No subscription for {request.method} found.")
 
+    def _dispatch_notification(self, request: Request) -> None:
+        func = self._subscription_func(request)
+
         try:
             self._exec_func(func, request)
         except Exception:
+            self._record_notification(request, True)
             self.log(traceback.format_exc())
+        else:
+            self._record_notification(request, False)
 
-    def _write_locked(self, obj: JSONType) -> None:
-        # ensure_ascii turns UTF-8 into \uXXXX so we need to suppress that,
-        # then utf8 ourselves.
-        s = bytes(json.dumps(
-            obj,
-            cls=LightningRpc.LightningJSONEncoder,
-            ensure_ascii=False
-        ) + "\n\n", encoding='utf-8')
+    def _write_locked(self, obj: JSONType, priority: bool = False) -> None:
+        s = self.codec.dumps(obj) + b"\n\n"
+        writer = self.writer
+        if writer is not None:
+            writer.put(s, priority)
+            return
         with self.write_lock:
+            self._write_out(s)
+
+    def _take_logs(self) -> bytes:
+        """Remove and return pending logs, holding the write_lock"""
+        if self._log_timer is not None:
+            self._log_timer.cancel()
+            self._log_timer = None
+        if self._logs_dropped_unreported:
+            self._log_buffer.append(self._encode_log(
+                "Dropped {} log messages".format(self._logs_dropped_unreported),
+                'warn'))
+            self._logs_dropped_unreported = 0
+        logs = b"".join(self._log_buffer)
+        self._log_buffer = []
+        return logs
+
+    def _write_out(self, s: bytes = b"") -> None:
+        """Write `s` preceded by any pending logs, holding the write_lock"""
+        s = self._take_logs() + s
+        if s:
             self.stdout.buffer.write(s)
             self.stdout.flush()
 
+    def flush_logs(self) -> None:
+        """Write out any pending log notifications"""
+        writer = self.writer
+        if writer is not None:
+            writer.logs_pending()
+            return
+        with self.write_lock:
+            self._write_out()
+
+    def _start_writer(self) -> None:
+        self.writer = PluginWriter(self, self.write_queue_size)
+
+    def _stop_writer(self) -> None:
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+        self.flush_logs()
+
+    def _encode_log(self, line: str, level: str) -> bytes:
+        return self.codec.dumps({
+            'jsonrpc': '2.0',
+            'method': 'log',
+            'params': {'level': level, 'message': line},
+        }) + b"\n\n"
+
     def notify(self, method: str, params: JSONType) -> None:
         payload = {
             'jsonrpc': '2.0',
@@ -697,8 +1212,25 @@ class Plugin(object):
     def log(self, message: str, level: str = 'info') -> None:
         # Split the log into multiple lines and print them
         # individually. Makes tracebacks much easier to read.
-        for line in message.split('\n'):
-            self.notify('log', {'level': level, 'message': line})
+        lines = [self._encode_log(line, level) for line in message.split('\n')]
+        with self.write_lock:
+            room = max(0, self.log_buffer_size - len(self._log_buffer))
+            if len(lines) > room:
+                self.logs_dropped += len(lines) - room
+                self._logs_dropped_unreported += len(lines) - room
+                lines = lines[:room]
+            self._log_buffer.extend(lines)
+
+            if self.writer is not None:
+                self.writer.logs_pending()
+            elif self.log_flush_interval <= 0:
+                self._write_out()
+            elif self._log_timer is None:
+                self._log_timer = Timer(self.log_flush_interval, self.flush_logs)
+                # Don't keep the plugin from exiting: `run` flushes the
+                # logs on its way out.
+                self._log_timer.daemon = True
+                self._log_timer.start()
 
     def notify_message(self, request: Request, message: str,
                        level: str = 'info') -> None:
@@ -720,26 +1252,75 @@ class Plugin(object):
             params=jsrequest['params'],
             background=False,
         )
+        if self.handler_metrics is not None:
+            request.received = time.monotonic()
+            self.handler_metrics.request_received()
         return request
 
+    def _dispatch_payload(self, payload) -> None:
+        """Parse a single message (any bytes-like object) and dispatch it."""
+        # Note that we use function annotations to do Millisatoshi
+        # conversions in _exec_func, so we don't use LightningJSONDecoder
+        # here.
+        request = self._parse_request(self.codec.loads(payload))
+
+        if self.executor is None or request.method in ('getmanifest', 'init'):
+            self._dispatch(request)
+        else:
+            self._submit(request)
+
+    def _dispatch(self, request: Request) -> None:
+        # If this has an 'id'-field, it's a request and returns a
+        # result. Otherwise it's a notification and it doesn't
+        # return anything.
+        if self.handler_metrics is not None:
+            self.handler_metrics.request_started()
+        if request.id is not None:
+            self._dispatch_request(request)
+        else:
+            self._dispatch_notification(request)
+
+    def _dispatch_in_worker(self, request: Request) -> None:
+        # There is no one to raise to in a worker thread.
+        try:
+            self._dispatch(request)
+        except Exception:
+            self.log(traceback.format_exc(), level='error')
+
+    def _submit(self, request: Request) -> None:
+        """Hand the request to the worker pool, respecting `ordering`."""
+        assert self.executor is not None
+        if self.ordering == 'none':
+            self.executor.submit(self._dispatch_in_worker, request)
+            return
+
+        key = request.method if self.ordering == 'method' else None
+        with self._ordered_lock:
+            queue = self._ordered_queues.get(key)
+            if queue is not None:
+                # A worker is on it already, it'll get to this one.
+                queue.append(request)
+                return
+            self._ordered_queues[key] = deque([request])
+        self.executor.submit(self._dispatch_ordered, key)
+
+    def _dispatch_ordered(self, key: Optional[str]) -> None:
+        while True:
+            with self._ordered_lock:
+                queue = self._ordered_queues[key]
+                if not queue:
+                    del self._ordered_queues[key]
+                    return
+                request = queue.popleft()
+            self._dispatch_in_worker(request)
+
     def _multi_dispatch(self, msgs: List[bytes]) -> bytes:
         """We received a couple of messages, now try to dispatch them all.
 
         Returns the last partial message that was not complete yet.
         """
         for payload in msgs[:-1]:
-            # Note that we use function annotations to do Millisatoshi
-            # conversions in _exec_func, so we don't use LightningJSONDecoder
-            # here.
-            request = self._parse_request(json.loads(payload.decode('utf8')))
-
-            # If this has an 'id'-field, it's a request and returns a
-            # result. Otherwise it's a notification and it doesn't
-            # return anything.
-            if request.id is not None:
-                self._dispatch_request(request)
-            else:
-                self._dispatch_notification(request)
+            self._dispatch_payload(payload)
 
         return msgs[-1]
 
@@ -843,15 +1424,50 @@ class Plugin(object):
         if os.environ.get('LIGHTNINGD_PLUGIN', None) != '1':
             return self.print_usage()
 
-        partial = b""
-        for l in self.stdin.buffer:
-            partial += l
-
-            msgs = partial.split(b'\n\n')
-            if len(msgs) < 2:
-                continue
+        self._start_writer()
+        try:
+            read = self.stdin.buffer.read1
+            buff = bytearray()
+            scanned = 0
+            while True:
+                b = read(RPC_READ_SIZE)
+                if len(b) == 0:
+                    break
+                buff += b
+                scanned = self._consume(buff, scanned, self._dispatch_payload)
+                self.flush_logs()
+
+            # Let the workers finish what they have started.
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=True)
+        finally:
+            self._stop_writer()
 
-            partial = self._multi_dispatch(msgs)
+    @staticmethod
+    def _consume(buff: bytearray, scanned: int,
+                 dispatch: Callable[[memoryview], None]) -> int:
+        """Pass each complete message in `buff` to `dispatch`, and remove them.
+
+        We read whatever is available, in large chunks, and call this
+        after each read. We only ever search the newly read data for
+        the terminator (`scanned` is where the last search stopped, the
+        position to resume from is returned), and messages are parsed
+        straight from the buffer, so large messages cost linear time.
+        """
+        start = 0
+        while True:
+            end = buff.find(b'\n\n', max(start, scanned))
+            if end < 0:
+                break
+            with memoryview(buff)[start:end] as payload:
+                dispatch(payload)
+            start = end + 2
+
+        del buff[:start]
+        # The terminator may straddle reads.
+        return max(0, len(buff) - 1)
 
     def _getmanifest(self, **kwargs) -> JSONType:
         if 'allow-deprecated-apis' in kwargs:
@@ -938,6 +1554,10 @@ class Plugin(object):
 
         return manifest
 
+    def _connect_rpc(self, path: str) -> LightningRpc:
+        """Create the RPC client for `plugin.rpc`"""
+        return LightningRpc(path, json_backend=self.json_backend)
+
     def _init(self, options: Dict[str, JSONType],
               configuration: Dict[str, JSONType],
               request: Request) -> JSONType:
@@ -960,7 +1580,7 @@ class Plugin(object):
         self.lightning_dir = verify_str(configuration, 'lightning-dir')
 
         path = os.path.join(self.lightning_dir, self.rpc_filename)
-        self.rpc = LightningRpc(path)
+        self.rpc = self._connect_rpc(path)
         self.startup = verify_bool(configuration, 'startup')
         for name, value in options.items():
             self.options[name]['value'] = value
@@ -1017,6 +1637,33 @@ def monkey_patch(plugin: Plugin, stdout: bool = True,
         setattr(sys, "stderr", PluginStream(plugin, level="warn"))
 
 
+# The plugin in a `process` method runner, see `Plugin._init_process`.
+_process_plugin: Optional[Plugin] = None
+
+
+def _process_init(plugin: Plugin) -> None:
+    global _process_plugin
+    plugin._init_process()
+    _process_plugin = plugin
+
+
+def _process_call(req_id: Any, method: str,
+                  params: Any) -> Tuple[Any, Optional[Exception], bytes]:
+    """Call a `process` method, returning its result or exception, and output"""
+    plugin = _process_plugin
+    assert plugin is not None
+    request = plugin._parse_request(
+        {'id': req_id, 'method': method, 'params': params})
+    result, error = None, None
+    try:
+        result = plugin._exec_func(plugin.methods[method].func, request)
+    except Exception as e:
+        plugin.log(traceback.format_exc(), level='debug')
+        error = e
+    plugin.flush_logs()
+    return result, error, plugin._take_output()
+
+
 class PluginLogHandler(logging.StreamHandler):
     def __init__(self, plugin: Plugin) -> None:
         logging.StreamHandler.__init__(self, stream=None)
@@ -0,0 +1,310 @@
+"""Micro-benchmarks for pyln-client, using pytest-benchmark.
+
+These are not collected by default, run them explicitly with:
+
+    pytest tests/benchmark.py
+"""
+from pyln.client import Gossmap, GossmapColumns, GossmapStats, LightningRpc, Millisatoshi, Plugin
+from pyln.client.jsoncodec import get_codec, orjson
+import io
+import json
+import operator
+import os
+import pytest  # type: ignore
+import subprocess
+import sys
+
+
+def listpeerchannels(num_channels=2000, num_htlcs=10):
+    """A synthetic `listpeerchannels` response, shaped like the real one"""
+    def htlc(i):
+        return {
+            'direction': 'out', 'id': i, 'amount_msat': 1000 * i,
+            'expiry': 800000 + i, 'payment_hash': '00' * 32,
+            'state': 'SENT_ADD_ACK_REVOCATION',
+        }
+
+    def channel(i):
+        return {
+            'peer_id': '02' + '%064x' % i, 'peer_connected': True,
+            'state': 'CHANNELD_NORMAL', 'short_channel_id': '%dx1x0' % i,
+            'feerate': {'perkw': 253, 'perkb': 1012},
+            'updates': {
+                'local': {'htlc_minimum_msat': 0, 'htlc_maximum_msat': 990000000,
+                          'cltv_expiry_delta': 6, 'fee_base_msat': 1,
+                          'fee_proportional_millionths': 10},
+                'remote': {'htlc_minimum_msat': 0, 'htlc_maximum_msat': 990000000,
+                           'cltv_expiry_delta': 6, 'fee_base_msat': 1,
+                           'fee_proportional_millionths': 10},
+            },
+            'funding': {'local_funds_msat': 1000000000, 'remote_funds_msat': 0,
+                        'pushed_msat': 0},
+            'to_us_msat': 1000000000, 'min_to_us_msat': 0,
+            'max_to_us_msat': 1000000000, 'total_msat': 1000000000,
+            'fee_base_msat': 1, 'fee_proportional_millionths': 10,
+            'dust_limit_msat': 546000, 'max_total_htlc_in_msat': 2 ** 64 - 1,
+            'their_reserve_msat': 10000000, 'our_reserve_msat': 10000000,
+            'spendable_msat': 979000000, 'receivable_msat': 0,
+            'minimum_htlc_in_msat': 0, 'minimum_htlc_out_msat': 0,
+            'maximum_htlc_out_msat': 990000000,
+            'in_offered_msat': 0, 'in_fulfilled_msat': 0,
+            'out_offered_msat': 0, 'out_fulfilled_msat': 0,
+            'htlcs': [htlc(j) for j in range(num_htlcs)],
+        }
+
+    return json.dumps({'channels': [channel(i) for i in range(num_channels)]})
+
+
+@pytest.fixture(scope="module")
+def listpeerchannels_json():
+    return listpeerchannels()
+
+
+def test_decode_listpeerchannels(benchmark, listpeerchannels_json):
+    decoder = LightningRpc.LightningJSONDecoder()
+    benchmark(decoder.decode, listpeerchannels_json)
+
+
+def test_decode_listpeerchannels_recursive(benchmark, listpeerchannels_json):
+    """The way we used to convert amounts: re-walking each object's
+    children with replace_amounts. For comparison with the above."""
+    replace_amounts = LightningRpc.LightningJSONDecoder.replace_amounts
+    decoder = json.JSONDecoder(object_hook=replace_amounts)
+    benchmark(decoder.decode, listpeerchannels_json)
+
+
+@pytest.fixture(scope="module")
+def listforwards_json():
+    return json.dumps({'forwards': [{
+        'created_index': i, 'in_channel': '%dx1x0' % i, 'in_htlc_id': i,
+        'out_channel': '%dx1x1' % i, 'out_htlc_id': i,
+        'in_msat': 1001000 + i, 'out_msat': 1000000 + i, 'fee_msat': 1000,
+        'status': 'settled', 'style': 'tlv', 'received_time': 1700000000.0,
+        'resolved_time': 1700000001.0,
+    } for i in range(100000)]})
+
+
+@pytest.mark.parametrize("msat_mode", ['object', 'int', 'lazy'])
+def test_decode_listforwards(benchmark, listforwards_json, msat_mode):
+    decoder = LightningRpc.LightningJSONDecoder(msat_mode=msat_mode)
+    benchmark(decoder.decode, listforwards_json)
+
+
+backends = ['json'] + (['orjson'] if orjson is not None else [])
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_codec_loads_listpeerchannels(benchmark, listpeerchannels_json, backend):
+    codec = get_codec(backend, LightningRpc.LightningJSONEncoder,
+                      LightningRpc.LightningJSONDecoder())
+    benchmark(codec.loads, listpeerchannels_json.encode('UTF-8'))
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_codec_dumps_listpeerchannels(benchmark, listpeerchannels_json, backend):
+    """Encoding a large result, as a plugin replying to a call would"""
+    codec = get_codec(backend, LightningRpc.LightningJSONEncoder,
+                      LightningRpc.LightningJSONDecoder())
+    obj = codec.loads(listpeerchannels_json.encode('UTF-8'))
+    benchmark(codec.dumps, obj)
+
+
+@pytest.fixture
+def plugin():
+    stdout = io.TextIOWrapper(io.BytesIO())
+    return Plugin(stdout=stdout, autopatch=False)
+
+
+def test_dispatch_notifications(benchmark, plugin):
+    """Notifications per second: a forward_event subscription"""
+    received = []
+
+    @plugin.subscribe("forward_event")
+    def on_forward_event(forward_event, plugin, **kwargs):
+        received.append(forward_event)
+
+    payload = json.dumps({'jsonrpc': '2.0', 'method': 'forward_event', 'params': {
+        'forward_event': {
+            'payment_hash': '00' * 32, 'in_channel': '103x1x0',
+            'out_channel': '110x1x0', 'in_msat': 1001000, 'out_msat': 1000000,
+            'fee_msat': 1000, 'status': 'settled', 'received_time': 1700000000.0,
+        },
+    }}).encode()
+
+    def dispatch_many():
+        for _ in range(1000):
+            plugin._dispatch_payload(payload)
+
+    benchmark(dispatch_many)
+    assert len(received) > 0
+
+
+def test_dispatch_positional(benchmark, plugin):
+    """Method calls with positional params, injections and a Millisatoshi"""
+    @plugin.method("pay")
+    def pay(request, bolt11, amount_msat: Millisatoshi = None, label=None, plugin=None):
+        return None
+
+    request = plugin._parse_request({
+        'id': 1, 'jsonrpc': '2.0', 'method': 'pay',
+        'params': ['lnbc1...', 1000, 'label'],
+    })
+
+    def exec_many():
+        for _ in range(1000):
+            plugin._exec_func(pay, request)
+
+    benchmark(exec_many)
+
+
+@pytest.mark.parametrize("debug_requests", [False, True])
+def test_dispatch_hooks(benchmark, plugin, debug_requests):
+    """Requests per second: a stream of htlc_accepted hook calls"""
+    plugin.debug_requests = debug_requests
+
+    @plugin.hook("htlc_accepted")
+    def on_htlc_accepted(onion, htlc, plugin, **kwargs):
+        return {'result': 'continue'}
+
+    payload = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'htlc_accepted', 'params': {
+        'onion': {'payload': '00' * 64, 'type': 'tlv', 'short_channel_id': '110x1x0',
+                  'forward_msat': 1000000, 'outgoing_cltv_value': 800100,
+                  'shared_secret': '00' * 32, 'next_onion': '00' * 1366},
+        'htlc': {'short_channel_id': '103x1x0', 'id': 1, 'amount_msat': 1001000,
+                 'cltv_expiry': 800150, 'cltv_expiry_relative': 150,
+                 'payment_hash': '00' * 32},
+        'forward_to': '00' * 32,
+    }}).encode()
+
+    def dispatch_many():
+        for _ in range(1000):
+            plugin._dispatch_payload(payload)
+
+    benchmark(dispatch_many)
+
+
+def importtime(statement):
+    """Run `statement` in a fresh interpreter, with `-X importtime`.
+
+    Returns the cumulative import time of each top-level import, in
+    microseconds.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                         env=env, stderr=subprocess.PIPE, check=True).stderr
+    times = {}
+    for line in out.decode().splitlines():
+        _, cumulative, name = line.split('|')
+        # Nested imports are indented, and counted in their parent's.
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("statement", [
+    "import pyln.client",
+    "from pyln.client import Plugin; Plugin(autopatch=False)",
+    "from pyln.client import Gossmap",
+])
+def test_startup(benchmark, statement):
+    """Time for a plugin's interpreter to get to `statement`"""
+    times = benchmark.pedantic(importtime, args=(statement,), rounds=5)
+    benchmark.extra_info['import_us'] = sum(times.values())
+    benchmark.extra_info['pyln.client_us'] = times.get('pyln.client')
+
+
+def gossip_store(num_channels=100000, num_nodes=15000):
+    """A synthetic gossip_store: channels between random nodes, each
+    with its capacity, both channel_updates, and node announcements."""
+    import random
+    import struct
+    rnd = random.Random(42)
+    node_ids = sorted(b'\x02' + rnd.randbytes(32) for _ in range(num_nodes))
+
+    def record(msg):
+        return struct.pack('>HHII', 0, len(msg), 0, 1700000000) + msg
+
+    out = [b'\x0c']
+    for i in range(num_channels):
+        n1, n2 = sorted(rnd.sample(node_ids, 2))
+        scid = (700000 + i // 1000) << 40 | (i % 1000) << 16 | 1
+        out.append(record(
+            struct.pack('>H', 256) + bytes(256) + struct.pack('>H', 2) + b'\x01\x00'
+            + bytes(32) + struct.pack('>Q', scid) + n1 + n2 + b'\x02' * 33 + b'\x03' * 33))
+        out.append(record(struct.pack('>HQ', 4101, rnd.randrange(10**5, 10**8))))
+        for direction in (0, 1):
+            out.append(record(
+                struct.pack('>H', 258) + bytes(64) + bytes(32)
+                + struct.pack('>QIBBHQIIQ', scid, 1700000000 + i, 1, direction,
+                              rnd.choice([18, 40, 144]), 1000, rnd.randrange(2000),
+                              rnd.randrange(5000), 990000000)))
+    for node_id in node_ids:
+        addresses = b'\x01' + rnd.randbytes(4) + struct.pack('>H', 9735)
+        out.append(record(
+            struct.pack('>H', 257) + bytes(64) + struct.pack('>H', 3) + b'\x08\xa0\x00'
+            + struct.pack('>I', 1700000000) + node_id + b'\x01\x02\x03'
+            + b'node'.ljust(32, b'\x00') + struct.pack('>H', len(addresses)) + addresses))
+    return b''.join(out)
+
+
+@pytest.fixture(scope="module")
+def gossip_store_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp("gossmap") / "gossip_store"
+    path.write_bytes(gossip_store())
+    return str(path)
+
+
+def test_gossmap_load(benchmark, gossip_store_file):
+    """Loading a mainnet sized gossip_store"""
+    g = benchmark.pedantic(Gossmap, args=(gossip_store_file,), rounds=3)
+    assert len(g.channels) == 100000
+
+
+def test_gossmap_memory(benchmark, gossip_store_file):
+    """Peak memory (tracemalloc) for loading a mainnet sized gossip_store"""
+    import tracemalloc
+
+    def load():
+        tracemalloc.start()
+        try:
+            g = Gossmap(gossip_store_file)
+            return g, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    g, peak = benchmark.pedantic(load, rounds=1)
+    benchmark.extra_info['peak_bytes'] = peak
+    benchmark.extra_info['peak_bytes_per_channel'] = peak // len(g.channels)
+
+
+@pytest.fixture(scope="module")
+def gossmap(gossip_store_file):
+    return Gossmap(gossip_store_file)
+
+
+def test_gossmap_columns(benchmark, gossmap):
+    """Building the columnar view of a mainnet sized gossmap"""
+    cols = benchmark.pedantic(GossmapColumns, args=(gossmap,), rounds=3)
+    assert len(cols.halfchannels) == 200000
+
+
+@pytest.mark.parametrize("columns", [False, True])
+def test_gossmap_stats(benchmark, gossmap, columns):
+    """A few GossmapStats filters and quantiles, on the objects or the columns"""
+    stats = GossmapStats(gossmap)
+    channels = None if columns else list(gossmap.channels.values())
+    gossmap.columns()
+
+    def run():
+        return (stats.filter_halfchannels_fee_ppm(1000, operator.ge, channels),
+                stats.filter_channels_capacity(1000000, operator.ge, channels),
+                stats.filter_channels_unidirectional(channels),
+                stats.quantiles_halfchannels_fee_base(10, channels))
+
+    benchmark(run)
+
+
+def test_gossmap_refresh(benchmark, gossmap):
+    """Refreshing a mainnet sized gossmap when nothing changed"""
+    changes = benchmark(gossmap.refresh)
+    assert not changes
@@ -1,7 +1,12 @@
-from pyln.client import Gossmap, GossmapNode, GossmapNodeId
+from pyln.client import Gossmap, GossmapColumns, GossmapNode, GossmapNodeId, GossmapStats, LnFeatureBits
+from pyln.proto import ShortChannelId
 
-import os.path
 import lzma
+import operator
+import os
+import os.path
+import pytest
+import struct
 
 
 def unxz_data_tmp(src, tmp_path, dst, wmode):
@@ -48,6 +53,13 @@ def test_gossmap(tmp_path):
     assert g.get_channel("686386x1093x1") is None
     assert channel2.satoshis == 3000000
 
+    # Fields are decoded from the store on demand.
+    for c in g.channels.values():
+        assert c.fields['short_channel_id'] == c.scid.to_int()
+        assert c.fields['node_id_1'] == c.node1.node_id.nodeid
+        assert c.fields['node_id_2'] == c.node2.node_id.nodeid
+        assert c.features == int.from_bytes(bytes(c.fields['features']), 'big')
+
 
 def test_gossmap_halfchannel(tmp_path):
     """ this test a simple [l1->l2] gossip store that was created by the pyln-testing framework """
@@ -68,6 +80,9 @@ def test_gossmap_halfchannel(tmp_path):
     assert chan
     assert chan.node1 == n1
     assert chan.node2 == n2
+    assert chan.is_private
+    assert chan.fields['short_channel_id'] == chan.scid.to_int()
+    assert chan.fields['node_id_1'] == n1.node_id.nodeid
 
     half0 = chan.get_direction(0)
     half1 = g.get_halfchannel("103x1x1", 1)
@@ -161,6 +176,26 @@ def test_mesh(tmp_path):
 
     nodes = [g.get_node(nid) for nid in nodeids]
 
+    # Attributes read straight from the store match the decoded fields.
+    for node in nodes:
+        assert node.announced
+        assert node.timestamp == node.fields['timestamp']
+        assert node.features == int.from_bytes(bytes(node.fields['features']), 'big')
+        assert node.alias == bytes(node.fields['alias']).decode('utf-8')
+        assert node.rgb == node.fields['rgb_color']
+        assert node.addresses == node._parse_addresses(bytes(node.fields['addresses']))
+        assert repr(node) == f'GossmapNode[{node.node_id}, "{node.alias}"]'
+    for channel in g.channels.values():
+        for hc in channel.half_channels:
+            assert hc.timestamp == hc.fields['timestamp']
+            assert hc.cltv_expiry_delta == hc.fields['cltv_expiry_delta']
+            assert hc.htlc_minimum_msat == hc.fields['htlc_minimum_msat']
+            assert hc.htlc_maximum_msat == hc.fields['htlc_maximum_msat']
+            assert hc.fee_base_msat == hc.fields['fee_base_msat']
+            assert hc.fee_proportional_millionths == hc.fields['fee_proportional_millionths']
+            assert hc.disabled == (hc.fields['channel_flags'] & 2 != 0)
+            assert hc.direction == hc.fields['channel_flags'] & 1
+
     # check all nodes are there
     for nodeid in nodeids:
         node = g.get_node(nodeid)
@@ -294,3 +329,321 @@ def test_mesh(tmp_path):
     for d in range(4, 6):
         result = g.get_neighbors_hc(destination=nodeids[8], depth=d)
         assert len(result) == 0
+
+
+def test_columns(tmp_path):
+    sfile = unxz_data_tmp("gossip_store-part1.xz", tmp_path, "gossip_store", "xb")
+    g = Gossmap(sfile)
+    cols = g.columns(use_numpy=False)
+    g.refresh()
+    assert g.columns() is cols
+
+    # The view is rebuilt once the store changed.
+    unxz_data_tmp("gossip_store-part2.xz", tmp_path, "gossip_store", "ab")
+    g.refresh()
+    assert g._columns is None
+    cols = g.columns(use_numpy=False)
+
+    assert cols.nodes == list(g.nodes.values())
+    assert cols.channels == list(g.channels.values())
+    for i, c in enumerate(cols.channels):
+        assert cols.channel_index[c.scid] == i
+        assert cols.node_ids[cols.node1[i]] == c.node1.node_id
+        assert cols.node_ids[cols.node2[i]] == c.node2.node_id
+        for direction in (0, 1):
+            j = direction * len(cols.channels) + i
+            hc = c.half_channels[direction]
+            assert cols.halfchannels[j] is hc
+            assert cols.channel[j] == i
+            assert cols.present[j] == (hc is not None)
+            if hc is not None:
+                assert cols.fee_base_msat[j] == hc.fee_base_msat
+                assert cols.cltv_expiry_delta[j] == hc.cltv_expiry_delta
+                assert cols.htlc_maximum_msat[j] == (hc.htlc_maximum_msat or 0)
+
+    # The CSR adjacency has every half channel once, under its source.
+    seen = []
+    for n, node in enumerate(cols.nodes):
+        for j in cols.outgoing(n):
+            assert cols.halfchannels[j].source is node
+            seen.append(j)
+    assert sorted(seen) == [j for j, p in enumerate(cols.present) if p]
+
+    # Stats on the whole map use the columns, with explicit nodes or
+    # channels they use the objects: they must agree.
+    stats = GossmapStats(g)
+    nodes = list(g.nodes.values())
+    channels = list(g.channels.values())
+    for name in ('filter_nodes_ratelimited', 'filter_nodes_unannounced'):
+        assert getattr(stats, name)() == getattr(stats, name)(nodes=nodes)
+    for bit in (LnFeatureBits.OPTION_DATA_LOSS_PROTECT, LnFeatureBits.BASIC_MPP, 100):
+        for name in ('filter_nodes_feature', 'filter_nodes_feature_compulsory', 'filter_nodes_feature_optional'):
+            assert getattr(stats, name)(bit) == getattr(stats, name)(bit, nodes=nodes)
+        for name in ('filter_channels_feature', 'filter_channels_feature_compulsory', 'filter_channels_feature_optional'):
+            assert getattr(stats, name)(bit) == getattr(stats, name)(bit, channels=channels)
+    for op in (operator.ge, operator.lt):
+        assert stats.filter_nodes_channel_count(2, op) == stats.filter_nodes_channel_count(2, op, nodes=nodes)
+        assert stats.filter_channels_capacity(1000000, op) == stats.filter_channels_capacity(1000000, op, channels=channels)
+        assert stats.filter_halfchannels_fee_base(1000, op) == stats.filter_halfchannels_fee_base(1000, op, channels=channels)
+        assert stats.filter_halfchannels_fee_ppm(100, op) == stats.filter_halfchannels_fee_ppm(100, op, channels=channels)
+    for name in ('filter_channels_unidirectional', 'filter_channels_nosatoshis',
+                 'filter_channels_disabled_bidirectional', 'filter_channels_disabled_unidirectional',
+                 'filter_halfchannels_disabled', 'filter_halfchannels_ratelimited'):
+        assert getattr(stats, name)() == getattr(stats, name)(channels=channels)
+    assert stats.quantiles_nodes_channel_count(10) == stats.quantiles_nodes_channel_count(10, nodes=nodes)
+    for name in ('quantiles_channels_capacity', 'quantiles_halfchannels_fee_base', 'quantiles_halfchannels_fee_ppm'):
+        assert getattr(stats, name)(10) == getattr(stats, name)(10, channels=channels)
+    assert len(stats.filter_channels_unidirectional()) > 0
+
+
+def test_columns_numpy(tmp_path):
+    """The NumPy columns and helpers give the same results as array.array"""
+    numpy = pytest.importorskip('numpy')
+    sfile = unxz_data_tmp("gossip_store-part1.xz", tmp_path, "gossip_store", "xb")
+    unxz_data_tmp("gossip_store-part2.xz", tmp_path, "gossip_store", "ab")
+    g = Gossmap(sfile)
+    np = GossmapColumns(g, use_numpy=True)
+    ar = GossmapColumns(g, use_numpy=False)
+    assert np.use_numpy and not ar.use_numpy
+
+    for name in ('node_announced', 'node_features', 'node_channel_count', 'node_ratelimit',
+                 'node1', 'node2', 'capacity_sat', 'has_capacity', 'channel_features',
+                 'present', 'channel', 'source', 'destination', 'fee_base_msat',
+                 'fee_proportional_millionths', 'cltv_expiry_delta', 'htlc_minimum_msat',
+                 'htlc_maximum_msat', 'disabled', 'ratelimit', 'indptr', 'indices'):
+        col = getattr(np, name)
+        assert isinstance(col, numpy.ndarray)
+        assert col.tolist() == list(getattr(ar, name))
+
+    for cols in (np, ar):
+        assert [list(cols.outgoing(n)) for n in range(len(cols.nodes))] == \
+            [list(ar.outgoing(n)) for n in range(len(ar.nodes))]
+    for op, value in ((operator.le, 10), (operator.ge, 1000)):
+        masks = [cols.compare(cols.fee_proportional_millionths, op, value) for cols in (np, ar)]
+        assert np.select(np.halfchannels, masks[0]) == ar.select(ar.halfchannels, masks[1])
+        masks = [cols.all_of(cols.present, cols.negate(m)) for cols, m in zip((np, ar), masks)]
+        assert np.select(np.halfchannels, masks[0]) == ar.select(ar.halfchannels, masks[1])
+        assert np.values(np.fee_base_msat, masks[0]) == ar.values(ar.fee_base_msat, masks[1])
+    for bits in (3 << LnFeatureBits.OPTION_STATIC_REMOTEKEY, 1 << 63):
+        assert np.select(np.channels, np.any_bits(np.channel_features, bits)) == \
+            ar.select(ar.channels, ar.any_bits(ar.channel_features, bits))
+        assert np.select(np.nodes, np.any_bits(np.node_features, bits)) == \
+            ar.select(ar.nodes, ar.any_bits(ar.node_features, bits))
+    assert np.values(np.capacity_sat) == ar.values(ar.capacity_sat)
+
+    # And so do the stats using them.
+    assert g.columns(use_numpy=True).use_numpy
+    stats = GossmapStats(g)
+    channels = list(g.channels.values())
+    for name in ('filter_channels_unidirectional', 'filter_channels_disabled_unidirectional',
+                 'filter_halfchannels_disabled', 'filter_halfchannels_ratelimited'):
+        assert getattr(stats, name)() == getattr(stats, name)(channels=channels)
+    for op in (operator.ge, operator.lt):
+        assert stats.filter_channels_capacity(1000000, op) == stats.filter_channels_capacity(1000000, op, channels=channels)
+        assert stats.filter_halfchannels_fee_ppm(100, op) == stats.filter_halfchannels_fee_ppm(100, op, channels=channels)
+    assert stats.quantiles_halfchannels_fee_base(10) == stats.quantiles_halfchannels_fee_base(10, channels=channels)
+
+    # Any other op is called for each element.
+    nodes = list(g.nodes.values())
+    for op in (lambda a, b: a >= b and a < 10, operator.is_):
+        assert stats.filter_nodes_channel_count(2, op) == stats.filter_nodes_channel_count(2, op, nodes=nodes)
+        assert stats.filter_channels_capacity(1000000, op) == stats.filter_channels_capacity(1000000, op, channels=channels)
+    assert len(stats.filter_nodes_channel_count(2, lambda a, b: a >= b and a < 10)) > 0
+
+
+def store_records(sfile):
+    """(offset, flags, type) of the records in a gossip_store"""
+    with open(sfile, "rb") as f:
+        buf = f.read()
+    records = []
+    pos = 1
+    while pos < len(buf):
+        flags, length = struct.unpack_from(">HH", buf, pos)
+        rectype, = struct.unpack_from(">H", buf, pos + 12)
+        records.append((pos, flags, rectype))
+        pos += 12 + length
+    return records
+
+
+def set_flags(sfile, pos, flags):
+    with open(sfile, "r+b") as f:
+        f.seek(pos)
+        f.write(struct.pack(">H", flags))
+
+
+def mark_channel(sfile, channel, flag):
+    """Mark a channel_announcement and its amount, as gossipd does"""
+    records = store_records(sfile)
+    i = next(i for i, r in enumerate(records) if r[0] == channel.hdr.pos)
+    for pos, flags, rectype in records[i:i + 2]:
+        if rectype in (256, 4101, 4104):
+            set_flags(sfile, pos, flag | flags)
+
+
+def assert_same_map(g, sfile):
+    g2 = Gossmap(sfile)
+    assert set(g.channels.keys()) == set(g2.channels.keys())
+    assert set(g.nodes.keys()) == set(g2.nodes.keys())
+    for scid, c in g.channels.items():
+        c2 = g2.channels[scid]
+        assert c.satoshis == c2.satoshis
+        assert c.fields == c2.fields
+        for hc, hc2 in zip(c.half_channels, c2.half_channels):
+            assert (hc is None) == (hc2 is None)
+            if hc is not None:
+                assert hc.fields == hc2.fields
+    for node_id, n in g.nodes.items():
+        n2 = g2.nodes[node_id]
+        assert n.announced == n2.announced
+        assert n.fields == n2.fields
+        assert sorted(str(c.scid) for c in n.channels) == sorted(str(c.scid) for c in n2.channels)
+
+
+def test_refresh_changes(tmp_path):
+    sfile = unxz_data_tmp("gossip_store-part1.xz", tmp_path, "gossip_store", "xb")
+    g = Gossmap(sfile)
+    channels = set(g.channels.keys())
+    nodes = set(g.nodes.keys())
+
+    changes = g.refresh()
+    assert not changes
+
+    unxz_data_tmp("gossip_store-part2.xz", tmp_path, "gossip_store", "ab")
+    changes = g.refresh()
+    assert changes
+    assert not changes.reopened
+    # This one is added then deleted, so did not change for us.
+    deleted = ShortChannelId.from_str("686386x1093x1")
+    assert deleted not in changes.added_channels | changes.removed_channels
+    assert changes.added_channels == set(g.channels.keys()) - channels
+    assert changes.removed_channels == channels - set(g.channels.keys())
+    assert changes.added_nodes == set(g.nodes.keys()) - nodes
+    assert changes.removed_nodes == nodes - set(g.nodes.keys())
+    assert changes.updated_channels <= channels & set(g.channels.keys())
+    assert changes.updated_nodes <= nodes & set(g.nodes.keys())
+    assert_same_map(g, sfile)
+
+
+def test_refresh_deleted(tmp_path):
+    """gossipd marks records deleted when it appends what replaces them"""
+    sfile = unxz_data_tmp("gossip_store.mesh-3x3.xz", tmp_path, "gossip_store", "xb")
+    g = Gossmap(sfile)
+
+    # A newer channel_update for one of the half channels of a channel,
+    # and another channel deleted.
+    hc = next(hc for c in g.channels.values() for hc in c.half_channels
+              if hc is not None and hc.hdr.off == hc.hdr.pos + 12)
+    channel = next(c for c in g.channels.values() if c is not hc.channel)
+    with open(sfile, "rb") as f:
+        f.seek(hc.hdr.pos)
+        rec = bytearray(f.read(12 + hc.hdr.length))
+    struct.pack_into(">I", rec, 12 + 2 + 64 + 32 + 8, hc.timestamp + 1)
+    set_flags(sfile, hc.hdr.pos, 0x8000 | hc.hdr.flags)
+    mark_channel(sfile, channel, 0x8000)
+    with open(sfile, "ab") as f:
+        f.write(rec)
+        f.write(struct.pack(">HHII", 0, 10, 0, 0) + struct.pack(">HQ", 4103, channel.scid.to_int()))
+
+    changes = g.refresh()
+    assert changes.removed_channels == {channel.scid}
+    assert changes.updated_channels == {hc.channel.scid}
+    assert hc.channel.half_channels[hc.direction].timestamp == hc.timestamp + 1
+    assert_same_map(g, sfile)
+    assert not g.refresh()
+
+    # Records only marked in place, as zombies, are dropped on the next
+    # rewrite of the store.
+    other = next(c for c in g.channels.values() if c is not hc.channel)
+    mark_channel(sfile, other, 0x1000)
+    assert not g.refresh()
+    assert other.scid in g.channels
+    compact(sfile, tmp_path)
+    changes = g.refresh()
+    assert changes.reopened
+    assert changes.removed_channels == {other.scid}
+    assert_same_map(g, sfile)
+
+
+def compact(sfile, tmp_path):
+    """Rewrite the store as gossipd does, without its deleted records"""
+    with open(sfile, "rb") as f:
+        buf = f.read()
+    new = bytearray(buf[0:1])
+    for pos, flags, rectype in store_records(sfile):
+        length, = struct.unpack_from(">H", buf, pos + 2)
+        if flags & 0x9000 == 0:
+            new += buf[pos:pos + 12 + length]
+    tmpfile = os.path.join(tmp_path, "gossip_store.tmp")
+    with open(tmpfile, "wb") as f:
+        f.write(new)
+    old = open(sfile, "ab")
+    os.rename(tmpfile, sfile)
+    old.write(struct.pack(">HHII", 0, 10, 0, 0) + struct.pack(">HQ", 4105, len(new)))
+    old.close()
+
+
+def test_refresh_reopen(tmp_path):
+    sfile = unxz_data_tmp("gossip_store-part1.xz", tmp_path, "gossip_store", "xb")
+    unxz_data_tmp("gossip_store-part2.xz", tmp_path, "gossip_store", "ab")
+    g = Gossmap(sfile)
+    old_store = g.store_file
+
+    # A channel deleted between our last refresh and the compaction.
+    c = next(iter(g.channels.values()))
+    mark_channel(sfile, c, 0x8000)
+    compact(sfile, tmp_path)
+
+    changes = g.refresh()
+    assert changes.reopened
+    assert changes.removed_channels == {c.scid}
+    assert not changes.added_channels
+    assert not changes.updated_channels
+    assert old_store.closed
+    assert g.bytes_read == os.path.getsize(sfile)
+    # Everything now points into the new store.
+    for channel in g.channels.values():
+        assert channel._store is g._store
+        for hc in channel.half_channels:
+            assert hc is None or hc._store is g._store
+    assert_same_map(g, sfile)
+
+    # And we keep following it.
+    with open(sfile, "ab") as f:
+        f.write(struct.pack(">HHII", 0, 10, 0, 0) + struct.pack(">HQ", 4103, c.scid.to_int()))
+    assert not g.refresh()
+    other = next(iter(g.channels.values()))
+    with open(sfile, "ab") as f:
+        f.write(struct.pack(">HHII", 0, 10, 0, 0) + struct.pack(">HQ", 4103, other.scid.to_int()))
+    changes = g.refresh()
+    assert changes.removed_channels == {other.scid}
+    assert_same_map(g, sfile)
+
+
+def test_node_reannounced(tmp_path):
+    """A new node_announcement replaces what was decoded from the old one"""
+    sfile = unxz_data_tmp("gossip_store.mesh-3x3.xz", tmp_path, "gossip_store", "xb")
+    g = Gossmap(sfile)
+    node = next(n for n in g.nodes.values() if n.announced)
+    old_alias, old_timestamp = node.alias, node.timestamp
+
+    with open(sfile, "rb") as f:
+        f.seek(node.hdr.pos)
+        rec = bytearray(f.read(12 + node.hdr.length))
+    flen, = struct.unpack_from(">H", rec, 12 + 2 + 64)
+    pos = 12 + 2 + 64 + 2 + flen
+    struct.pack_into(">I", rec, pos, old_timestamp + 1)
+    rec[pos + 4 + 33 + 3:pos + 4 + 33 + 3 + 32] = b'renamed'.ljust(32, b'_')
+    with open(sfile, "ab") as f:
+        f.write(rec)
+
+    changes = g.refresh()
+    assert changes.updated_nodes == {node.node_id}
+    assert node.timestamp == old_timestamp + 1
+    assert node.alias == 'renamed'.ljust(32, '_') != old_alias
+    assert node.fields['timestamp'] == old_timestamp + 1
+
+    # Same when the fields are set directly.
+    fields = dict(node.fields, alias=b'other'.ljust(32, b'_'), timestamp=old_timestamp + 2)
+    node.fields = fields
+    assert node.alias == 'other'.ljust(32, '_')
+    assert node.timestamp == old_timestamp + 2
@@ -0,0 +1,88 @@
+from pyln.client import LightningRpc, Millisatoshi
+from pyln.client.jsoncodec import JsonCodec, get_codec, orjson
+import json
+import math
+import pytest  # type: ignore
+
+
+backends = ['json']
+if orjson is not None:
+    backends.append('orjson')
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_dumps(backend):
+    codec = get_codec(backend)
+    assert codec.name == backend
+    obj = {'amount_msat': Millisatoshi(1000), 'label': 'héllo ⚡',
+           'big': 2**70, 'list': [1, None, True, 1.5]}
+    s = codec.dumps(obj)
+    assert type(s) is bytes
+    # Non-ASCII is not escaped, amounts use their to_json().
+    assert 'héllo ⚡'.encode('UTF-8') in s
+    assert json.loads(s) == {'amount_msat': '1000msat', 'label': 'héllo ⚡',
+                             'big': 2**70, 'list': [1, None, True, 1.5]}
+
+    with pytest.raises(TypeError):
+        codec.dumps({'x': object()})
+
+    # Non-finite floats are written the same way by all backends.
+    obj = {'a': [float('nan'), None], 'b': {'c': float('inf'), 'd': -float('inf')}}
+    assert codec.dumps(obj) == JsonCodec().dumps(obj)
+    assert codec.dumps(obj) == b'{"a": [NaN, null], "b": {"c": Infinity, "d": -Infinity}}'
+
+
+@pytest.mark.parametrize('backend', backends)
+@pytest.mark.parametrize('msat_mode', ['object', 'int', 'lazy'])
+def test_loads(backend, msat_mode):
+    data = json.dumps({
+        'amount_msat': 1000,
+        'nested': [{'fee_msat': '3msat', 'label': '⚡'}],
+        'big': 2**70,
+        'other': 4,
+    }).encode('UTF-8')
+
+    decoder = LightningRpc.LightningJSONDecoder(msat_mode=msat_mode)
+    expected = JsonCodec(decoder=decoder).loads(data)
+    obj = get_codec(backend, decoder=decoder).loads(memoryview(data))
+    assert obj == expected
+    assert type(obj) is type(expected)
+    assert type(obj['nested'][0]) is type(expected['nested'][0])
+    assert type(obj['nested'][0]['fee_msat']) is type(expected['nested'][0]['fee_msat'])
+    assert obj['big'] == 2**70
+
+    with pytest.raises(ValueError):
+        get_codec(backend, decoder=decoder).loads(b'{"a": ')
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_loads_plain(backend):
+    codec = get_codec(backend)
+    for data in [b'{"id": 1, "params": {"label": "\xe2\x9a\xa1"}}',
+                 b'[18446744073709551615, -9223372036854775808]',
+                 b'[18446744073709551616, "12345678901234567890123"]',
+                 b'{"a": -9223372036854775809}',
+                 b'[1.5e300, null, true]']:
+        assert codec.loads(bytearray(data)) == json.loads(data)
+    assert type(codec.loads(b'[18446744073709551616]')[0]) is int
+    assert math.isnan(codec.loads(b'[NaN]')[0])
+
+
+def test_get_codec():
+    class MyEncoder(json.JSONEncoder):
+        pass
+
+    assert get_codec(encoder_cls=MyEncoder).name == 'json'
+    assert get_codec(decoder=json.JSONDecoder(parse_float=str)).name == 'json'
+    with pytest.raises(ValueError):
+        get_codec('simdjson')
+    if orjson is not None:
+        assert get_codec().name == 'orjson'
+        with pytest.raises(ValueError):
+            get_codec('orjson', encoder_cls=MyEncoder)
+
+
+def test_no_global_patch(tmp_path):
+    LightningRpc(str(tmp_path / 'lightning-rpc'))
+    with pytest.raises(TypeError):
+        json.dumps(Millisatoshi(1))
@@ -43,3 +43,19 @@ def test_compare_int():
         assert 11.0 > Millisatoshi(10)
     with pytest.raises(AttributeError):
         assert 11.0 >= Millisatoshi(10)
+
+
+def test_fast_paths():
+    # The int and "<n>msat" shortcuts agree with the general parsing.
+    assert Millisatoshi(1234).millisatoshis == 1234
+    assert Millisatoshi("1234msat").millisatoshis == 1234
+    assert Millisatoshi("0msat").millisatoshis == 0
+    assert Millisatoshi("1234.0msat").millisatoshis == 1234
+    assert Millisatoshi(True).millisatoshis == 1
+    with pytest.raises(ValueError, match='Millisatoshi must be >= 0'):
+        Millisatoshi(-1)
+    with pytest.raises(ValueError, match='Millisatoshi must be >= 0'):
+        Millisatoshi("-1msat")
+    with pytest.raises(ValueError, match='Millisatoshi must be >= 0'):
+        Millisatoshi(1) - Millisatoshi(2)
+    assert not hasattr(Millisatoshi(1), '__dict__')
@@ -1,7 +1,15 @@
-from pyln.client import Plugin
-from pyln.client.plugin import Request, Millisatoshi, RpcException
+from pyln.client import AsyncPlugin, Plugin
+from pyln.client.plugin import PluginWriter, Request, Millisatoshi, RpcException
+import asyncio
+import io
 import itertools
+import json
+import os
 import pytest  # type: ignore
+import subprocess
+import sys
+import threading
+import time
 
 
 def test_simple_methods():
@@ -384,6 +392,27 @@ def test_bind_kwargs():
     test6(*bound.args, **bound.kwargs)
 
 
+def test_bind_plan_at_registration():
+    """Handlers' signatures are inspected when they are registered, not
+    on their first call."""
+    p = Plugin(autopatch=False)
+
+    @p.method("hello")
+    def hello(name, plugin):
+        return name
+
+    @p.subscribe("connect")
+    def on_connect(plugin, **kwargs):
+        pass
+
+    @p.hook("peer_connected")
+    def on_peer_connected(peer, plugin, **kwargs):
+        return {'result': 'continue'}
+
+    for func in (hello, on_connect, on_peer_connected):
+        assert func in p._bind_plans
+
+
 def test_argument_coercion():
     p = Plugin(autopatch=False)
 
@@ -398,7 +427,7 @@ def test_argument_coercion():
 
 
 def test_duplicate_result():
-    p = Plugin(autopatch=False)
+    p = Plugin(autopatch=False, debug_requests=True)
 
     def test1(request):
         request.set_result(1)     # MARKER1
@@ -435,3 +464,463 @@ def test_duplicate_result():
     ba = p._bind_kwargs(test4, {}, req)
     with pytest.raises(ValueError, match=r'current state is RequestState\.FINISHED(.*\n*.*)*MARKER4'):
         test4(*ba.args)
+
+    # Without debug_requests we don't know where, but still catch it.
+    p.debug_requests = False
+    req = Request(p, req_id=5, method="test1", params=[])
+    ba = p._bind_kwargs(test1, {}, req)
+    with pytest.raises(ValueError, match=r'current state is RequestState\.FINISHED\. Set plugin.debug_requests'):
+        test1(*ba.args)
+
+
+def test_run_framing(monkeypatch):
+    """Messages are dispatched however they are split across reads."""
+    monkeypatch.setenv('LIGHTNINGD_PLUGIN', '1')
+    rfd, wfd = os.pipe()
+    stdin = io.TextIOWrapper(io.BufferedReader(io.FileIO(rfd, 'r')))
+    stdout = io.TextIOWrapper(io.BytesIO())
+    p = Plugin(stdin=stdin, stdout=stdout, autopatch=False)
+
+    received = []
+
+    @p.method("test")
+    def test(blob):
+        received.append(len(blob))
+        return len(blob)
+
+    sizes = [10, 3 * 1024 * 1024, 0, 5, 70000]
+    data = b''.join(json.dumps({
+        'id': i, 'jsonrpc': '2.0', 'method': 'test', 'params': ['x' * s]
+    }).encode() + b'\n\n' for i, s in enumerate(sizes))
+
+    def writer():
+        # Odd sized writes, so the terminators straddle reads.
+        with os.fdopen(wfd, 'wb') as f:
+            for i in range(0, len(data), 65537):
+                f.write(data[i:i + 65537])
+                f.flush()
+
+    t = threading.Thread(target=writer)
+    t.start()
+    p.run()
+    t.join()
+
+    assert received == sizes
+    replies = stdout.buffer.getvalue().split(b'\n\n')[:-1]
+    assert [json.loads(r)['result'] for r in replies] == sizes
+
+
+def test_worker_pool():
+    """A slow handler doesn't hold up others, hook fallbacks still apply."""
+    stdout = io.TextIOWrapper(io.BytesIO())
+    p = Plugin(stdout=stdout, autopatch=False, max_workers=4)
+    release = threading.Event()
+
+    @p.method("slow")
+    def slow():
+        assert release.wait(10)
+        return "slow"
+
+    @p.method("fast")
+    def fast():
+        return "fast"
+
+    @p.hook("htlc_accepted")
+    def on_htlc_accepted(onion, htlc, plugin, **kwargs):
+        raise ValueError("oops")
+
+    def replies():
+        msgs = stdout.buffer.getvalue().split(b'\n\n')[:-1]
+        return [json.loads(m) for m in msgs if b'"id"' in m]
+
+    p._dispatch_payload(b'{"id": 1, "method": "slow", "params": {}}')
+    p._dispatch_payload(b'{"id": 2, "method": "fast", "params": {}}')
+    p._dispatch_payload(b'{"id": 3, "method": "htlc_accepted", "params": {"onion": {}, "htlc": {}}}')
+    while len(replies()) < 2:
+        time.sleep(0.01)
+    release.set()
+    p.executor.shutdown(wait=True)
+
+    r = replies()
+    assert [m['id'] for m in r][2] == 1
+    assert {m['id']: m['result'] for m in r} == {
+        1: 'slow', 2: 'fast', 3: {'result': 'fail', 'failure_message': '2002'}
+    }
+
+
+@pytest.mark.parametrize('ordering', ['method', 'all'])
+def test_worker_pool_ordering(ordering):
+    stdout = io.TextIOWrapper(io.BytesIO())
+    p = Plugin(stdout=stdout, autopatch=False, max_workers=4,
+               ordering=ordering)
+    calls = []
+
+    @p.method("sleep")
+    def sleep(delay):
+        time.sleep(delay)
+        calls.append(delay)
+
+    for i, delay in enumerate([0.1, 0.0, 0.05, 0.0]):
+        p._dispatch_payload(json.dumps({
+            'id': i, 'method': 'sleep', 'params': [delay]
+        }).encode())
+    p.executor.shutdown(wait=True)
+    assert calls == [0.1, 0.0, 0.05, 0.0]
+    assert p._ordered_queues == {}
+
+
+def test_async_plugin():
+    rfd, wfd = os.pipe()
+    stdin = io.TextIOWrapper(io.BufferedReader(io.FileIO(rfd, 'r')))
+    stdout = io.TextIOWrapper(io.BytesIO())
+    p = AsyncPlugin(stdin=stdin, stdout=stdout, autopatch=False)
+    released = None
+    notified = []
+
+    @p.method("wait")
+    async def wait(plugin):
+        await released.wait()
+        return "waited"
+
+    @p.method("release")
+    def release():
+        released.set()
+        return "released"
+
+    @p.hook("htlc_accepted")
+    async def on_htlc_accepted(onion, htlc, **kwargs):
+        await asyncio.sleep(0)
+        raise ValueError("oops")
+
+    @p.subscribe("connect")
+    async def on_connect(id, **kwargs):
+        await asyncio.sleep(0)
+        notified.append(id)
+
+    with os.fdopen(wfd, 'wb') as f:
+        for msg in [
+                {'id': 1, 'method': 'wait', 'params': {}},
+                {'id': 2, 'method': 'htlc_accepted', 'params': {'onion': {}, 'htlc': {}}},
+                {'method': 'connect', 'params': {'id': 'abc'}},
+                {'id': 3, 'method': 'release', 'params': []}]:
+            f.write(json.dumps(msg).encode() + b'\n\n')
+
+    async def run():
+        nonlocal released
+        released = asyncio.Event()
+        await p.run_async()
+
+    asyncio.run(run())
+
+    msgs = [json.loads(m) for m in stdout.buffer.getvalue().split(b'\n\n')[:-1]]
+    results = [(m['id'], m['result']) for m in msgs if 'id' in m]
+    # The waiting request didn't hold up the others.
+    assert results[-1] == (1, 'waited')
+    assert dict(results) == {
+        1: 'waited',
+        2: {'result': 'fail', 'failure_message': '2002'},
+        3: 'released',
+    }
+    assert notified == ['abc']
+
+
+class CountingIO(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, b):
+        self.writes += 1
+        return super().write(b)
+
+
+def test_log_buffering():
+    out = CountingIO()
+    p = Plugin(stdout=io.TextIOWrapper(out), autopatch=False,
+               log_flush_interval=10, log_buffer_size=60)
+
+    @p.method("fail")
+    def fail():
+        p.log("\n".join("line {}".format(i) for i in range(50)))
+        raise ValueError("oops")
+
+    p._dispatch_payload(b'{"id": 1, "method": "fail", "params": {}}')
+    # The logs went out in one write, together with the error.
+    assert out.writes == 1
+    msgs = [json.loads(m) for m in out.getvalue().split(b'\n\n')[:-1]]
+    assert msgs[-1]['id'] == 1
+    logs = [m['params']['message'] for m in msgs if m.get('method') == 'log']
+    assert logs == ["line {}".format(i) for i in range(50)]
+    # The traceback logged after it is pending.
+    p.flush_logs()
+    assert out.writes == 2
+    assert b'ValueError: oops' in out.getvalue()
+    assert p.logs_dropped == 0
+
+    # Overload: anything beyond the buffer size is dropped and counted.
+    p.log("\n".join("more {}".format(i) for i in range(100)), level='debug')
+    assert p.logs_dropped == 40
+    p.flush_logs()
+    assert out.writes == 3
+    msgs = [json.loads(m) for m in out.getvalue().split(b'\n\n')[:-1]]
+    assert msgs[-1]['params'] == {'level': 'warn', 'message': 'Dropped 40 log messages'}
+    assert msgs[-2]['params'] == {'level': 'debug', 'message': 'more 59'}
+
+
+def test_log_flush_interval():
+    out = CountingIO()
+    p = Plugin(stdout=io.TextIOWrapper(out), autopatch=False,
+               log_flush_interval=0.01)
+    p.log("first")
+    p.log("second")
+    assert out.writes == 0
+    for _ in range(100):
+        if out.writes:
+            break
+        time.sleep(0.01)
+    assert out.writes == 1
+    assert out.getvalue().count(b'"log"') == 2
+
+    # Unbuffered
+    p.log_flush_interval = 0
+    p.log("third")
+    assert out.writes == 2
+
+
+def test_log_flush_on_exit(monkeypatch):
+    """Buffered logs are written when `run` returns, not left to the timer"""
+    monkeypatch.setenv('LIGHTNINGD_PLUGIN', '1')
+    rfd, wfd = os.pipe()
+    os.close(wfd)
+    out = CountingIO()
+    p = Plugin(stdin=io.TextIOWrapper(io.BufferedReader(io.FileIO(rfd, 'r'))),
+               stdout=io.TextIOWrapper(out), autopatch=False,
+               log_flush_interval=3600)
+    p.log("bye")
+    assert p._log_timer.daemon
+    p.run()
+    assert out.writes == 1
+    assert p._log_timer is None
+    assert json.loads(out.getvalue())['params']['message'] == "bye"
+
+
+class SlowIO(CountingIO):
+    def write(self, b):
+        time.sleep(0.01)
+        return super().write(b)
+
+
+def test_writer():
+    out = SlowIO()
+    p = Plugin(stdout=io.TextIOWrapper(out), autopatch=False,
+               write_queue_size=5)
+
+    @p.method("echo")
+    def echo(i):
+        p.log("echo {}".format(i))
+        return i
+
+    p._start_writer()
+    for i in range(50):
+        p._dispatch_payload(json.dumps({
+            "id": i, "method": "echo", "params": [i]
+        }).encode('UTF-8'))
+    p.writer.flush()
+    stats = p.writer.stats()
+    p._stop_writer()
+
+    msgs = [json.loads(m) for m in out.getvalue().split(b'\n\n')[:-1]]
+    # Responses are written in order, logs are all there.
+    assert [m['result'] for m in msgs if 'result' in m] == list(range(50))
+    logs = [m['params']['message'] for m in msgs if m.get('method') == 'log']
+    assert logs == ["echo {}".format(i) for i in range(50)]
+
+    # Each log comes before the response of the call that logged it.
+    order = [m.get('result', m.get('params', {}).get('message')) for m in msgs]
+    for i in range(50):
+        assert order.index("echo {}".format(i)) < order.index(i)
+
+    # Queueing blocked while stdout was slow, and writes were coalesced.
+    assert stats['max_queue_depth'] == 5
+    assert stats['blocked'] > 0
+    assert stats['blocked_seconds'] > 0
+    assert stats['messages'] == 50
+    assert stats['writes'] == out.writes < 50
+    assert stats['queue_depth'] == 0
+    assert p.writer is None
+
+    # Late writes, e.g. from a worker still running at shutdown, are
+    # written out directly once the writer is closed.
+    writer = PluginWriter(p)
+    writer.close()
+    p.log("late log")
+    writer.put(b'{"late": true}\n\n')
+    msgs = [json.loads(m) for m in out.getvalue().split(b'\n\n')[:-1]]
+    assert msgs[-1] == {'late': True}
+    assert msgs[-2]['params']['message'] == "late log"
+
+
+class BlockingIO(CountingIO):
+    """Blocks writes while `release` isn't set"""
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, b):
+        self.entered.set()
+        self.release.wait()
+        return super().write(b)
+
+
+def test_writer_blocked():
+    out = BlockingIO()
+    p = Plugin(stdout=io.TextIOWrapper(out), autopatch=False)
+
+    @p.hook("htlc_accepted")
+    def on_htlc_accepted(onion, htlc, **kwargs):
+        return {'result': 'continue'}
+
+    p._start_writer()
+    p.notify("first", {})
+    assert out.entered.wait(5)
+
+    # While stdout is stuck, logging and replying doesn't block.
+    def work():
+        p.log("while blocked")
+        p.notify("second", {})
+        p._dispatch_payload(json.dumps({
+            "id": 1, "method": "htlc_accepted", "params": {"onion": {}, "htlc": {}}
+        }).encode('UTF-8'))
+
+    t = threading.Thread(target=work)
+    t.start()
+    t.join(5)
+    assert not t.is_alive()
+
+    out.release.set()
+    p._stop_writer()
+
+    msgs = [json.loads(m) for m in out.getvalue().split(b'\n\n')[:-1]]
+    # The htlc_accepted reply goes out ahead of what was queued before.
+    assert [m.get('method', m.get('id')) for m in msgs] == ['first', 1, 'log', 'second']
+    assert msgs[2]['params']['message'] == "while blocked"
+
+
+def test_lazy_imports():
+    """Plugins shouldn't pay for what they don't use at startup"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    out = subprocess.check_output([sys.executable, '-c', (
+        "import sys, pyln.client\n"
+        "from pyln.client import Plugin\n"
+        "print(' '.join(sys.modules))\n"
+    )], env=env).decode().split()
+    for module in ['asyncio', 'pyln.proto', 'pyln.spec.bolt7',
+                   'pyln.client.gossmap', 'pyln.client.async_plugin']:
+        assert module not in out
+
+    import pyln.client
+    assert pyln.client.Gossmap is pyln.client.gossmap.Gossmap
+    assert set(pyln.client.__all__) <= set(dir(pyln.client))
+    with pytest.raises(AttributeError):
+        pyln.client.NotThere
+
+
+def test_stats_method():
+    r, w = os.pipe()
+    stdin = os.fdopen(r, 'r')
+    stdout = io.BytesIO()
+    p = Plugin(stdout=io.TextIOWrapper(stdout), stdin=stdin,
+               autopatch=False, stats_method="test-stats")
+
+    @p.method("hello")
+    def say_hello(name):
+        if name is None:
+            raise ValueError("who?")
+        return "Hello {}".format(name)
+
+    @p.hook("htlc_accepted")
+    def on_htlc_accepted(onion, htlc):
+        raise ValueError("oops")
+
+    @p.subscribe("connect")
+    def on_connect(id, address):
+        pass
+
+    def call(method, params, req_id=None):
+        p._dispatch_payload(json.dumps({
+            "id": req_id, "method": method, "params": params
+        }).encode('UTF-8'))
+
+    call("hello", ["world"], 1)
+    call("hello", [None], 2)
+    call("htlc_accepted", {"onion": {}, "htlc": {}}, 3)
+    call("connect", {"id": "02aa", "address": {}})
+    os.write(w, b"{}")
+    call("test-stats", {}, 4)
+    p.flush_logs()
+
+    msgs = [json.loads(m) for m in stdout.getvalue().split(b'\n\n')[:-1]]
+    assert [m['result']['result'] for m in msgs if m.get('id') == 3] == ['fail']
+    stats = [m['result'] for m in msgs if m.get('id') == 4][0]
+
+    hello = stats['methods']['hello']
+    assert (hello['calls'], hello['errors'], hello['fallbacks']) == (2, 1, 0)
+    assert 0 < hello['latency_p50_seconds'] <= hello['latency_p99_seconds'] <= hello['latency_max_seconds']
+    htlc = stats['hooks']['htlc_accepted']
+    assert (htlc['calls'], htlc['errors'], htlc['fallbacks']) == (1, 1, 1)
+    assert stats['subscriptions']['connect']['calls'] == 1
+    assert stats['subscriptions']['connect']['errors'] == 0
+    # The stats call itself is being handled.
+    assert stats['queued_requests'] == 0
+    assert stats['stdin_pending_bytes'] == 2
+    assert stats['writer'] is None
+
+    p.handler_metrics.reset()
+    assert p.handler_metrics.to_dict()['methods'] == {}
+
+    # It is documented, so lightningd gets a description and we don't
+    # complain about the missing docstring.
+    stdout.seek(0)
+    stdout.truncate()
+    manifest = p._getmanifest()
+    method = [m for m in manifest['rpcmethods'] if m['name'] == 'test-stats'][0]
+    assert method['description'] == "Returns this plugin's handler metrics and output queue stats."
+    p.flush_logs()
+    assert b"'test-stats' does not have a docstring" not in stdout.getvalue()
+    os.close(w)
+    stdin.close()
+
+
+def test_process_method():
+    stdout = io.BytesIO()
+    p = Plugin(stdout=io.TextIOWrapper(stdout), autopatch=False,
+               max_processes=2)
+
+    @p.method("pid", process=True)
+    def pid(n, plugin):
+        plugin.log("computing in {}".format(os.getpid()))
+        if n < 0:
+            raise RpcException("negative", code=1234)
+        return {'pid': os.getpid(), 'square': n * n}
+
+    with pytest.raises(ValueError):
+        p.add_method("bg", lambda: None, background=True, process=True)
+
+    for i, n in enumerate([3, -1, 4]):
+        p._dispatch_payload(json.dumps({
+            "id": i, "method": "pid", "params": [n]
+        }).encode('UTF-8'))
+    p._process_pool.shutdown(wait=True)
+    p.flush_logs()
+
+    msgs = [json.loads(m) for m in stdout.getvalue().split(b'\n\n')[:-1]]
+    results = {m['id']: m.get('result', m.get('error')) for m in msgs if 'id' in m}
+    assert results[0]['square'] == 9
+    assert results[2]['square'] == 16
+    assert results[0]['pid'] != os.getpid()
+    assert results[1]['code'] == 1234
+    assert results[1]['message'] == "negative"
+
+    logs = [m['params']['message'] for m in msgs if m.get('method') == 'log']
+    assert "computing in {}".format(results[0]['pid']) in logs
@@ -0,0 +1,603 @@
+from concurrent.futures import ThreadPoolExecutor
+from pyln.client import (AsyncLightningRpc, AsyncPlugin, LightningRpc,
+                         Millisatoshi, RpcError, RpcMetrics)
+import asyncio
+import io
+import json
+import os
+import socket
+import threading
+import pytest  # type: ignore
+
+
+class FakeLightningd(object):
+    """A tiny JSON-RPC server that speaks just enough of the lightningd
+    protocol to exercise the client: requests are a plain stream of JSON
+    objects, responses are terminated by an empty line.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.connections = 0
+        self.requests = []
+        self.clients = []
+        self.num_forwards = 0
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            self.clients.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        decoder = json.JSONDecoder()
+        buff = ''
+        lock = threading.Lock()
+
+        def send(resp):
+            with lock:
+                conn.sendall(json.dumps(resp).encode('UTF-8') + b'\n\n')
+
+        while True:
+            try:
+                b = conn.recv(65536)
+            except OSError:
+                return
+            if not b:
+                conn.close()
+                return
+            buff += b.decode('UTF-8')
+            while True:
+                buff = buff.lstrip()
+                try:
+                    req, end = decoder.raw_decode(buff)
+                except ValueError:
+                    break
+                buff = buff[end:]
+                self.requests.append(req)
+                if req['method'] == 'slow':
+                    # Answer from another thread, so slow calls on the same
+                    # connection overlap and may complete out of order.
+                    resp = {'jsonrpc': '2.0', 'id': req['id'], 'result': req['params']}
+                    threading.Timer(req['params']['delay'], send, args=(resp,)).start()
+                    continue
+                for resp in self.handle(req):
+                    send(resp)
+
+    def handle(self, req):
+        method, params = req['method'], req['params']
+        if method == 'notifications':
+            return [{'jsonrpc': '2.0', 'id': req['id'], 'result': {}}]
+        if method == 'echo':
+            return [{'jsonrpc': '2.0', 'id': req['id'], 'result': params}]
+        if method == 'listforwards':
+            forwards = [{'created_index': i, 'in_msat': i} for i in range(1, self.num_forwards + 1)]
+            if 'start' in params:
+                forwards = [f for f in forwards if f['created_index'] >= params['start']]
+            if 'limit' in params:
+                forwards = forwards[:params['limit']]
+            return [{'jsonrpc': '2.0', 'id': req['id'], 'result': {'forwards': forwards}}]
+        if method == 'listpeers':
+            return [{'jsonrpc': '2.0', 'id': req['id'], 'result': {'peers': []}}]
+        if method == 'chatty':
+            return [
+                {'jsonrpc': '2.0', 'method': 'message',
+                 'params': {'id': req['id'], 'message': 'hello'}},
+                {'jsonrpc': '2.0', 'id': req['id'], 'result': {}},
+            ]
+        return [{'jsonrpc': '2.0', 'id': req['id'],
+                 'error': {'code': -32601, 'message': 'Unknown command'}}]
+
+    def drop_clients(self):
+        for c in self.clients:
+            c.shutdown(socket.SHUT_RDWR)
+        self.clients = []
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def lightningd(tmp_path):
+    path = os.path.join(str(tmp_path), "lightning-rpc")
+    server = FakeLightningd(path)
+    yield server
+    server.close()
+
+
+def test_call(lightningd):
+    rpc = LightningRpc(lightningd.path)
+    assert rpc.echo(msg='hi') == {'msg': 'hi'}
+    assert rpc.call('echo', ['a', 'b']) == ['a', 'b']
+    with pytest.raises(RpcError):
+        rpc.unknown()
+    # One connection per call
+    assert lightningd.connections == 3
+
+
+def test_metrics(lightningd):
+    metrics = RpcMetrics(buckets=(0.05, 1.0))
+    rpc = LightningRpc(lightningd.path, persistent=True, metrics=metrics)
+    rpc.echo(msg='hi')
+    rpc.slow(delay=0.1)
+    with pytest.raises(RpcError):
+        rpc.unknown()
+
+    stats = metrics.to_dict()
+    assert sorted(stats) == ['echo', 'slow', 'unknown']
+    echo = stats['echo']
+    assert echo['calls'] == 1
+    assert echo['errors'] == {}
+    assert echo['bytes_sent'] > len('{"msg": "hi"}')
+    assert echo['bytes_received'] > len('{"msg": "hi"}')
+    assert echo['latency_histogram'][-1] == (float('inf'), 1)
+
+    # We were waiting on the server, not busy decoding.
+    slow = stats['slow']
+    assert slow['wait_seconds'] >= 0.1
+    assert slow['decode_seconds'] < slow['wait_seconds']
+    assert slow['latency_seconds'] >= slow['wait_seconds']
+    assert slow['latency_histogram'] == [(0.05, 0), (1.0, 1), (float('inf'), 1)]
+    assert stats['unknown']['errors'] == {'RpcError': 1}
+
+    text = metrics.to_prometheus()
+    assert '# TYPE pyln_rpc_call_duration_seconds histogram' in text
+    assert 'pyln_rpc_call_duration_seconds_bucket{method="slow",le="0.05"} 0' in text
+    assert 'pyln_rpc_call_duration_seconds_bucket{method="slow",le="+Inf"} 1' in text
+    assert 'pyln_rpc_call_duration_seconds_count{method="echo"} 1' in text
+    assert 'pyln_rpc_errors_total{method="unknown",error="RpcError"} 1' in text
+
+    metrics.reset()
+    assert metrics.to_dict() == {}
+
+
+def test_persistent(lightningd):
+    rpc = LightningRpc(lightningd.path, persistent=True)
+    for i in range(10):
+        assert rpc.echo(i=i) == {'i': i}
+    assert lightningd.connections == 1
+
+    # Errors are just responses, they don't break the connection.
+    with pytest.raises(RpcError):
+        rpc.unknown()
+    assert rpc.echo(i=11) == {'i': 11}
+    assert lightningd.connections == 1
+
+    rpc.close_connections()
+    assert rpc.echo(i=12) == {'i': 12}
+    assert lightningd.connections == 2
+
+
+def test_persistent_reconnect(lightningd):
+    rpc = LightningRpc(lightningd.path, persistent=True)
+    assert rpc.echo(i=1) == {'i': 1}
+
+    # Server hangs up on us while idle, we just reconnect.
+    lightningd.drop_clients()
+    assert rpc.echo(i=2) == {'i': 2}
+    assert lightningd.connections == 2
+
+
+def test_persistent_notifications(lightningd):
+    rpc = LightningRpc(lightningd.path, persistent=True)
+    messages = []
+
+    def fn(message, progress, request, **kwargs):
+        messages.append(message)
+
+    with rpc.notify(fn):
+        rpc.chatty()
+        rpc.chatty()
+    assert messages == ['hello', 'hello']
+
+    # Notifications are only enabled once per connection.
+    enables = [r for r in lightningd.requests if r['method'] == 'notifications']
+    assert len(enables) == 1
+
+    # Once enabled, notifications without a callback are skipped.
+    assert rpc.chatty() == {}
+    assert messages == ['hello', 'hello']
+    assert lightningd.connections == 1
+
+
+def test_concurrent_pool(lightningd):
+    rpc = LightningRpc(lightningd.path, persistent=True, pool_size=4)
+
+    def work(i):
+        return rpc.slow(i=i, delay=0.05)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(work, range(40)))
+    assert results == [{'i': i, 'delay': 0.05} for i in range(40)]
+
+    # Calls ran in parallel, but sockets were reused
+    assert 1 < lightningd.connections <= 4
+    assert len(rpc._idle_conns) <= 4
+
+    # Every request got a unique id
+    ids = [r['id'] for r in lightningd.requests]
+    assert len(ids) == len(set(ids))
+
+
+def test_cmdprefix_per_thread(lightningd):
+    rpc = LightningRpc(lightningd.path)
+    rpc.cmdprefix = "main"
+    seen = []
+
+    def work():
+        seen.append(rpc.cmdprefix)
+        rpc.cmdprefix = "worker"
+        rpc.echo()
+
+    t = threading.Thread(target=work)
+    t.start()
+    t.join()
+    assert seen == [None]
+    assert rpc.cmdprefix == "main"
+    rpc.echo()
+
+    prefixes = [r['id'].split('/')[0] for r in lightningd.requests]
+    assert prefixes == ["worker", "main"]
+
+
+def test_async(lightningd):
+    async def run():
+        async with AsyncLightningRpc(lightningd.path) as rpc:
+            assert await rpc.echo(msg='hi') == {'msg': 'hi'}
+            # The documented LightningRpc methods work too.
+            assert await rpc.listpeers() == {'peers': []}
+            assert await rpc.getpeer('02' * 33) is None
+            with pytest.raises(RpcError):
+                await rpc.unknown()
+
+            # Many requests in flight over one socket, answered out of
+            # order.
+            delays = [0.1, 0.05, 0.0, 0.08, 0.02]
+            results = await asyncio.gather(*[
+                rpc.slow(i=i, delay=d) for i, d in enumerate(delays)
+            ])
+            assert results == [{'i': i, 'delay': d} for i, d in enumerate(delays)]
+        assert lightningd.connections == 1
+
+    asyncio.run(run())
+
+
+def test_async_loops(lightningd):
+    """A client can be used from one event loop after the other"""
+    rpc = AsyncLightningRpc(lightningd.path)
+
+    async def run(n):
+        # Concurrent first calls contend for the connection.
+        return await asyncio.gather(*[rpc.echo(i=i) for i in range(n)])
+
+    assert asyncio.run(run(3)) == [{'i': i} for i in range(3)]
+    assert asyncio.run(run(3)) == [{'i': i} for i in range(3)]
+
+    async def closing():
+        async with rpc:
+            return await run(2)
+
+    assert asyncio.run(closing()) == [{'i': i} for i in range(2)]
+    assert asyncio.run(closing()) == [{'i': i} for i in range(2)]
+
+    # Switching loops closes the connection of the previous one, even
+    # if that loop is still around.
+    loops = [asyncio.new_event_loop() for _ in range(3)]
+    conns = []
+    for loop in loops:
+        assert loop.run_until_complete(rpc.echo(i=1)) == {'i': 1}
+        conns.append(rpc._conn)
+    assert [c.sock.fileno() for c in conns[:-1]] == [-1, -1]
+    loops[-1].run_until_complete(rpc.close_connections())
+    for loop in loops:
+        loop.close()
+
+
+def test_async_notify_filter(lightningd):
+    rpc = AsyncLightningRpc(lightningd.path)
+    messages = []
+
+    def fn(message, progress, request, **kwargs):
+        messages.append((message, request['id']))
+
+    async def with_notify():
+        with rpc.notify(fn), rpc.reply_filter({'x': True}):
+            return await rpc.chatty()
+
+    async def run():
+        await asyncio.gather(with_notify(), rpc.chatty())
+        await rpc.close_connections()
+
+    asyncio.run(run())
+
+    # Only the call made within the context got the notification and filter.
+    chatty = [r for r in lightningd.requests if r['method'] == 'chatty']
+    assert len(chatty) == 2
+    filtered = [r for r in chatty if 'filter' in r]
+    assert len(filtered) == 1
+    assert messages == [('hello', filtered[0]['id'])]
+
+
+def test_async_notify_raises(lightningd):
+    """A failing notification callback doesn't fail the other calls"""
+    rpc = AsyncLightningRpc(lightningd.path)
+
+    def fn(message, progress, request, **kwargs):
+        raise ValueError("oops")
+
+    async def with_notify():
+        with rpc.notify(fn):
+            return await rpc.chatty()
+
+    async def run():
+        async with rpc:
+            return await asyncio.gather(with_notify(), rpc.slow(i=1, delay=0.1))
+
+    assert asyncio.run(run()) == [{}, {'i': 1, 'delay': 0.1}]
+    assert lightningd.connections == 1
+
+
+def test_call_many(lightningd):
+    rpc = LightningRpc(lightningd.path, persistent=True)
+    calls = [('echo', {'i': i}) for i in range(500)]
+    calls[10] = ('unknown', {'i': 10})
+    results = rpc.call_many(calls)
+
+    assert len(results) == 500
+    assert isinstance(results[10], RpcError)
+    assert results[10].method == 'unknown'
+    assert results[10].error['code'] == -32601
+    for i, r in enumerate(results):
+        if i != 10:
+            assert r == {'i': i}
+    assert lightningd.connections == 1
+
+    # Big enough that neither side can buffer the whole batch: we must
+    # read responses while still writing requests.
+    blob = 'x' * 4096
+    results = rpc.call_many([('echo', [blob, i]) for i in range(1000)])
+    assert results == [[blob, i] for i in range(1000)]
+    assert lightningd.connections == 1
+
+    # Requests and responses each larger than the socket buffers, and a
+    # server which writes each response in full before reading on: we
+    # must never block on a partial send.
+    blob = 'x' * (1 << 20)
+    # With a small send buffer, "writable" leaves room for much less
+    # than a 64kB chunk.
+    sock = rpc._idle_conns[0].sock.sock
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    done = []
+    t = threading.Thread(target=lambda: done.append(rpc.call_many([('echo', [blob, i]) for i in range(16)])),
+                         daemon=True)
+    t.start()
+    t.join(30)
+    assert done and done[0] == [[blob, i] for i in range(16)]
+    assert rpc.call('echo', {'after': True}) == {'after': True}
+
+    # Responses out of order are matched up by id.
+    results = rpc.call_many([('slow', {'delay': d}) for d in [0.1, 0.0, 0.05]])
+    assert results == [{'delay': 0.1}, {'delay': 0.0}, {'delay': 0.05}]
+
+    assert rpc.call_many([]) == []
+
+
+def test_async_call_many(lightningd):
+    async def run():
+        async with AsyncLightningRpc(lightningd.path) as rpc:
+            return await rpc.call_many([('echo', {'i': 1}), ('unknown', None)])
+
+    results = asyncio.run(run())
+    assert results[0] == {'i': 1}
+    assert isinstance(results[1], RpcError)
+
+
+class ChunkedSocket(object):
+    """Hands out its data a few bytes at a time, like a slow socket"""
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+        self.reads = []
+
+    def recv(self, length):
+        self.reads.append(length)
+        b, self.data = self.data[:self.chunk], self.data[self.chunk:]
+        return b
+
+
+def test_readobj():
+    rpc = LightningRpc("/dev/null")
+    objs = [{'id': i, 'result': {'x': 'ü' * i}} for i in range(50)]
+    data = b''.join(json.dumps(o).encode('UTF-8') + b'\n\n' for o in objs)
+
+    # Chunks of every size, including ones splitting the terminator and
+    # multi-byte characters.
+    for chunk in [1, 2, 3, 7, 64, len(data)]:
+        sock = ChunkedSocket(data, chunk)
+        buff = b''
+        for o in objs:
+            obj, buff = rpc._readobj(sock, buff)
+            assert obj == o
+        assert len(buff) == 0
+        # Read sizes don't balloon with the buffer.
+        assert max(sock.reads) <= 65536
+        obj, buff = rpc._readobj(sock, buff)
+        assert obj == {'error': 'Connection to RPC server lost.'}
+
+    # A large response is read in bounded chunks.
+    big = {'id': 1, 'result': ['x' * 100] * 100000}
+    sock = ChunkedSocket(json.dumps(big).encode('UTF-8') + b'\n\n', 65536)
+    obj, buff = rpc._readobj(sock)
+    assert obj == big
+    assert max(sock.reads) <= 65536
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_iter_forwards(lightningd, prefetch):
+    lightningd.num_forwards = 2500
+    rpc = LightningRpc(lightningd.path, persistent=True)
+    rpc.cmdprefix = "export"
+
+    forwards = rpc.iter_forwards(page_size=1000, prefetch=prefetch)
+    assert [f['created_index'] for f in forwards] == list(range(1, 2501))
+
+    pages = [r for r in lightningd.requests if r['method'] == 'listforwards']
+    assert [p['params'].get('start') for p in pages] == [None, 1001, 2001]
+    assert all(p['params']['limit'] == 1000 for p in pages)
+    assert all(p['params']['index'] == 'created' for p in pages)
+    # Prefetching happens in another thread, but uses our prefix.
+    assert all(p['id'].startswith('export/') for p in pages)
+
+    # Exact multiple of the page size needs one more (empty) page.
+    lightningd.requests = []
+    assert len(list(rpc.iter_forwards(start=501, page_size=1000, prefetch=prefetch))) == 2000
+    assert len(lightningd.requests) == 3
+
+
+def test_async_iter_forwards(lightningd):
+    lightningd.num_forwards = 250
+
+    async def run():
+        async with AsyncLightningRpc(lightningd.path) as rpc:
+            return [f['created_index'] async for f in rpc.iter_forwards(page_size=100, prefetch=True)]
+
+    assert asyncio.run(run()) == list(range(1, 251))
+
+
+def test_decoder_msat():
+    decoder = LightningRpc.LightningJSONDecoder()
+    obj = decoder.decode(json.dumps({
+        'amount_msat': 1000,
+        'lease-fee-base-msat': None,
+        'channels': [{
+            'to_us_msat': 5,
+            'htlcs': [{'amount_msat': '7msat', 'id': 1}],
+            'fees_msat': [1, 2],
+            'funding': {'local_funds_msat': 3},
+        }],
+        'not_an_amount': 1000,
+    }))
+    assert obj['amount_msat'] == Millisatoshi(1000)
+    assert isinstance(obj['amount_msat'], Millisatoshi)
+    assert obj['lease-fee-base-msat'] is None
+    chan = obj['channels'][0]
+    assert isinstance(chan['to_us_msat'], Millisatoshi)
+    assert isinstance(chan['htlcs'][0]['amount_msat'], Millisatoshi)
+    assert chan['htlcs'][0]['amount_msat'] == 7
+    assert not isinstance(chan['htlcs'][0]['id'], Millisatoshi)
+    assert all(isinstance(f, Millisatoshi) for f in chan['fees_msat'])
+    assert isinstance(chan['funding']['local_funds_msat'], Millisatoshi)
+    assert not isinstance(obj['not_an_amount'], Millisatoshi)
+
+    # Chained object_hook still gets called, after the conversion.
+    seen = []
+    decoder = LightningRpc.LightningJSONDecoder(object_hook=lambda o: seen.append(o) or o)
+    decoder.decode('{"a": {"b_msat": 1}}')
+    assert isinstance(seen[0]['b_msat'], Millisatoshi)
+    assert len(seen) == 2
+
+
+def test_decoder_msat_modes():
+    data = json.dumps({
+        'amount_msat': 1000,
+        'legacy_msat': '2000msat',
+        'none_msat': None,
+        'fees_msat': [1, 2],
+        'nested': [{'fee_msat': 3}],
+        'other': 4,
+    })
+
+    obj = LightningRpc.LightningJSONDecoder(msat_mode='int').decode(data)
+    assert obj == {'amount_msat': 1000, 'legacy_msat': 2000,
+                   'none_msat': None, 'fees_msat': [1, 2],
+                   'nested': [{'fee_msat': 3}], 'other': 4}
+    assert type(obj['amount_msat']) is int
+    assert type(obj['legacy_msat']) is int
+
+    obj = LightningRpc.LightningJSONDecoder(msat_mode='lazy').decode(data)
+    # Nothing converted until accessed
+    assert type(dict.__getitem__(obj, 'amount_msat')) is int
+    assert isinstance(obj['amount_msat'], Millisatoshi)
+    assert type(dict.__getitem__(obj, 'amount_msat')) is Millisatoshi
+    assert obj.get('legacy_msat') == Millisatoshi(2000)
+    assert obj['none_msat'] is None
+    assert obj.get('missing_msat', 5) == 5
+    assert isinstance(obj['nested'][0]['fee_msat'], Millisatoshi)
+    assert all(isinstance(f, Millisatoshi) for f in dict(obj.items())['fees_msat'])
+    assert obj['other'] == 4
+
+    # However they are read, the amounts are Millisatoshi.
+    def lazy():
+        return LightningRpc.LightningJSONDecoder(msat_mode='lazy').decode(data)
+
+    for copy in (dict(lazy()), {**lazy()}, lazy().copy(), dict(lazy().items())):
+        assert type(copy['amount_msat']) is Millisatoshi
+        assert type(dict.__getitem__(copy, 'legacy_msat')) is Millisatoshi
+    d = {}
+    d.update(lazy())
+    assert type(dict.__getitem__(d, 'amount_msat')) is Millisatoshi
+    assert all(type(v) is Millisatoshi for v in list(lazy().values())[:2])
+    assert type(lazy().pop('amount_msat')) is Millisatoshi
+    assert lazy().pop('missing_msat', None) is None
+    with pytest.raises(KeyError):
+        lazy().pop('missing_msat')
+    assert type(lazy().setdefault('amount_msat')) is Millisatoshi
+    assert lazy().setdefault('missing_msat', 5) == 5
+    obj = lazy()
+    while obj:
+        k, v = obj.popitem()
+        if k in ('amount_msat', 'legacy_msat'):
+            assert type(v) is Millisatoshi
+    assert type(json.loads(json.dumps(lazy(), cls=LightningRpc.LightningJSONEncoder))['amount_msat']) is str
+
+    with pytest.raises(ValueError):
+        LightningRpc.LightningJSONDecoder(msat_mode='float')
+
+
+def test_async_plugin_rpc(lightningd, tmp_path):
+    """An AsyncPlugin's handlers get an async client, and JSON ids
+    prefixed by the request they handle."""
+    stdout = io.TextIOWrapper(io.BytesIO())
+    p = AsyncPlugin(stdout=stdout, autopatch=False)
+
+    @p.init()
+    async def init(options, configuration, plugin):
+        await plugin.rpc.echo(init=True)
+
+    @p.method("hello")
+    async def hello(plugin):
+        return await plugin.rpc.echo(hello=True)
+
+    def request(id, method, params):
+        return json.dumps({'id': id, 'method': method, 'params': params}).encode()
+
+    async def run():
+        await p._dispatch_async(p._parse_request(json.loads(request(1, 'init', {
+            'options': {}, 'configuration': {
+                'rpc-file': 'lightning-rpc', 'lightning-dir': str(tmp_path),
+                'startup': True,
+            }
+        }))))
+        assert isinstance(p.rpc, AsyncLightningRpc)
+        await asyncio.gather(*[
+            p._dispatch_async(p._parse_request(json.loads(request(i, 'hello', {}))))
+            for i in range(2, 5)
+        ])
+        await p.rpc.close_connections()
+
+    asyncio.run(run())
+    msgs = [json.loads(m) for m in stdout.buffer.getvalue().split(b'\n\n')[:-1]]
+    assert sorted((m['id'], m['result']) for m in msgs if m['id'] != 1) == [
+        (i, {'hello': True}) for i in range(2, 5)
+    ]
+    ids = [r['id'] for r in lightningd.requests]
+    assert ids[0].startswith('1/')
+    assert sorted(i.split('/')[0] for i in ids[1:]) == ['2', '3', '4']